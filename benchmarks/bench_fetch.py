@@ -0,0 +1,144 @@
+"""
+取得処理全体（fetch_all_logs → StorageManager → MessageFormatter）のベンチマーク。
+Discord には接続せず、benchmarks/fake_discord.py の合成ギルドから取得します。
+初回の全件取得と、一部のチャンネル/スレッドに新着メッセージを追加した差分取得を続けて計測します。
+
+使い方:
+    python benchmarks/bench_fetch.py
+    python benchmarks/bench_fetch.py --channels 8 --messages 50000 --latency 0.05 --requests-per-sec 40
+    python benchmarks/bench_fetch.py --json result.json --min-rate 5000   # CI 用（下回った場合は終了コード 1）
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from typing import Any, Dict
+
+BENCH_CATEGORY = "benchmark"
+
+async def run_phase(name: str, guild: Any, args: argparse.Namespace) -> Dict[str, Any]:
+    """DiscordFetcher で1回分の取得を実行し、計測結果を返します。"""
+    from src import planner
+    from src.storage import ChannelBuffer
+    from src.fetch_logs import DiscordFetcher, create_client_options
+    from src.metrics import peak_rss_mb
+    from fake_discord import FakeAttachmentDownloader
+
+    # 合成ギルドのカテゴリのみを取得対象にする
+    planner.ALLOWED_CATEGORIES = [BENCH_CATEGORY]
+
+    class BenchFetcher(DiscordFetcher):
+        def get_guild(self, guild_id):
+            return guild
+
+    client = BenchFetcher(**create_client_options())
+    client.downloader = FakeAttachmentDownloader(workers=args.attachment_workers, latency=args.attachment_latency, metrics=client.metrics)
+
+    flushes = 0
+    original_flush = ChannelBuffer.flush
+    def counting_flush(buffer):
+        nonlocal flushes
+        if buffer.current_batch_count:
+            flushes += 1
+        original_flush(buffer)
+    ChannelBuffer.flush = counting_flush
+
+    requests_before = guild.rate_limit.requests
+    waits_before = guild.rate_limit.rate_limit_wait
+    stored_before = stored_message_count()
+    started = time.perf_counter()
+    try:
+        await client.fetch_all_logs()
+        await client.downloader.close()
+    finally:
+        client.storage.handles.close_all()
+        client.metrics.unwatch_rate_limits()
+        ChannelBuffer.flush = original_flush
+    elapsed = time.perf_counter() - started
+
+    messages = stored_message_count() - stored_before
+    return {
+        "phase": name,
+        "messages": messages,
+        "wall_time_s": round(elapsed, 3),
+        "messages_per_sec": round(messages / elapsed, 1) if elapsed else 0.0,
+        "flushes": flushes,
+        "flushes_per_sec": round(flushes / elapsed, 1) if elapsed else 0.0,
+        "skipped_targets": client.skipped_count,
+        "api_requests": guild.rate_limit.requests - requests_before,
+        "rate_limit_wait_s": round(guild.rate_limit.rate_limit_wait - waits_before, 3),
+        "attachments": client.downloader.downloaded_count,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def stored_message_count() -> int:
+    """保存済みの messages.jsonl の総行数"""
+    from src.config import DATA_DIR
+    total = 0
+    for root, _dirs, files in os.walk(DATA_DIR):
+        if "messages.jsonl" in files:
+            with open(os.path.join(root, "messages.jsonl"), 'rb') as f:
+                total += sum(1 for _ in f)
+    return total
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    from fake_discord import FakeGuild, FakeGuildSpec, FakeRateLimit
+
+    spec = FakeGuildSpec(channels=args.channels, messages=args.messages, threads=args.threads, thread_messages=args.thread_messages,
+                         attachment_ratio=args.attachment_ratio, seed=args.seed)
+    guild = FakeGuild(spec, BENCH_CATEGORY, FakeRateLimit(latency=args.latency, requests_per_sec=args.requests_per_sec))
+
+    results = [await run_phase("full", guild, args)]
+    guild.add_messages(args.incremental_messages, every=args.incremental_every)
+    results.append(await run_phase("incremental", guild, args))
+    return {"spec": vars(args), "results": results}
+
+def main():
+    parser = argparse.ArgumentParser(description="取得処理全体のオフラインベンチマーク")
+    parser.add_argument("--channels", type=int, default=4, help="チャンネル数 (既定: 4)")
+    parser.add_argument("--messages", type=int, default=20_000, help="チャンネルあたりのメッセージ数 (既定: 20000)")
+    parser.add_argument("--threads", type=int, default=2, help="チャンネルあたりのスレッド数 (既定: 2)")
+    parser.add_argument("--thread-messages", type=int, default=1_000, help="スレッドあたりのメッセージ数 (既定: 1000)")
+    parser.add_argument("--attachment-ratio", type=float, default=0.02, help="添付ファイルを持つメッセージの割合 (既定: 0.02)")
+    parser.add_argument("--attachment-workers", type=int, default=4)
+    parser.add_argument("--attachment-latency", type=float, default=0.0, help="添付ファイル1件あたりのダウンロードの待ち時間（秒）")
+    parser.add_argument("--latency", type=float, default=0.0, help="履歴1ページ (100件) あたりのAPIの待ち時間（秒）")
+    parser.add_argument("--requests-per-sec", type=float, default=0.0, help="APIリクエストの上限（超過分はレート制限として待機、0 は無制限）")
+    parser.add_argument("--incremental-messages", type=int, default=200, help="差分取得で追加するメッセージ数（対象ごと）")
+    parser.add_argument("--incremental-every", type=int, default=3, help="差分取得で新着を追加する対象の間隔（3 の場合は3件に1件）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="計測結果を書き出すJSONファイル")
+    parser.add_argument("--min-rate", type=float, default=0.0, help="初回取得の messages/sec がこの値を下回った場合に終了コード 1 で終了する")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # src.config の読み込み前に保存先を一時ディレクトリへ切り替える
+        os.environ["SDI_DATA_DIR"] = data_dir
+        benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+        sys.path.insert(0, os.path.dirname(benchmarks_dir))
+        sys.path.insert(0, benchmarks_dir)
+        from src.config import LOGGER_NAME
+        logging.getLogger(LOGGER_NAME).setLevel(logging.WARNING)
+        report = asyncio.run(run(args))
+
+    for result in report["results"]:
+        rss = result["peak_rss_mb"]
+        print(f"[{result['phase']}] messages: {result['messages']}, wall: {result['wall_time_s']:.2f} s, "
+              f"{result['messages_per_sec']:,.0f} msgs/s, flushes: {result['flushes']} ({result['flushes_per_sec']:,.1f}/s), "
+              f"skipped: {result['skipped_targets']}, requests: {result['api_requests']}, rate limit wait: {result['rate_limit_wait_s']:.2f} s, "
+              f"attachments: {result['attachments']}" + (f", peak rss: {rss:.1f} MB" if rss is not None else ""))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+
+    full = report["results"][0]
+    if args.min_rate and full["messages_per_sec"] < args.min_rate:
+        print(f"messages/sec が下限 {args.min_rate:,.0f} を下回りました", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
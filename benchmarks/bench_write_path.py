@@ -0,0 +1,79 @@
+"""
+書き込み経路（メッセージの変換 → バッファ → フラッシュ）のマイクロベンチマーク。
+Discord には接続せず、合成したメッセージを ChannelBuffer に直接追加します。
+
+使い方:
+    python benchmarks/bench_write_path.py                     # 100万件
+    python benchmarks/bench_write_path.py -n 100000 --batch-size 100 --max-batch-size 100
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import datetime
+import tempfile
+from types import SimpleNamespace
+
+def make_message(message_id: int, created_at: datetime.datetime, channel_id: int) -> SimpleNamespace:
+    """ChannelBuffer.render が参照する属性のみを持つ合成メッセージ"""
+    author = SimpleNamespace(id=1000 + message_id % 50, name=f"user{message_id % 50}", discriminator="0",
+                             display_name=f"User {message_id % 50}", bot=False)
+    content = f"benchmark message {message_id} " + "lorem ipsum " * (message_id % 8)
+    reference = SimpleNamespace(message_id=message_id - 3, channel_id=channel_id, guild_id=0) if message_id % 10 == 0 else None
+    return SimpleNamespace(id=message_id, author=author, content=content, clean_content=content, created_at=created_at,
+                           edited_at=None, attachments=[], embeds=[], reference=reference, reactions=[])
+
+async def run(count: int, batch_size: int, max_batch_size: int, interval: float) -> None:
+    from src.storage import StorageManager
+    from src.metrics import peak_rss_mb
+
+    data_dir = os.environ["SDI_DATA_DIR"]
+    channel_dir = os.path.join(data_dir, "bench", "channel")
+    messages_dir = os.path.join(channel_dir, "messages")
+    os.makedirs(messages_dir, exist_ok=True)
+
+    storage = StorageManager(batch_size=batch_size, max_batch_size=max_batch_size)
+    buffer = storage.create_buffer("1", os.path.join(channel_dir, "attachments"), messages_dir, os.path.join(channel_dir, "messages.jsonl"), channel_id=1)
+
+    flushes = 0
+    original_flush = buffer.flush
+    def counting_flush():
+        nonlocal flushes
+        if buffer.current_batch_count:
+            flushes += 1
+        original_flush()
+    buffer.flush = counting_flush
+
+    start_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    started = time.perf_counter()
+    for i in range(1, count + 1):
+        await buffer.add_message(make_message(i, start_at + datetime.timedelta(seconds=i * interval), 1))
+    buffer.flush()
+    buffer.close()
+    elapsed = time.perf_counter() - started
+
+    rss = peak_rss_mb()
+    print(f"messages: {count}")
+    print(f"elapsed: {elapsed:.2f} s ({count / elapsed:,.0f} msgs/s)")
+    print(f"flushes: {flushes} (final batch size: {buffer.batch_size})")
+    print(f"jsonl: {os.path.getsize(buffer.jsonl_file) / 1024 / 1024:.1f} MB, days: {len(os.listdir(messages_dir))}")
+    if rss is not None:
+        print(f"peak rss: {rss:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="書き込み経路のマイクロベンチマーク")
+    parser.add_argument("-n", "--count", type=int, default=1_000_000, help="合成するメッセージ数 (既定: 1000000)")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--max-batch-size", type=int, default=1000, help="バッチサイズの自動調整の上限 (batch-size 以下で無効)")
+    parser.add_argument("--interval", type=float, default=2.0, help="合成メッセージの投稿間隔（秒）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # src.config の読み込み前に保存先を一時ディレクトリへ切り替える
+        os.environ["SDI_DATA_DIR"] = data_dir
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        asyncio.run(run(args.count, args.batch_size, args.max_batch_size, args.interval))
+
+if __name__ == "__main__":
+    main()
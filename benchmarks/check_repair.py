@@ -0,0 +1,181 @@
+"""
+チェックポイントの巻き戻し（StorageManager.repair / rollback_checkpoint）の回帰テスト。
+Discord には接続せず、合成したメッセージを ChannelBuffer に書き込み、状態の保存後に書き込んだデータが
+中断（状態を保存せずに終了）またはフラッシュの失敗によって、保存時点の内容へ正しく戻ることを確認します。
+
+確認する内容:
+    - messages.jsonl / messages.idx / 日付ごとのMarkdown が状態の保存時点と同じ内容に戻ること（保存後に作成されたファイルは削除）
+    - fetch_state.json とメモリ上の状態が保存時点の最後のメッセージIDを指すこと
+    - ジャーナルが残らず、続きから取得し直した場合に重複や欠落がないこと
+
+使い方:
+    python benchmarks/check_repair.py
+全ての確認に成功した場合は終了コード 0、失敗した場合は 1 で終了します。
+"""
+import os
+import sys
+import json
+import asyncio
+import datetime
+import tempfile
+from typing import Dict, List
+
+from bench_write_path import make_message
+
+# 合成メッセージの開始時刻と投稿間隔（1時間ごと。1日あたり24件のため、書き込みが複数の日付にまたがる）
+START_AT = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+INTERVAL = 3600
+
+failures: List[str] = []
+
+def check(name: str, ok: bool) -> None:
+    print(f"{'OK' if ok else 'NG'}: {name}")
+    if not ok:
+        failures.append(name)
+
+def snapshot(channel_dir: str) -> Dict[str, bytes]:
+    """保存先のディレクトリ配下の全ファイルの内容を返します。"""
+    files = {}
+    for root, _dirs, names in os.walk(channel_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, channel_dir)] = f.read()
+    return files
+
+def saved_state(state_file: str) -> Dict:
+    with open(state_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+class Channel:
+    """1つのチャンネルの保存先と、StorageManager の生成（起動時の repair を含む）"""
+    def __init__(self, data_dir: str, key: str):
+        self.key = key
+        self.dir = os.path.join(data_dir, "check", f"channel-{key}")
+        self.messages_dir = os.path.join(self.dir, "messages")
+        os.makedirs(self.messages_dir, exist_ok=True)
+
+    def open(self, batch_size: int):
+        from src.storage import StorageManager
+        storage = StorageManager(batch_size=batch_size)
+        buffer = storage.create_buffer(self.key, os.path.join(self.dir, "attachments"), self.messages_dir, os.path.join(self.dir, "messages.jsonl"), channel_id=1)
+        return storage, buffer
+
+class FailingWrite:
+    """write() だけが失敗するファイルハンドル"""
+    def __init__(self, handle):
+        self.handle = handle
+
+    def write(self, data: bytes) -> int:
+        raise OSError("injected failure")
+
+    def __getattr__(self, name: str):
+        return getattr(self.handle, name)
+
+async def write(buffer, first: int, last: int) -> None:
+    """メッセージ first..last を書き込みます（バッチサイズごとにフラッシュされます）。"""
+    for i in range(first, last + 1):
+        await buffer.add_message(make_message(i, START_AT + datetime.timedelta(seconds=i * INTERVAL), 1))
+
+def check_rolled_back(label: str, channel: Channel, storage, expected_files: Dict[str, bytes], checkpoint_id: int) -> None:
+    from src.config import STATE_FILE
+    from src.message_index import MessageIndex
+
+    files = snapshot(channel.dir)
+    check(f"{label}: 保存後に作成されたファイルが削除される", sorted(files) == sorted(expected_files))
+    check(f"{label}: messages.jsonl が保存時点の内容に戻る", files.get("messages.jsonl") == expected_files["messages.jsonl"])
+    check(f"{label}: messages.idx が保存時点の内容に戻る", files.get("messages.idx") == expected_files["messages.idx"])
+    md_files = [name for name in expected_files if name.endswith(".md")]
+    check(f"{label}: 日付ごとのMarkdown ({len(md_files)} 件) が保存時点の内容に戻る", all(files.get(name) == expected_files[name] for name in md_files))
+    check(f"{label}: 状態ファイルが保存時点のIDを指す", saved_state(STATE_FILE).get(channel.key) == checkpoint_id)
+    check(f"{label}: メモリ上の状態が保存時点のIDを指す", storage.get_last_message_id(channel.key) == checkpoint_id)
+    check(f"{label}: ジャーナルが残らない", not os.path.exists(storage.journal_path(channel.key)))
+    index = MessageIndex(os.path.join(channel.dir, "messages.jsonl"))
+    check(f"{label}: 索引で保存時点の最後のメッセージを引ける", (index.lookup(checkpoint_id) or {}).get("id") == checkpoint_id)
+    check(f"{label}: 索引で巻き戻したメッセージを引けない", index.lookup(checkpoint_id + 1) is None)
+
+async def check_resume(label: str, channel: Channel, total: int) -> None:
+    """巻き戻した位置から続きを書き込み、messages.jsonl に重複や欠落がないことを確認します。"""
+    storage, buffer = channel.open(batch_size=50)
+    await write(buffer, storage.get_last_message_id(channel.key) + 1, total)
+    buffer.flush()
+    storage.save_state()
+    storage.handles.close_all()
+    with open(buffer.jsonl_file, 'r', encoding='utf-8') as f:
+        ids = [json.loads(line)["id"] for line in f]
+    check(f"{label}: 続きから書き込んだ messages.jsonl に重複や欠落がない", ids == list(range(1, total + 1)))
+
+async def run_crash(data_dir: str) -> None:
+    """状態の保存後に複数回フラッシュし、状態を保存せずに終了した場合（起動時の repair）"""
+    import src.storage as storage_module
+
+    channel = Channel(data_dir, "1")
+    storage, buffer = channel.open(batch_size=50)
+    await write(buffer, 1, 500)
+    buffer.flush()
+    storage.save_state()
+    expected_files = snapshot(channel.dir)
+
+    # 保存後のフラッシュで状態ファイルが保存されないよう、保存の間隔を無効にする
+    interval = storage_module.STATE_SAVE_INTERVAL
+    storage_module.STATE_SAVE_INTERVAL = float("inf")
+    try:
+        await write(buffer, 501, 1000)
+        buffer.flush()
+    finally:
+        storage_module.STATE_SAVE_INTERVAL = interval
+    check("中断: 保存後のフラッシュでジャーナルが作成される", channel.key in storage.journals)
+    check("中断: 保存後のフラッシュで新しい日付のMarkdownが作成される", len(snapshot(channel.dir)) > len(expected_files))
+    # 中断を再現する（状態を保存せずにハンドルだけを閉じる）
+    storage.handles.close_all()
+
+    storage, _buffer = channel.open(batch_size=50)
+    check_rolled_back("中断", channel, storage, expected_files, 500)
+    await check_resume("中断", channel, 1000)
+
+async def run_flush_failure(data_dir: str) -> None:
+    """状態の保存後にフラッシュが成功し、続くフラッシュが書き込みの途中で失敗した場合（rollback_checkpoint）"""
+    channel = Channel(data_dir, "2")
+    storage, buffer = channel.open(batch_size=1000)
+    await write(buffer, 1, 500)
+    buffer.flush()
+    storage.save_state()
+    expected_files = snapshot(channel.dir)
+
+    await write(buffer, 501, 600)
+    buffer.flush()
+    await write(buffer, 601, 700)
+    # messages.jsonl とMarkdownを書き込んだ後、索引の書き込みで失敗させる
+    original_get = storage.handles.get
+    def failing_get(path: str):
+        handle = original_get(path)
+        return FailingWrite(handle) if path == buffer.index.path else handle
+    storage.handles.get = failing_get
+    try:
+        buffer.flush()
+        check("フラッシュの失敗: OSError が送出される", False)
+    except OSError:
+        check("フラッシュの失敗: OSError が送出される", True)
+    finally:
+        storage.handles.get = original_get
+    check_rolled_back("フラッシュの失敗", channel, storage, expected_files, 500)
+    storage.handles.close_all()
+    await check_resume("フラッシュの失敗", channel, 700)
+
+async def run(data_dir: str) -> None:
+    await run_crash(data_dir)
+    await run_flush_failure(data_dir)
+
+def main():
+    with tempfile.TemporaryDirectory() as data_dir:
+        # src.config の読み込み前に保存先を一時ディレクトリへ切り替える
+        os.environ["SDI_DATA_DIR"] = data_dir
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        asyncio.run(run(data_dir))
+    if failures:
+        print(f"{len(failures)} 件の確認に失敗しました。")
+        sys.exit(1)
+    print("全ての確認に成功しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+ベンチマーク用の discord.Client / Guild / TextChannel / Thread / history() の代替。
+Discord には接続せず、チャンネルごとに決まった規則で合成したメッセージを返します。
+
+メッセージは history() の呼び出し時に生成するため、件数を増やしても代替側のメモリ使用量は増えません。
+history() は100件ごとに FakeRateLimit を通してページを要求し、APIの待ち時間とレート制限による待機を再現します。
+"""
+import os
+import time
+import random
+import asyncio
+import datetime
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import AsyncIterator, List, Optional
+import discord
+from discord.utils import time_snowflake
+from src.downloader import AttachmentDownloader, DownloadJob
+
+# history() の1ページあたりの件数（discord.py と同じ）
+PAGE_SIZE = 100
+
+@dataclass
+class FakeGuildSpec:
+    """合成するギルドの規模"""
+    channels: int = 4
+    messages: int = 10_000
+    threads: int = 2
+    thread_messages: int = 500
+    attachment_ratio: float = 0.05
+    # 合成メッセージの投稿間隔（秒）
+    interval: float = 60.0
+    seed: int = 0
+
+class FakeRateLimit:
+    """
+    ページ要求ごとの待ち時間 (latency) と、1秒あたりのリクエスト数の上限 (requests_per_sec) を再現します。
+    上限を超えたリクエストは discord.py の 429 処理と同様に、次の枠まで待機します。
+    """
+    def __init__(self, latency: float = 0.0, requests_per_sec: float = 0.0):
+        self.latency: float = latency
+        self.interval: float = 1.0 / requests_per_sec if requests_per_sec > 0 else 0.0
+        self.next_slot: float = 0.0
+        self.requests: int = 0
+        self.rate_limited: int = 0
+        self.rate_limit_wait: float = 0.0
+
+    async def request(self) -> None:
+        self.requests += 1
+        if self.interval:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+            if wait > 0:
+                self.rate_limited += 1
+                self.rate_limit_wait += wait
+                await asyncio.sleep(wait)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+class FakeMessageStream:
+    """
+    1つのチャンネル/スレッドのメッセージ列。i 番目のメッセージは (開始時刻, 投稿間隔, i) から決まり、IDは i について単調増加します。
+    """
+    def __init__(self, owner_id: int, salt: int, started_at: datetime.datetime, count: int, interval: float, attachment_ratio: float, seed: int):
+        self.owner_id: int = owner_id
+        # 同じ時刻のメッセージがチャンネル間で同じIDにならないよう、IDの下位ビットに加える値
+        self.salt: int = salt
+        self.started_at: datetime.datetime = started_at
+        self.count: int = count
+        self.interval: float = interval
+        self.attachment_ratio: float = attachment_ratio
+        self.seed: int = seed
+
+    def message_id(self, i: int) -> int:
+        return time_snowflake(self.created_at(i)) + self.salt
+
+    def created_at(self, i: int) -> datetime.datetime:
+        return self.started_at + datetime.timedelta(seconds=(i + 1) * self.interval)
+
+    @property
+    def last_message_id(self) -> Optional[int]:
+        return self.message_id(self.count - 1) if self.count else None
+
+    def index_after(self, message_id: int) -> int:
+        """message_id より大きいIDを持つ最初のメッセージの番号を二分探索で返します。"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.message_id(mid) <= message_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def message(self, i: int) -> SimpleNamespace:
+        """ChannelBuffer.render と MessageFormatter.to_markdown が参照する属性のみを持つ合成メッセージ"""
+        rng = random.Random(self.seed * 1_000_003 + self.owner_id + i)
+        message_id = self.message_id(i)
+        user = rng.randrange(50)
+        author = SimpleNamespace(id=1000 + user, name=f"user{user}", discriminator="0", display_name=f"User {user}", bot=False)
+        content = f"message {i} " + "lorem ipsum " * rng.randrange(12)
+        attachments = []
+        if rng.random() < self.attachment_ratio:
+            size = rng.randrange(1024, 256 * 1024)
+            attachments.append(SimpleNamespace(id=message_id, filename=f"image_{i}.png", url=f"https://cdn.invalid/{message_id}/image_{i}.png", size=size))
+        reference = None
+        if i > 0 and rng.random() < 0.1:
+            reference = SimpleNamespace(message_id=self.message_id(rng.randrange(max(0, i - 50), i)), channel_id=self.owner_id, guild_id=0)
+        return SimpleNamespace(id=message_id, channel=SimpleNamespace(id=self.owner_id), author=author, content=content, clean_content=content, created_at=self.created_at(i),
+                               edited_at=None, attachments=attachments, embeds=[], reference=reference, reactions=[])
+
+    async def history(self, rate_limit: FakeRateLimit, limit: Optional[int] = None, after: Optional[discord.abc.Snowflake] = None,
+                      before: Optional[discord.abc.Snowflake] = None, oldest_first: Optional[bool] = None) -> AsyncIterator[SimpleNamespace]:
+        start = self.index_after(after.id) if after else 0
+        end = self.index_after(before.id - 1) if before else self.count
+        indices = range(start, end) if oldest_first or (oldest_first is None and after) else range(end - 1, start - 1, -1)
+        if limit is not None:
+            indices = indices[:limit]
+        for n, i in enumerate(indices):
+            if n % PAGE_SIZE == 0:
+                await rate_limit.request()
+            yield self.message(i)
+
+class FakeTextChannel(discord.TextChannel):
+    """FetchPlanner の isinstance 判定を通過するテキストチャンネルの代替"""
+    def __init__(self, guild: "FakeGuild", channel_id: int, name: str, category: Optional[SimpleNamespace], stream: FakeMessageStream):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.topic = None
+        self.stream: FakeMessageStream = stream
+        self.fake_category = category
+        self.fake_threads: List["FakeThread"] = []
+        self.last_message_id = stream.last_message_id
+
+    @property
+    def category(self):
+        return self.fake_category
+
+    @property
+    def threads(self):
+        return self.fake_threads
+
+    @property
+    def type(self):
+        return discord.ChannelType.text
+
+    @property
+    def created_at(self):
+        return discord.utils.snowflake_time(self.id)
+
+    def history(self, **kwargs):
+        return self.stream.history(self.guild.rate_limit, **kwargs)
+
+    async def archived_threads(self, **kwargs):
+        await self.guild.rate_limit.request()
+        for thread in []:
+            yield thread
+
+class FakeThread(discord.Thread):
+    """FetchPlanner の isinstance 判定を通過するスレッドの代替（アクティブなスレッドとして扱う）"""
+    def __init__(self, guild: "FakeGuild", parent: FakeTextChannel, thread_id: int, name: str, stream: FakeMessageStream):
+        self.guild = guild
+        self.id = thread_id
+        self.name = name
+        self.parent_id = parent.id
+        self.fake_parent = parent
+        self.stream: FakeMessageStream = stream
+        self.archive_timestamp = None
+        self.last_message_id = stream.last_message_id
+
+    @property
+    def parent(self):
+        return self.fake_parent
+
+    @property
+    def type(self):
+        return discord.ChannelType.public_thread
+
+    @property
+    def created_at(self):
+        return discord.utils.snowflake_time(self.id)
+
+    def history(self, **kwargs):
+        return self.stream.history(self.guild.rate_limit, **kwargs)
+
+class FakeGuild:
+    """合成したチャンネルとスレッドを持つギルドの代替"""
+    def __init__(self, spec: FakeGuildSpec, category_name: str, rate_limit: FakeRateLimit, started_at: Optional[datetime.datetime] = None):
+        self.spec: FakeGuildSpec = spec
+        self.id: int = 1
+        self.name: str = "benchmark"
+        self.rate_limit: FakeRateLimit = rate_limit
+        self.started_at: datetime.datetime = started_at or datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        category = SimpleNamespace(name=category_name)
+        self.channels: List[FakeTextChannel] = []
+        self.threads: List[FakeThread] = []
+        self.stream_count: int = 0
+        base_id = time_snowflake(self.started_at)
+        for c in range(spec.channels):
+            channel_id = base_id + c + 1
+            channel = FakeTextChannel(self, channel_id, f"channel-{c}", category, self._stream(channel_id, spec.messages))
+            for t in range(spec.threads):
+                thread_id = base_id + 4096 * (c + 1) + t + 1
+                channel.fake_threads.append(FakeThread(self, channel, thread_id, f"thread-{c}-{t}", self._stream(thread_id, spec.thread_messages)))
+            self.channels.append(channel)
+
+    def _stream(self, owner_id: int, count: int) -> FakeMessageStream:
+        self.stream_count += 1
+        return FakeMessageStream(owner_id, self.stream_count, self.started_at, count, self.spec.interval, self.spec.attachment_ratio, self.spec.seed)
+
+    def get_channel(self, channel_id: int):
+        return next((c for c in self.channels if c.id == channel_id), None)
+
+    @property
+    def targets(self) -> List[discord.abc.Messageable]:
+        return [*self.channels, *(t for c in self.channels for t in c.fake_threads)]
+
+    def add_messages(self, count: int, every: int = 1) -> int:
+        """every 件おきのチャンネル/スレッドに新着メッセージを count 件ずつ追加し、追加した総数を返します（差分取得の計測用）。"""
+        added = 0
+        for k, target in enumerate(self.targets):
+            if k % every:
+                continue
+            target.stream.count += count
+            target.last_message_id = target.stream.last_message_id
+            added += count
+        return added
+
+    @property
+    def message_count(self) -> int:
+        return sum(target.stream.count for target in self.targets)
+
+class FakeAttachmentDownloader(AttachmentDownloader):
+    """HTTP の代わりに、待ち時間の後で添付ファイルのサイズ分のデータを書き込むダウンローダー"""
+    def __init__(self, *args, latency: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency: float = latency
+
+    async def _download(self, job: DownloadJob) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        with open(job.path, 'wb') as f:
+            f.write(os.urandom(job.size))
+        self.downloaded_bytes += job.size
+        self.downloaded_count += 1
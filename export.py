@@ -0,0 +1,20 @@
+import logging
+from src.config import LOGGER_NAME, EXPORT_DIR
+from src.exporter import ParquetExporter
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def main():
+    """
+    保存済みの messages.jsonl を分析用の Parquet データセットへエクスポートするエントリーポイント
+    """
+    try:
+        exporter = ParquetExporter()
+    except RuntimeError as e:
+        logger.error(str(e))
+        return
+    count = exporter.run()
+    logger.info(f"{count} 件のメッセージをエクスポートしました: {EXPORT_DIR}")
+
+if __name__ == "__main__":
+    main()
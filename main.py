@@ -1,6 +1,7 @@
 import logging
+import argparse
 from src.fetch_logs import run_fetcher
-from src.config import LOGGER_NAME
+from src.config import LOGGER_NAME, DAEMON_ENABLED, RECONCILE_ENABLED, MAX_RUNTIME
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -8,9 +9,15 @@ def main():
     """
     プログラムのエントリーポイント
     """
+    parser = argparse.ArgumentParser(description="Discord サーバーのログを取得します。")
+    parser.add_argument("--daemon", action="store_true", help="取得後も接続を維持し、新着メッセージをリアルタイムに保存する")
+    parser.add_argument("--reconcile", action="store_true", help="直近の期間を再取得し、取得済みメッセージの編集/削除を反映する")
+    parser.add_argument("--max-runtime", type=float, default=MAX_RUNTIME, metavar="SECONDS", help="取得に使う時間の上限（秒）。超過した場合は状態を保存し、残りのチャンネル/スレッドを次回に持ち越す")
+    args = parser.parse_args()
+
     try:
         logger.info("Simple-Discord-Indexer を開始します。")
-        run_fetcher()
+        run_fetcher(daemon=args.daemon or DAEMON_ENABLED, reconcile=args.reconcile or RECONCILE_ENABLED, max_runtime=args.max_runtime)
     except KeyboardInterrupt:
         logger.info("ユーザーによって中断されました。")
     except Exception as e:
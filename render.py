@@ -0,0 +1,22 @@
+import logging
+import argparse
+from src.config import LOGGER_NAME
+from src.renderer import MarkdownRenderer
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def main():
+    """
+    保存済みの messages.jsonl から日付ごとのMarkdownを再生成するエントリーポイント（Discordへの接続は行いません）
+    """
+    parser = argparse.ArgumentParser(description="保存済みの messages.jsonl から日付ごとのMarkdownを再生成します。")
+    parser.add_argument("--force", action="store_true", help="変更の有無にかかわらず全ての日付を再生成する")
+    parser.add_argument("-j", "--workers", type=int, help="並行して処理するプロセス数 (既定: CPUコア数)")
+    args = parser.parse_args()
+
+    renderer = MarkdownRenderer(workers=args.workers)
+    channels, rendered = renderer.run(force=args.force)
+    logger.info(f"{channels} 件のチャンネル/スレッドを確認し、{rendered} 日分のMarkdownを再生成しました。")
+
+if __name__ == "__main__":
+    main()
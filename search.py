@@ -0,0 +1,47 @@
+import os
+import sys
+import logging
+import argparse
+from src.config import LOGGER_NAME, DATA_DIR, SEARCH_DB_FILE
+from src.search_index import SearchIndex
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def main():
+    """
+    全文検索インデックスを検索するエントリーポイント
+    """
+    parser = argparse.ArgumentParser(description="取得したメッセージを全文検索します。")
+    parser.add_argument("query", nargs="?", help="検索語句")
+    parser.add_argument("-n", "--limit", type=int, default=20, help="表示する件数 (既定: 20)")
+    parser.add_argument("--author", help="表示名で絞り込み")
+    parser.add_argument("--channel", type=int, help="チャンネルIDまたはスレッドIDで絞り込み")
+    parser.add_argument("--since", help="この日付以降 (YYYY-MM-DD)")
+    parser.add_argument("--until", help="この日付以前 (YYYY-MM-DD)")
+    parser.add_argument("--raw", action="store_true", help="FTS5 のクエリ構文をそのまま使用する")
+    parser.add_argument("--rebuild", action="store_true", help="全ての messages.jsonl からインデックスを作り直す")
+    args = parser.parse_args()
+
+    if not args.rebuild and not args.query:
+        parser.error("検索語句を指定してください。")
+
+    index = SearchIndex()
+    try:
+        if args.rebuild:
+            count = index.rebuild()
+            logger.info(f"{count} 件のメッセージをインデックスに追加しました: {SEARCH_DB_FILE}")
+            if not args.query:
+                return
+
+        rows = index.search(args.query, limit=args.limit, author=args.author, channel_id=args.channel,
+                            since=args.since, until=args.until, raw=args.raw)
+        for row in rows:
+            print(f"{row['created_at'][:16]}  {row['author_name']}  {os.path.join(DATA_DIR, row['md_path'])}")
+            print(f"    {row['snippet']}")
+        if not rows:
+            print("見つかりませんでした。", file=sys.stderr)
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import datetime
+import logging
+from typing import List, Optional, Tuple
+import discord
+from discord.utils import snowflake_time
+from .config import LOGGER_NAME
+from .storage import ChannelBuffer
+from .formatter import MessageFormatter
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class SlicedBackfill:
+    """
+    初回取得時に、チャンネルの期間をスノーフレークIDの範囲で分割して並行に取得するクラス。
+    最初のスライスはそのままバッファへ書き込み、それ以降のスライスは一時ファイル (spool) に
+    変換済みのメッセージを書き出しておき、前のスライスが完了した順に古い方からバッファへ再生します。
+    そのため messages.jsonl と日付ごとのMarkdownは通常の取得と同じ順序で書き込まれ、
+    チェックポイントも再生に合わせて進みます。
+    deadline（time.monotonic()）を過ぎた場合は全てのスライスの取得を止め、古い方から途切れずに取得できた分だけを書き込みます
+    （interrupted が True になり、残りは次回の通常の取得で取得されます）。
+    """
+    def __init__(self, messageable: discord.abc.Messageable, buffer: ChannelBuffer, slices: int, spool_dir: str, label: str = "", deadline: Optional[float] = None):
+        self.messageable = messageable
+        self.buffer: ChannelBuffer = buffer
+        self.slices: int = slices
+        self.spool_dir: str = spool_dir
+        self.label: str = label
+        self.deadline: Optional[float] = deadline
+        # 実行時間の上限により、全ての期間を取得する前に中断したかどうか
+        self.interrupted: bool = False
+
+    @staticmethod
+    def is_applicable(messageable: discord.abc.Messageable, last_message_id: Optional[int], slices: int, min_days: int) -> bool:
+        """初回取得で、かつチャンネルの期間が十分に長い場合のみ分割取得を行います。"""
+        cached_last_id = getattr(messageable, 'last_message_id', None)
+        if slices <= 1 or last_message_id is not None or not cached_last_id:
+            return False
+        span = snowflake_time(int(cached_last_id)) - snowflake_time(messageable.id)
+        return span >= datetime.timedelta(days=min_days)
+
+    def boundaries(self) -> List[int]:
+        """
+        スライスの境界となるIDのリストを返します。スライス k は [b[k], b[k+1]) の範囲を担当します。
+        フォーラムの最初の投稿はスレッドと同じIDを持つため、先頭はチャンネルIDそのものを含めます。
+        """
+        start = self.messageable.id
+        end = int(self.messageable.last_message_id) + 1
+        step = max(1, (end - start) // self.slices)
+        bounds = [start + step * k for k in range(self.slices)]
+        bounds.append(end)
+        return bounds
+
+    async def run(self) -> int:
+        """分割取得を実行し、バッファへ書き込んだメッセージ数を返します。"""
+        bounds = self.boundaries()
+        if os.path.isdir(self.spool_dir):
+            shutil.rmtree(self.spool_dir)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        logger.info(f'    {self.label}: {len(bounds) - 1} 個の期間に分割して取得します。')
+
+        tasks = [asyncio.create_task(self._fetch_slice(k, bounds[k], bounds[k + 1])) for k in range(1, len(bounds) - 1)]
+        count = 0
+        try:
+            # 最初のスライスは直接バッファへ書き込む
+            count += await self._fetch_into_buffer(bounds[0], bounds[1])
+            for k, task in enumerate(tasks, start=1):
+                if self.interrupted:
+                    break
+                # 前のスライスまで書き込み済みのため、完了した順に再生できる（中断されたスライスも先頭から取得した分は再生できる）
+                spool_file, complete = await task
+                count += self._replay(spool_file)
+                self.interrupted = not complete
+                logger.info(f'    ... {self.label}: 期間 {k + 1}/{len(bounds) - 1} を書き込みました (計 {count} 件)')
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+        return count
+
+    def _history(self, start: int, end: int):
+        return self.messageable.history(limit=None, after=discord.Object(id=start - 1), before=discord.Object(id=end), oldest_first=True)
+
+    def _past_deadline(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    async def _fetch_into_buffer(self, start: int, end: int) -> int:
+        count = 0
+        async for message in self._history(start, end):
+            await self.buffer.add_message(message)
+            count += 1
+            if self._past_deadline():
+                self.interrupted = True
+                break
+        return count
+
+    async def _fetch_slice(self, index: int, start: int, end: int) -> Tuple[str, bool]:
+        """スライスを一時ファイルへ書き出し、(一時ファイルのパス, 最後まで取得できたかどうか) を返します。"""
+        spool_file = os.path.join(self.spool_dir, f"slice_{index:04d}.jsonl")
+        with open(spool_file, 'w', encoding='utf-8') as f:
+            async for message in self._history(start, end):
+                msg_date_str, formatted_msg, msg_data = await self.buffer.render(message)
+                f.write(json.dumps([message.id, msg_date_str, formatted_msg, msg_data], ensure_ascii=False) + "\n")
+                if self._past_deadline():
+                    return spool_file, False
+        return spool_file, True
+
+    def _replay(self, spool_file: str) -> int:
+        count = 0
+        with open(spool_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                message_id, msg_date_str, formatted_msg, msg_data = json.loads(line)
+                # 前のスライスにある返信先は、書き込み済みになった時点で引き直す
+                if formatted_msg is not None:
+                    formatted_msg = MessageFormatter.resolve_reply(formatted_msg, msg_data, self.buffer.lookup_message)
+                self.buffer.add_rendered(message_id, msg_date_str, formatted_msg, msg_data)
+                count += 1
+        os.remove(spool_file)
+        return count
@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import Dict, Optional
+from .config import LOGGER_NAME, BLOB_DIR
+from .utils import atomic_write_json
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class BlobStore:
+    """
+    添付ファイルを内容のハッシュ (SHA-256) で管理するストア。
+    実体は BLOB_DIR/ab/abcdef... に一度だけ保存し、各チャンネルの attachments には
+    ハードリンク（利用できない場合は相対シンボリックリンク、最後の手段としてコピー）を作成します。
+    既存のMarkdownリンクは attachments/ 配下のパスのままなので影響を受けません。
+    add() と link() はダウンローダーのワーカーから別スレッドで並行して呼び出されます
+    （同じ内容のブロブの置き換えは同じ結果になり、インデックスへの追加は1件ずつの代入のみのため排他は不要です）。
+    """
+    def __init__(self, root: str = BLOB_DIR):
+        self.root: str = root
+        self.index_file: str = os.path.join(root, 'index.json')
+        # "ETag:サイズ" -> ハッシュ。ダウンロード前に既知のファイルかどうかを判定するために使用する
+        self.index: Dict[str, str] = {}
+        os.makedirs(root, exist_ok=True)
+        self.load_index()
+
+    def load_index(self) -> None:
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"ブロブストアのインデックス {self.index_file} の読み込みに失敗しました: {e}")
+
+    def save_index(self) -> None:
+        try:
+            atomic_write_json(self.index_file, self.index)
+        except OSError as e:
+            logger.error(f"ブロブストアのインデックスの保存に失敗しました: {e}")
+
+    @staticmethod
+    def index_key(etag: Optional[str], size: int) -> Optional[str]:
+        if not etag:
+            return None
+        etag = etag.strip('"')
+        return f"{etag}:{size}"
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lookup(self, etag: Optional[str], size: int) -> Optional[str]:
+        """ETag とサイズから保存済みのブロブを探します。見つかった場合はハッシュを返します。"""
+        key = self.index_key(etag, size)
+        digest = self.index.get(key) if key else None
+        if digest and os.path.exists(self.blob_path(digest)):
+            return digest
+        return None
+
+    def add(self, src_path: str, etag: Optional[str] = None) -> str:
+        """
+        ダウンロード済みのファイルをストアに移動し、ハッシュを返します。
+        同じ内容のブロブが既にある場合は src_path を削除します。
+        """
+        sha256 = hashlib.sha256()
+        with open(src_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        size = os.path.getsize(src_path)
+
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(src_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(src_path, blob_path)
+
+        key = self.index_key(etag, size)
+        if key:
+            self.index[key] = digest
+        return digest
+
+    def link(self, digest: str, dest_path: str) -> None:
+        """ブロブを dest_path から参照できるようにします。"""
+        blob_path = self.blob_path(digest)
+        if os.path.exists(dest_path):
+            return
+        try:
+            os.link(blob_path, dest_path)
+            return
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.relpath(blob_path, os.path.dirname(dest_path)), dest_path)
+            return
+        except OSError:
+            pass
+        shutil.copyfile(blob_path, dest_path)
@@ -15,17 +15,62 @@ CONFIG_PATH: str = os.path.join(BASE_DIR, 'config.yaml')
 default_config = {
     'discord': {
         'token': None,
-        'guild_id': 0
+        'guild_id': 0,
+        'guild_ids': []
     },
     'indexing': {
         'allowed_categories': []
     },
+    'fetching': {
+        'concurrency': 4,
+        'guild_workers': 0,
+        'batch_size': 100,
+        'max_batch_size': 1000,
+        'max_open_files': 64,
+        'dump_plan': False,
+        'backfill_slices': 1,
+        'backfill_min_days': 30,
+        'priority': True,
+        'priority_staleness_weight': 1.0,
+        'max_runtime': 0
+    },
+    'attachments': {
+        'workers': 4,
+        'max_bytes_per_run': 0,
+        'max_bytes_per_sec': 0,
+        'dedup': False
+    },
+    'client': {
+        'members_intent': False,
+        'chunk_guilds_at_startup': False,
+        'max_messages': 0
+    },
+    'export': {
+        'enabled': False,
+        'compression': 'zstd'
+    },
+    'reconcile': {
+        'enabled': False,
+        'window_days': 7
+    },
+    'daemon': {
+        'enabled': False,
+        'flush_interval': 30
+    },
+    'search': {
+        'enabled': False,
+        'tokenizer': 'trigram'
+    },
     'logging': {
         'name': "Simple-Discord-Indexer",
         'level': "INFO"
     },
     'paths': {
-        'data_dir': 'data'
+        'data_dir': 'data',
+        'export_dir': 'export',
+        'jsonl_format': 'plain',
+        'segment_by': 'month',
+        'segment_max_bytes': 64 * 1024 * 1024
     }
 }
 
@@ -55,16 +100,68 @@ logging.basicConfig(
 logger = logging.getLogger(LOGGER_NAME)
 
 DISCORD_TOKEN: Optional[str] = os.getenv('DISCORD_TOKEN') or config['discord'].get('token')
-GUILD_ID: int = int(config['discord'].get('guild_id', 0))
+# 取得対象のギルド（guild_ids が空の場合は guild_id のみ）
+# 環境変数 SDI_SHARD_GUILD_ID が設定されている場合はそのギルドのみを対象にする（複数ギルドの実行時に ShardedRunner がワーカープロセスへ設定する）
+GUILD_IDS: List[int] = [int(os.environ['SDI_SHARD_GUILD_ID'])] if os.getenv('SDI_SHARD_GUILD_ID') else [int(g) for g in (config['discord'].get('guild_ids') or [config['discord'].get('guild_id', 0)])]
+GUILD_ID: int = GUILD_IDS[0]
+# 複数ギルドを同時に取得するワーカープロセスの数（0 の場合はCPUコア数）
+GUILD_WORKERS: int = int(config['fetching'].get('guild_workers', 0))
 ALLOWED_CATEGORIES: List[str] = config['indexing'].get('allowed_categories', [])
+FETCH_CONCURRENCY: int = int(config['fetching'].get('concurrency', 4))
+BATCH_SIZE: int = int(config['fetching'].get('batch_size', 100))
+MAX_BATCH_SIZE: int = int(config['fetching'].get('max_batch_size', 1000))
+MAX_OPEN_FILES: int = int(config['fetching'].get('max_open_files', 64))
+DUMP_PLAN: bool = bool(config['fetching'].get('dump_plan', False))
+BACKFILL_SLICES: int = int(config['fetching'].get('backfill_slices', 1))
+BACKFILL_MIN_DAYS: int = int(config['fetching'].get('backfill_min_days', 30))
+# 新着メッセージの見込み数と前回の取得からの経過時間で取得対象を並べ替えるかどうか
+PRIORITY_ENABLED: bool = bool(config['fetching'].get('priority', True))
+# 前回の取得からの経過時間1時間あたりに加える優先度（新着メッセージ1件分を 1.0 とする）
+PRIORITY_STALENESS_WEIGHT: float = float(config['fetching'].get('priority_staleness_weight', 1.0))
+# 1回の実行で取得に使う時間の上限（秒、0 は無制限）。超過した対象は状態を保存して次回に持ち越す
+MAX_RUNTIME: float = float(config['fetching'].get('max_runtime', 0))
+ATTACHMENT_WORKERS: int = int(config['attachments'].get('workers', 4))
+ATTACHMENT_MAX_BYTES_PER_RUN: int = int(config['attachments'].get('max_bytes_per_run', 0))
+ATTACHMENT_MAX_BYTES_PER_SEC: int = int(config['attachments'].get('max_bytes_per_sec', 0))
+ATTACHMENT_DEDUP: bool = bool(config['attachments'].get('dedup', False))
+CLIENT_MEMBERS_INTENT: bool = bool(config['client'].get('members_intent', False))
+CLIENT_CHUNK_GUILDS_AT_STARTUP: bool = bool(config['client'].get('chunk_guilds_at_startup', False))
+# 0 の場合はメッセージキャッシュを無効にする (None)
+CLIENT_MAX_MESSAGES: Optional[int] = int(config['client'].get('max_messages') or 0) or None
+EXPORT_ENABLED: bool = bool(config['export'].get('enabled', False))
+EXPORT_COMPRESSION: str = config['export'].get('compression', 'zstd')
+RECONCILE_ENABLED: bool = bool(config['reconcile'].get('enabled', False))
+RECONCILE_WINDOW_DAYS: int = int(config['reconcile'].get('window_days', 7))
+DAEMON_ENABLED: bool = bool(config['daemon'].get('enabled', False))
+DAEMON_FLUSH_INTERVAL: float = float(config['daemon'].get('flush_interval', 30))
+SEARCH_ENABLED: bool = bool(config['search'].get('enabled', False))
+SEARCH_TOKENIZER: str = config['search'].get('tokenizer', 'trigram')
 
 # 必須環境変数の検証
 if not DISCORD_TOKEN:
     logger.critical("DISCORD_TOKEN が設定されていません。.env または config.yaml を確認してください。")
 
-DATA_DIR: str = os.path.join(BASE_DIR, config['paths'].get('data_dir', '../Cafe-Horizon-Discord-Vault'))
+# 環境変数 SDI_DATA_DIR が設定されている場合は config.yaml より優先する（ベンチマークや複数ギルドのワーカープロセス、ギルド単位の再生成で使用）
+# DATA_DIR などの一般的な名前は他のツールの .env と衝突するため、このプログラム専用の名前にしている
+DATA_DIR: str = os.path.join(BASE_DIR, os.getenv('SDI_DATA_DIR') or config['paths'].get('data_dir', '../Cafe-Horizon-Discord-Vault'))
 KNOWLEDGE_BASE_DIR: str = DATA_DIR
 STATE_FILE: str = os.path.join(DATA_DIR, 'fetch_state.json')
+JOURNAL_DIR: str = os.path.join(DATA_DIR, '.journal')
+PLAN_FILE: str = os.path.join(DATA_DIR, 'fetch_plan.json')
+FAILED_DOWNLOADS_FILE: str = os.path.join(DATA_DIR, 'failed_downloads.json')
+BLOB_DIR: str = os.path.join(DATA_DIR, '.blobs')
+SEARCH_DB_FILE: str = os.path.join(DATA_DIR, 'search.db')
+RENDER_MANIFEST_FILE: str = os.path.join(DATA_DIR, 'render_manifest.json')
+# 実行ごとの計測結果（node exporter の textfile collector と、ダッシュボード用のJSON）
+METRICS_TEXTFILE: str = os.path.join(DATA_DIR, 'metrics.prom')
+RUN_SUMMARY_FILE: str = os.path.join(DATA_DIR, 'run_summary.json')
+EXPORT_DIR: str = os.path.join(BASE_DIR, os.getenv('SDI_EXPORT_DIR') or config['paths'].get('export_dir', 'export'))
+# 'segmented' の場合、古い messages.jsonl の行を圧縮済みのセグメントへ移す
+JSONL_FORMAT: str = config['paths'].get('jsonl_format', 'plain')
+SEGMENT_BY: str = config['paths'].get('segment_by', 'month')
+SEGMENT_MAX_BYTES: int = int(config['paths'].get('segment_max_bytes', 64 * 1024 * 1024))
+# '_' で始まるファイルはデータセットの読み込み時に無視される
+EXPORT_MANIFEST_FILE: str = os.path.join(EXPORT_DIR, '_export_manifest.json')
 
 # ディレクトリが存在することを確認
 os.makedirs(KNOWLEDGE_BASE_DIR, exist_ok=True)
@@ -0,0 +1,230 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import discord
+from .config import GUILD_ID, LOGGER_NAME, DAEMON_FLUSH_INTERVAL
+from .fetch_logs import DiscordFetcher
+from .planner import FetchPlanner, FetchTarget
+from .reconcile import Reconciler, make_edit_patch, make_delete_patch
+from .storage import ChannelBuffer
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class DiscordDaemon(DiscordFetcher):
+    """
+    常駐モードのクライアント。
+    起動時に通常の取得（キャッチアップ）を行い、その後は接続を維持したまま
+    on_message / on_thread_create などのゲートウェイイベントから同じバッファへ書き込みます。
+    セッションを再開できずに再接続した場合（on_ready が再度呼ばれた場合）は、切断中のイベントが届かないため
+    キャッチアップをやり直します。キャッチアップ中に受信したイベントは保留し、完了後に受信順に処理します。
+    バッファは batch_size 件に達するか、flush_interval 秒ごとにフラッシュされます。
+    取得済みメッセージの編集/削除は on_raw_message_edit / on_raw_message_delete からパッチとして記録し、
+    終了時に messages.jsonl とMarkdownへ反映します。
+    """
+    def __init__(self, *args, flush_interval: float = DAEMON_FLUSH_INTERVAL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flush_interval: float = flush_interval
+        # 対象ID -> 常駐中に使用する書き込みバッファ
+        self.live_buffers: Dict[str, ChannelBuffer] = {}
+        # キャッチアップ中に受信したイベントの (処理, 引数)（完了後に受信順に再生する）
+        self.pending_events: List[Tuple[Callable[[Any], Awaitable[None]], Any]] = []
+        self.catchup_started: bool = False
+        self.catchup_done: bool = False
+        # 再接続が続いた場合に、キャッチアップを重ねて実行しないためのロック
+        self.catchup_lock: asyncio.Lock = asyncio.Lock()
+        # 受信したイベントによる書き込みを1件ずつ順に行うためのロック
+        self.write_lock: asyncio.Lock = asyncio.Lock()
+        # 終了処理中（以降に受信したイベントは破棄する）
+        self.closing: bool = False
+        self.flush_task: Optional[asyncio.Task] = None
+        self.planner: FetchPlanner = FetchPlanner(self.storage)
+
+    async def on_ready(self) -> None:
+        # セッションを再開できた場合は on_resumed が呼ばれ、切断中のイベントも届く。
+        # on_ready が再度呼ばれた場合は新しいセッションのため、切断中のメッセージを取得し直す
+        if self.catchup_started:
+            logger.info('ゲートウェイに再接続しました。切断中のメッセージを取得します。')
+        else:
+            self.catchup_started = True
+            self.metrics.mark("on_ready")
+            logger.info(f'{self.user} としてログインしました (ID: {self.user.id})')
+        await self.catch_up()
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+            logger.info(f'常駐モードでメッセージの受信を開始しました ({self.flush_interval} 秒ごとにフラッシュ)。')
+
+    async def catch_up(self) -> None:
+        """
+        通常の取得で前回の取得以降のメッセージを取得し、その間に保留したイベントを受信順に処理します。
+        取得と同じファイルへ並行して書き込まないよう、常駐用のバッファはフラッシュしてから破棄します（保留の処理で作り直す）。
+        """
+        async with self.catchup_lock:
+            self.catchup_done = False
+            async with self.write_lock:
+                self.flush_live_buffers()
+                for buffer in self.live_buffers.values():
+                    buffer.close()
+                self.live_buffers.clear()
+            try:
+                await self.fetch_all_logs()
+            except Exception as e:
+                logger.error(f"キャッチアップ中にエラーが発生しました: {e}", exc_info=True)
+
+            # キャッチアップが途中で失敗した場合でも添付ファイルのダウンロードを行えるようにする
+            self.downloader.start()
+            # 再生中に届いたイベントも保留に加え、受信順を保ったまま処理し終えてから受信を再開する
+            while self.pending_events:
+                handler, arg = self.pending_events.pop(0)
+                await handler(arg)
+            self.catchup_done = True
+
+    async def handle_event(self, handler: Callable[[Any], Awaitable[None]], arg: Any) -> None:
+        """受信したイベントを処理します。キャッチアップ中は完了後に処理するため保留し、終了処理中は破棄します。"""
+        if self.closing:
+            return
+        if not self.catchup_done:
+            self.pending_events.append((handler, arg))
+            return
+        await handler(arg)
+
+    async def on_message(self, message: discord.Message) -> None:
+        if not message.guild or message.guild.id != GUILD_ID:
+            return
+        await self.handle_event(self.ingest, message)
+
+    async def on_thread_create(self, thread: discord.Thread) -> None:
+        if thread.guild.id != GUILD_ID or not self.catchup_done or self.closing:
+            return
+        target = self.planner.target_for(thread)
+        if not target:
+            return
+        logger.info(f'  新しいスレッドを検出しました: {thread.name}')
+        # スレッドのメッセージイベントを確実に受信するため参加する
+        if thread.me is None:
+            try:
+                await thread.join()
+            except discord.HTTPException as e:
+                logger.warning(f'  スレッド {thread.name} への参加に失敗しました: {e}')
+        self.get_live_buffer(target)
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        await self.handle_event(self.record_edit, payload)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        await self.handle_event(self.record_delete, payload)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
+        await self.handle_event(self.record_bulk_delete, payload)
+
+    async def record_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        async with self.write_lock:
+            if self.closing:
+                return
+            buffer = self.get_archived_buffer(payload.guild_id, payload.message.channel, payload.message_id)
+            if buffer is None:
+                return
+            _date, _md, record = await buffer.render(payload.message)
+            if record:
+                buffer.append_patches([make_edit_patch(record)])
+
+    async def record_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        async with self.write_lock:
+            if self.closing:
+                return
+            buffer = self.get_archived_buffer(payload.guild_id, self.get_channel(payload.channel_id), payload.message_id)
+            if buffer:
+                buffer.append_patches([make_delete_patch(payload.message_id)])
+
+    async def record_bulk_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
+        async with self.write_lock:
+            if self.closing:
+                return
+            channel = self.get_channel(payload.channel_id)
+            for message_id in sorted(payload.message_ids):
+                buffer = self.get_archived_buffer(payload.guild_id, channel, message_id)
+                if buffer:
+                    buffer.append_patches([make_delete_patch(message_id)])
+
+    def get_archived_buffer(self, guild_id: Optional[int], channel: Optional[discord.abc.GuildChannel], message_id: int) -> Optional[ChannelBuffer]:
+        """
+        編集/削除されたメッセージが保存済みであれば、パッチの記録先となるバッファを返します。
+        未保存のメッセージは、通常の取得または受信の時点で最新の内容が保存されるため None を返します。
+        """
+        if guild_id != GUILD_ID or channel is None:
+            return None
+        target = self.planner.target_for(channel)
+        if not target:
+            return None
+        buffer = self.get_live_buffer(target)
+        # バッファ内に残っているメッセージは先に書き込み、パッチの適用対象にする
+        if buffer.pending_last_id and message_id <= buffer.pending_last_id:
+            try:
+                buffer.flush()
+            except OSError as e:
+                logger.error(f'    書き込みエラー {target.channel_name}/{target.file_name}: {e}')
+                return None
+        last_message_id = self.storage.get_last_message_id(target.key)
+        if last_message_id is None or message_id > last_message_id:
+            return None
+        return buffer
+
+    def get_live_buffer(self, target: FetchTarget) -> ChannelBuffer:
+        """対象の常駐用バッファを取得します（初回は保存先を用意して生成します）。"""
+        buffer = self.live_buffers.get(target.key)
+        if buffer is None:
+            buffer = self.prepare_target(target.messageable, target.key, target.category_path, target.channel_name, target.file_name, target.is_thread)
+            self.live_buffers[target.key] = buffer
+        return buffer
+
+    async def ingest(self, message: discord.Message) -> None:
+        """受信したメッセージを対応するバッファへ追加します。取得済みのメッセージは無視します。"""
+        target = self.planner.target_for(message.channel)
+        if not target:
+            return
+        async with self.write_lock:
+            if self.closing:
+                return
+            buffer = self.get_live_buffer(target)
+            last_message_id = buffer.pending_last_id or self.storage.get_last_message_id(target.key)
+            if last_message_id and message.id <= last_message_id:
+                return
+            try:
+                await buffer.add_message(message)
+            except OSError as e:
+                logger.error(f'    書き込みエラー {target.channel_name}/{target.file_name}: {e}')
+
+    def flush_live_buffers(self) -> None:
+        for key, buffer in self.live_buffers.items():
+            try:
+                buffer.flush()
+            except OSError as e:
+                logger.error(f'    書き込みエラー {key}: {e}')
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush_live_buffers()
+
+    async def close(self) -> None:
+        """
+        イベントの受信を止め、バッファを全てフラッシュして編集/削除を反映してから終了します。
+        ゲートウェイは切断まで接続したままのため、反映中の messages.jsonl やパッチファイルへ書き込まないよう、
+        処理中のイベントの完了を待ってから以降のイベントを破棄します（メッセージは次回の取得で取得されます）。
+        """
+        if not self.closing:
+            self.closing = True
+            if self.flush_task:
+                self.flush_task.cancel()
+                self.flush_task = None
+            async with self.write_lock:
+                self.flush_live_buffers()
+                self.storage.save_state()
+                for key, buffer in self.live_buffers.items():
+                    if not os.path.exists(buffer.patches_file):
+                        continue
+                    try:
+                        await Reconciler.compact_in_thread(buffer)
+                    except OSError as e:
+                        logger.error(f'    編集/削除の反映に失敗しました {key}: {e}')
+        await super().close()
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import random
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import aiohttp
+from .config import LOGGER_NAME, DATA_DIR, FAILED_DOWNLOADS_FILE
+from .blob_store import BlobStore
+from .metrics import RunMetrics, TargetMetrics
+
+logger = logging.getLogger(LOGGER_NAME)
+
+@dataclass
+class DownloadJob:
+    """1つの添付ファイルのダウンロード要求"""
+    url: str
+    path: str
+    filename: str = ""
+    size: int = 0
+    # URL を取得し直すための添付ファイルの所在（DiscordのCDNのURLは期限付きのため）
+    channel_id: Optional[int] = None
+    message_id: Optional[int] = None
+    attachment_id: Optional[int] = None
+    # 前回の実行から持ち越したジョブ（ダウンロード前にURLを取得し直す）
+    refresh_url: bool = False
+
+class AttachmentDownloader:
+    """
+    添付ファイルをキュー経由でダウンロードするワーカープール。
+    履歴のページングとは独立して動作するため、遅いファイルや失敗するファイルが
+    メッセージの取得を妨げることはありません。
+    1回の実行あたりの総バイト数と転送速度に上限を設定できます。
+    blob_store を指定した場合は内容のハッシュで重複を排除し、ETag とサイズが既知のファイルはダウンロードしません。
+    metrics を指定した場合は、保存先のパスから対象のチャンネル/スレッドを求めて件数・バイト数・所要時間・再試行回数を記録します。
+    失敗または上限により持ち越したファイルは、次回の実行で resolve_urls（(チャンネルID, メッセージID) から
+    添付ファイルID -> 現在のURL を返す関数）によりURLを取得し直してからダウンロードします。
+    """
+    def __init__(self, workers: int = 4, max_bytes_per_run: int = 0, max_bytes_per_sec: int = 0, failed_file: str = FAILED_DOWNLOADS_FILE, blob_store: Optional[BlobStore] = None,
+                 metrics: Optional[RunMetrics] = None, resolve_urls: Optional[Callable[[int, int], Awaitable[Dict[int, str]]]] = None):
+        self.workers_count: int = max(1, workers)
+        self.max_bytes_per_run: int = max_bytes_per_run
+        self.max_bytes_per_sec: int = max_bytes_per_sec
+        self.failed_file: str = failed_file
+        self.blob_store: Optional[BlobStore] = blob_store
+        self.metrics: Optional[RunMetrics] = metrics
+        self.resolve_urls: Optional[Callable[[int, int], Awaitable[Dict[int, str]]]] = resolve_urls
+        # メッセージID -> 取得し直した添付ファイルのURL（同じメッセージの添付ファイルで再度取得しない）
+        self.resolved_urls: Dict[int, Dict[int, str]] = {}
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers: List[asyncio.Task] = []
+        self.session: Optional[aiohttp.ClientSession] = None
+        # 重複してキューに追加しないためのパス集合
+        self.queued_paths: Set[str] = set()
+        # 保存先のパス -> ワーカーがダウンロード中のジョブ（終了時に打ち切った場合に持ち越すため）
+        self.active: Dict[str, DownloadJob] = {}
+        # 保存先のパス -> 失敗したダウンロード（同じファイルを重複して記録しない）
+        self.failed: Dict[str, Dict[str, Any]] = {}
+        self.scheduled_bytes: int = 0
+        self.downloaded_bytes: int = 0
+        self.downloaded_count: int = 0
+        # ブロブストアに既にあったためダウンロードを省略したファイル数
+        self.deduplicated_count: int = 0
+        self.started_at: float = 0.0
+
+    def start(self) -> None:
+        """ワーカーを起動し、前回失敗したダウンロードを再度キューに追加します。"""
+        if self.workers:
+            return
+        self.session = aiohttp.ClientSession()
+        self.started_at = time.monotonic()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+        self.retry_failed()
+
+    def enqueue(self, url: str, path: str, filename: str = "", size: int = 0, channel_id: Optional[int] = None, message_id: Optional[int] = None,
+                attachment_id: Optional[int] = None, refresh_url: bool = False) -> None:
+        """ダウンロード要求をキューに追加します。既に保存済みのファイルは無視します。"""
+        if path in self.queued_paths or os.path.exists(path):
+            return
+        job = DownloadJob(url=url, path=path, filename=filename, size=size or 0, channel_id=channel_id, message_id=message_id, attachment_id=attachment_id,
+                          refresh_url=refresh_url)
+        if self.max_bytes_per_run and self.scheduled_bytes + job.size > self.max_bytes_per_run:
+            # 上限を超える分は次回の実行に持ち越す（同じ実行内で再度要求されても記録は1件のみ）
+            self.queued_paths.add(path)
+            self._record_failure(job, "1回の実行あたりのダウンロード上限に達しました")
+            return
+        self.scheduled_bytes += job.size
+        self.queued_paths.add(path)
+        self.queue.put_nowait(job)
+
+    def retry_failed(self) -> None:
+        """前回の実行で失敗したダウンロードを読み込み、キューに追加します。"""
+        if not os.path.exists(self.failed_file):
+            return
+        try:
+            with open(self.failed_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"失敗したダウンロードの一覧 {self.failed_file} の読み込みに失敗しました: {e}")
+            return
+        for entry in entries:
+            # 所在を記録していない以前の形式の一覧は、記録されたURLのまま再試行する
+            self.enqueue(entry["url"], os.path.join(DATA_DIR, entry["path"]), entry.get("filename", ""), entry.get("size", 0),
+                         channel_id=entry.get("channel_id"), message_id=entry.get("message_id"), attachment_id=entry.get("attachment_id"),
+                         refresh_url=entry.get("message_id") is not None)
+        if entries:
+            logger.info(f"前回失敗した {len(entries)} 件の添付ファイルを再試行します。")
+
+    async def close(self, timeout: Optional[float] = None) -> None:
+        """
+        キュー内の全ダウンロードの完了を待機し、失敗した一覧を書き出します。
+        timeout 秒以内に終わらない場合は、ダウンロード中と未着手のファイルを失敗した一覧に加えて次回に持ち越します。
+        """
+        if not self.workers and not self.session:
+            return
+        if self.workers:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                self._defer_remaining("実行時間の上限に達しました")
+            for worker in self.workers:
+                worker.cancel()
+            await asyncio.gather(*self.workers, return_exceptions=True)
+            self.workers = []
+        if self.session:
+            await self.session.close()
+            self.session = None
+        if self.blob_store:
+            self.blob_store.save_index()
+        self.save_failed()
+        logger.info(f"添付ファイル: {self.downloaded_count} 件 ({self.downloaded_bytes / 1024 / 1024:.1f} MB) をダウンロードしました。重複により省略 {self.deduplicated_count} 件、失敗 {len(self.failed)} 件")
+
+    def save_failed(self) -> None:
+        """失敗したダウンロードの一覧を書き出します。失敗がなければファイルを削除します。"""
+        try:
+            if self.failed:
+                with open(self.failed_file, 'w', encoding='utf-8') as f:
+                    json.dump(list(self.failed.values()), f, indent=4, ensure_ascii=False)
+            elif os.path.exists(self.failed_file):
+                os.remove(self.failed_file)
+        except OSError as e:
+            logger.error(f"失敗したダウンロードの一覧の保存に失敗しました: {e}")
+
+    def _defer_remaining(self, reason: str) -> None:
+        """ダウンロード中と未着手のジョブを失敗した一覧に加えます（ワーカーの停止前に呼び出す）。"""
+        jobs = list(self.active.values())
+        while not self.queue.empty():
+            jobs.append(self.queue.get_nowait())
+            self.queue.task_done()
+        for job in jobs:
+            self._record_failure(job, reason)
+        if jobs:
+            logger.warning(f"{len(jobs)} 件の添付ファイルのダウンロードを次回に持ち越します: {reason}")
+
+    def _record_failure(self, job: DownloadJob, error: Any) -> None:
+        entry = asdict(job)
+        del entry["refresh_url"]
+        entry["path"] = os.path.relpath(job.path, DATA_DIR)
+        entry["error"] = str(error)
+        entry["failed_at"] = str(datetime.datetime.now())
+        self.failed[entry["path"]] = entry
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            started = time.monotonic()
+            self.active[job.path] = job
+            try:
+                if job.refresh_url and not await self._refresh_url(job):
+                    logger.info(f"    添付ファイル {job.filename} は元のメッセージから削除されたため、ダウンロードを取りやめます。")
+                    continue
+                await self._download_with_retry(job)
+                target = self._target_metrics(job)
+                if target:
+                    target.attachments += 1
+                    target.attachment_bytes += job.size
+                    target.attachment_seconds += time.monotonic() - started
+            except Exception as e:
+                logger.warning(f"    添付ファイルのダウンロードに失敗しました {job.filename}: {e}")
+                self._record_failure(job, e)
+            finally:
+                self.active.pop(job.path, None)
+                self.queue.task_done()
+
+    async def _download_with_retry(self, job: DownloadJob) -> None:
+        # 指数バックオフを用いたリトライ処理
+        max_retries = 3
+        base_delay = 1.0 # 秒
+
+        for attempt in range(max_retries):
+            try:
+                await self._download(job)
+                return
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    # ランダムな揺らぎ（Jitter）を追加
+                    delay = (base_delay * (2 ** attempt)) + (random.random() * 0.5)
+                    logger.warning(f"    添付ファイルのダウンロードに失敗 ({job.filename}): {e}。 {delay:.2f}秒後に再試行します... (試行 {attempt + 1}/{max_retries})")
+                    target = self._target_metrics(job)
+                    if target:
+                        target.retries += 1
+                    await asyncio.sleep(delay)
+                else:
+                    # 最後のリトライでも失敗した場合
+                    raise e
+
+    async def _refresh_url(self, job: DownloadJob) -> bool:
+        """
+        持ち越したジョブのURLを、元のメッセージを取得し直して現在のURLに置き換えます。
+        メッセージまたは添付ファイルが削除されている場合は False を返します。
+        """
+        if not self.resolve_urls:
+            return True
+        urls = self.resolved_urls.get(job.message_id)
+        if urls is None:
+            urls = self.resolved_urls[job.message_id] = await self.resolve_urls(job.channel_id, job.message_id)
+        url = urls.get(job.attachment_id)
+        if url is None:
+            return False
+        job.url = url
+        job.refresh_url = False
+        return True
+
+    def _target_metrics(self, job: DownloadJob) -> Optional[TargetMetrics]:
+        return self.metrics.target_for_path(job.path) if self.metrics else None
+
+    async def _download(self, job: DownloadJob) -> None:
+        if self.blob_store:
+            # ETag とサイズが既知であれば本体をダウンロードせずにリンクする
+            async with self.session.head(job.url) as response:
+                digest = self.blob_store.lookup(response.headers.get('ETag'), job.size) if response.ok else None
+            if digest:
+                await asyncio.to_thread(self.blob_store.link, digest, job.path)
+                self.deduplicated_count += 1
+                return
+
+        # 一時ファイルに書き込んでから置き換えることで、途中で中断されたファイルを残さない
+        tmp_path = job.path + ".part"
+        try:
+            async with self.session.get(job.url) as response:
+                response.raise_for_status()
+                etag = response.headers.get('ETag')
+                with open(tmp_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        f.write(chunk)
+                        self.downloaded_bytes += len(chunk)
+                        await self._throttle()
+            if self.blob_store:
+                # 大きなファイルのハッシュ計算やコピーでイベントループを止めないよう、別スレッドで行う
+                digest = await asyncio.to_thread(self.blob_store.add, tmp_path, etag)
+                await asyncio.to_thread(self.blob_store.link, digest, job.path)
+            else:
+                os.replace(tmp_path, job.path)
+            self.downloaded_count += 1
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def _throttle(self) -> None:
+        """転送速度が上限を超えている場合、上限に収まるまで待機します。"""
+        if not self.max_bytes_per_sec:
+            return
+        expected = self.downloaded_bytes / self.max_bytes_per_sec
+        elapsed = time.monotonic() - self.started_at
+        if expected > elapsed:
+            await asyncio.sleep(expected - elapsed)
@@ -0,0 +1,240 @@
+import os
+import json
+import hashlib
+import datetime
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from .config import LOGGER_NAME, DATA_DIR, EXPORT_DIR, EXPORT_MANIFEST_FILE, EXPORT_COMPRESSION
+from .segments import SegmentedJsonl, iter_segment_lines
+from .utils import atomic_write_json, read_channel_ids
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    # エクスポートを使用しない場合は pyarrow は不要
+    pa = None
+    pc = None
+    pq = None
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def export_schema() -> "pa.Schema":
+    """エクスポートするデータセットの列の型"""
+    timestamp = pa.timestamp('us', tz='UTC')
+    return pa.schema([
+        ("id", pa.int64()),
+        ("channel_id", pa.int64()),
+        ("thread_id", pa.int64()),
+        ("thread_name", pa.string()),
+        ("author_id", pa.int64()),
+        ("author_name", pa.string()),
+        ("author_display_name", pa.string()),
+        ("author_bot", pa.bool_()),
+        ("created_at", timestamp),
+        ("edited_at", timestamp),
+        ("deleted_at", timestamp),
+        ("content", pa.string()),
+        ("clean_content", pa.string()),
+        ("reply_to_message_id", pa.int64()),
+        ("attachments", pa.list_(pa.string())),
+        ("reactions", pa.list_(pa.struct([("emoji", pa.string()), ("count", pa.int32())]))),
+        ("reaction_count", pa.int32()),
+    ])
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromisoformat(value) if value else None
+
+def to_row(record: Dict[str, Any], channel_id: Optional[int], thread_id: Optional[int], thread_name: Optional[str]) -> Dict[str, Any]:
+    """messages.jsonl のレコードをエクスポート用の行に変換します。"""
+    author = record.get("author") or {}
+    reference = record.get("reference") or {}
+    reactions = record.get("reactions") or []
+    return {
+        "id": record["id"],
+        "channel_id": channel_id,
+        "thread_id": thread_id,
+        "thread_name": thread_name,
+        "author_id": author.get("id"),
+        "author_name": author.get("name"),
+        "author_display_name": author.get("display_name"),
+        "author_bot": author.get("bot"),
+        "created_at": parse_timestamp(record["created_at"]),
+        "edited_at": parse_timestamp(record.get("edited_at")),
+        "deleted_at": parse_timestamp(record.get("deleted_at")),
+        "content": record.get("content"),
+        "clean_content": record.get("clean_content"),
+        "reply_to_message_id": reference.get("message_id"),
+        "attachments": record.get("attachments") or [],
+        "reactions": reactions,
+        "reaction_count": sum(r.get("count", 0) for r in reactions),
+    }
+
+class ParquetExporter:
+    """
+    messages.jsonl を分析用の列指向データセット (Parquet) へエクスポートするクラス。
+    出力は category=/channel=/month= の Hive 形式で分割され、スレッドは親チャンネルのパーティションに含まれます。
+    各パーティションには messages.jsonl ごとに1つのファイルを置き、追記分は既存のファイルと結合して置き換えます
+    （実行のたびに小さなファイルが増えないようにするため）。
+
+    各 messages.jsonl について読み込み済みのバイト位置をマニフェストに記録し、次回はその続きのみを追記します。
+    編集/削除の反映やセグメントへの分割などでファイルが置き換えられた場合（inode の変化、サイズの縮小、
+    またはセグメントの追加）は、そのファイルから出力したデータを削除してセグメントを含めて最初からエクスポートし直します。
+    """
+    def __init__(self, data_dir: str = DATA_DIR, export_dir: str = EXPORT_DIR, manifest_file: str = EXPORT_MANIFEST_FILE,
+                 compression: str = EXPORT_COMPRESSION):
+        if pa is None:
+            raise RuntimeError("Parquet へのエクスポートには pyarrow が必要です (pip install pyarrow)")
+        self.data_dir: str = data_dir
+        self.export_dir: str = export_dir
+        self.manifest_file: str = manifest_file
+        self.compression: str = compression
+        self.schema = export_schema()
+
+    def load_manifest(self) -> Dict[str, Any]:
+        if not os.path.exists(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"マニフェスト {self.manifest_file} の読み込みに失敗したため、全てエクスポートし直します: {e}")
+            return {}
+
+    def run(self) -> int:
+        """エクスポートを実行し、追加した行数を返します。"""
+        os.makedirs(self.export_dir, exist_ok=True)
+        manifest = self.load_manifest()
+        total = 0
+        for root, _dirs, files in os.walk(self.data_dir):
+            if "messages.jsonl" not in files:
+                continue
+            source = os.path.relpath(os.path.join(root, "messages.jsonl"), self.data_dir)
+            try:
+                entry, count = self.export_source(source, manifest.get(source))
+            except (OSError, pa.ArrowException) as e:
+                logger.error(f"{source} のエクスポートに失敗しました: {e}")
+                continue
+            if manifest.get(source) == entry:
+                continue
+            manifest[source] = entry
+            total += count
+            # 途中で中断されても、書き出し済みのファイルまでは次回に引き継ぐ
+            atomic_write_json(self.manifest_file, manifest, indent=4)
+        return total
+
+    def partition_of(self, source: str) -> Tuple[str, str, Optional[str]]:
+        """(カテゴリ, チャンネル, スレッド名) を保存先のパスから求めます。"""
+        parts = os.path.dirname(source).split(os.sep)
+        category = parts[0] if parts else ""
+        channel = parts[1] if len(parts) > 1 else ""
+        thread_name = parts[2] if len(parts) > 2 else None
+        return category, channel, thread_name
+
+    def export_source(self, source: str, entry: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], int]:
+        """1つの messages.jsonl の未エクスポート分を書き出し、(新しいマニフェストのエントリ, 行数) を返します。"""
+        path = os.path.join(self.data_dir, source)
+        stat = os.stat(path)
+        # 出力ファイル名の接頭辞（同じチャンネルのパーティションに複数のスレッドが含まれるため）
+        prefix = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+        category, channel, thread_name = self.partition_of(source)
+        channel_export_dir = os.path.join(self.export_dir, f"category={category}", f"channel={channel}")
+
+        segmented = SegmentedJsonl(path)
+        last_segment_id = segmented.last_segment_id()
+
+        entry = entry or {}
+        offset = entry.get("offset", 0)
+        full = entry.get("inode") != stat.st_ino or stat.st_size < offset or entry.get("last_segment_id") != last_segment_id
+        if full:
+            if entry:
+                logger.info(f"  {source} が書き換えられたため、最初からエクスポートし直します。")
+            self.remove_outputs(channel_export_dir, prefix)
+            offset = 0
+        elif stat.st_size == offset:
+            return entry, 0
+
+        channel_id, thread_id = read_channel_ids(os.path.dirname(path))
+        rows_by_month: Dict[str, List[Dict[str, Any]]] = {}
+
+        def add_line(line: bytes, in_segment: bool = False) -> None:
+            try:
+                record = json.loads(line)
+                # セグメントへの移動が中断された場合に messages.jsonl に残る重複した行
+                if not in_segment and last_segment_id is not None and record["id"] <= last_segment_id:
+                    return
+                row = to_row(record, channel_id, thread_id, thread_name)
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                logger.warning(f"{source} の不正な行をスキップしました: {e}")
+                return
+            rows_by_month.setdefault(record["created_at"][:7], []).append(row)
+
+        if full:
+            for segment in segmented.segments():
+                for line in iter_segment_lines(segment):
+                    add_line(line, in_segment=True)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                # 書き込み途中の行は次回に回す
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                add_line(line)
+
+        count = 0
+        for month, rows in rows_by_month.items():
+            month_dir = os.path.join(channel_export_dir, f"month={month}")
+            os.makedirs(month_dir, exist_ok=True)
+            self.write_month(month_dir, prefix, rows)
+            count += len(rows)
+
+        return {"inode": stat.st_ino, "offset": offset, "last_segment_id": last_segment_id}, count
+
+    def write_month(self, month_dir: str, prefix: str, rows: List[Dict[str, Any]]) -> None:
+        """
+        月のパーティションにある messages.jsonl ごとのファイルへ行を追加します（既存の行と結合して置き換え）。
+        追加する行以降のIDを持つ既存の行は、マニフェストの保存前に中断された前回の出力のため除外します。
+        以前の形式（実行ごとに1ファイル）で出力したファイルも、このファイルにまとめて削除します。
+        """
+        out_name = f"{prefix}.parquet"
+        existing = sorted(name for name in os.listdir(month_dir) if self.is_output(name, prefix))
+        # まとめ済みのファイルを先に読み、置き換え後に削除できなかった以前の形式のファイルとの重複は先に読んだ行を残す
+        if out_name in existing:
+            existing.remove(out_name)
+            existing.insert(0, out_name)
+
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        if existing:
+            previous = pa.concat_tables([pq.ParquetFile(os.path.join(month_dir, name)).read().cast(self.schema) for name in existing])
+            previous = previous.filter(pc.less(previous["id"], pa.scalar(rows[0]["id"], pa.int64())))
+            seen = set()
+            keep = []
+            for message_id in previous["id"].to_pylist():
+                keep.append(message_id not in seen)
+                seen.add(message_id)
+            table = pa.concat_tables([previous.filter(pa.array(keep)), table]).sort_by("id")
+
+        # 一時ファイルは '.' で始めることで、書き込み途中のファイルがデータセットとして読まれないようにする
+        tmp_path = os.path.join(month_dir, f".{out_name}.tmp")
+        pq.write_table(table, tmp_path, compression=self.compression)
+        os.replace(tmp_path, os.path.join(month_dir, out_name))
+        for name in existing:
+            if name != out_name:
+                os.remove(os.path.join(month_dir, name))
+
+    @staticmethod
+    def is_output(name: str, prefix: str) -> bool:
+        """指定した messages.jsonl から出力したファイルかどうか（以前の形式の {prefix}-{最初のID}.parquet を含む）"""
+        return name == f"{prefix}.parquet" or (name.startswith(f"{prefix}-") and name.endswith(".parquet"))
+
+    @classmethod
+    def remove_outputs(cls, channel_export_dir: str, prefix: str) -> None:
+        """指定した messages.jsonl から出力したファイルを削除します。"""
+        if not os.path.isdir(channel_export_dir):
+            return
+        for root, _dirs, files in os.walk(channel_export_dir):
+            for name in files:
+                if cls.is_output(name, prefix):
+                    os.remove(os.path.join(root, name))
@@ -1,21 +1,69 @@
 import discord
 import os
+import time
+import asyncio
 import json
 import datetime
 import logging
-from .config import DISCORD_TOKEN, GUILD_ID, KNOWLEDGE_BASE_DIR, ALLOWED_CATEGORIES, LOGGER_NAME
-from .storage import StorageManager
-from .utils import sanitize, replace_fake_uppercase
+from typing import Any, Callable, Dict, Optional, Set
+from .config import (
+    DISCORD_TOKEN, GUILD_ID, GUILD_IDS, GUILD_WORKERS, KNOWLEDGE_BASE_DIR, LOGGER_NAME, FETCH_CONCURRENCY, BATCH_SIZE, DUMP_PLAN, PLAN_FILE,
+    ATTACHMENT_WORKERS, ATTACHMENT_MAX_BYTES_PER_RUN, ATTACHMENT_MAX_BYTES_PER_SEC, ATTACHMENT_DEDUP, SEARCH_ENABLED,
+    BACKFILL_SLICES, BACKFILL_MIN_DAYS, MAX_BATCH_SIZE, MAX_OPEN_FILES, RECONCILE_ENABLED, RECONCILE_WINDOW_DAYS,
+    CLIENT_MEMBERS_INTENT, CLIENT_CHUNK_GUILDS_AT_STARTUP, CLIENT_MAX_MESSAGES, EXPORT_ENABLED,
+    JSONL_FORMAT, SEGMENT_BY, SEGMENT_MAX_BYTES, METRICS_TEXTFILE, RUN_SUMMARY_FILE, PRIORITY_ENABLED, MAX_RUNTIME
+)
+from .storage import StorageManager, ChannelBuffer
+from .scheduler import FetchScheduler
+from .planner import FetchPlanner, FetchTarget
+from .downloader import AttachmentDownloader
+from .blob_store import BlobStore
+from .search_index import SearchIndex
+from .backfill import SlicedBackfill
+from .reconcile import Reconciler
+from .metrics import RunMetrics
+from .exporter import ParquetExporter
+from .utils import sanitize, read_channel_ids
 
 # ロガーの設定
 logger = logging.getLogger(LOGGER_NAME)
 
 class DiscordFetcher(discord.Client):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, reconcile: bool = RECONCILE_ENABLED, on_progress: Optional[Callable[[Dict[str, Any]], None]] = None, max_runtime: float = 0, **kwargs):
         super().__init__(*args, **kwargs)
-        self.storage = StorageManager()
+        # 起動から on_ready、最初の履歴取得までの時間とメモリ使用量を計測する
+        self.metrics = RunMetrics()
+        self.metrics.watch_rate_limits()
+        self.storage = StorageManager(batch_size=BATCH_SIZE, max_batch_size=MAX_BATCH_SIZE, max_open_files=MAX_OPEN_FILES)
+        self.downloader = AttachmentDownloader(
+            workers=ATTACHMENT_WORKERS,
+            max_bytes_per_run=ATTACHMENT_MAX_BYTES_PER_RUN,
+            max_bytes_per_sec=ATTACHMENT_MAX_BYTES_PER_SEC,
+            blob_store=BlobStore() if ATTACHMENT_DEDUP else None,
+            metrics=self.metrics,
+            resolve_urls=self.fetch_attachment_urls
+        )
+        # 全文検索インデックス（フラッシュごとに差分を追加）
+        self.search_index: Optional[SearchIndex] = SearchIndex() if SEARCH_ENABLED else None
+        if self.search_index:
+            self.storage.add_sink(self.search_index)
+        # 同一チャンネル/スレッドへの並行アクセスを防ぐためのロック
+        self.target_locks: Dict[str, asyncio.Lock] = {}
+        # 更新がないためAPIを呼ばずにスキップした対象の数
+        self.skipped_count: int = 0
+        # 取得中にエラーが発生した対象のID
+        self.failed_targets: Set[str] = set()
+        # 直近の期間の編集/削除を反映する（None の場合は行わない）
+        self.reconciler: Optional[Reconciler] = Reconciler(RECONCILE_WINDOW_DAYS) if reconcile else None
+        # 進捗の通知先（複数ギルドの実行時に、親プロセスへ進捗を送るために使用）
+        self.on_progress: Optional[Callable[[Dict[str, Any]], None]] = on_progress
+        # 取得を打ち切る時刻（time.monotonic()、None の場合は無制限）
+        self.deadline: Optional[float] = time.monotonic() + max_runtime if max_runtime > 0 else None
+        # 実行時間の上限に達したため、未取得または途中までの取得で次回に持ち越した対象のID
+        self.deferred_targets: Set[str] = set()
 
     async def on_ready(self) -> None:
+        self.metrics.mark("on_ready")
         logger.info(f'{self.user} としてログインしました (ID: {self.user.id})')
         try:
             await self.fetch_all_logs()
@@ -25,6 +73,24 @@ class DiscordFetcher(discord.Client):
             logger.info('プロセスを終了します。')
             await self.close()
 
+    async def close(self) -> None:
+        """
+        残りの添付ファイルのダウンロードを待機し、検索インデックスを閉じてから切断します。
+        実行時間の上限がある場合、上限までに終わらなかったダウンロードは次回に持ち越します。
+        """
+        await self.downloader.close(timeout=max(0.0, self.deadline - time.monotonic()) if self.deadline is not None else None)
+        # 途中で終了した場合も、書き込み済みのデータまでの状態を保存する
+        self.storage.save_state()
+        self.storage.handles.close_all()
+        if self.search_index:
+            self.search_index.close()
+            self.search_index = None
+        self.metrics.unwatch_rate_limits()
+        if not self.is_closed():
+            self.metrics.log_summary()
+            self.metrics.write(METRICS_TEXTFILE, RUN_SUMMARY_FILE)
+        await super().close()
+
     async def fetch_all_logs(self) -> None:
         guild = self.get_guild(GUILD_ID)
         if not guild:
@@ -33,84 +99,232 @@ class DiscordFetcher(discord.Client):
 
         logger.info(f'ギルドのログを取得中: {guild.name}')
         
-        updated = False
-        
-        # テキストチャンネルとフォーラムを取得
-        channels = [c for c in guild.channels if isinstance(c, (discord.TextChannel, discord.ForumChannel))]
-        
-        for channel in channels:
-            category_name = replace_fake_uppercase(channel.category.name if channel.category else "Uncategorized")
-            # カテゴリ名が許可リストにない、かつ（カテゴリなしの場合に空文字列が許可リストにない）場合はスキップ
-            if category_name not in ALLOWED_CATEGORIES and not (not channel.category and "" in ALLOWED_CATEGORIES):
-                continue
-            logger.info(f'チャンネルを処理中: {channel.name} (ID: {channel.id}) カテゴリ: {category_name}')
-            
-            # 1. チャンネル自体の処理（テキストチャンネルの場合）
-            if isinstance(channel, discord.TextChannel):
-                if await self.process_messageable(channel, category_path=category_name, channel_name=replace_fake_uppercase(channel.name), file_name="messages"):
-                    updated = True
+        self.skipped_count = 0
+        self.failed_targets.clear()
+        self.deferred_targets.clear()
 
-            # 2. アクティブなスレッドの処理
-            try:
-                if hasattr(channel, 'threads'):
-                    for thread in channel.threads:
-                        logger.info(f'  スレッドを処理中: {thread.name}')
-                        if await self.process_messageable(thread, category_path=category_name, channel_name=replace_fake_uppercase(channel.name), file_name=replace_fake_uppercase(thread.name), is_thread=True):
-                            updated = True
-            except Exception as e:
-                logger.error(f"  {channel.name} のスレッドへのアクセスエラー: {e}")
+        # 取得対象を先に全て列挙し、重複を除外した計画を作成する
+        planner = FetchPlanner(self.storage)
+        plan = await planner.plan(guild)
+        # 新着メッセージが多いと見込まれる対象から取得する（実行時間の上限がある場合に重要な対象を先に更新するため）
+        if PRIORITY_ENABLED:
+            planner.prioritize(plan)
+        self.metrics.mark("取得計画")
+        if DUMP_PLAN:
+            plan.dump(PLAN_FILE)
+        self.report_progress({"event": "planned", "targets": len(plan.targets)})
 
-            # 3. アーカイブされたスレッドの処理（フォーラムチャンネル固有）
-            if isinstance(channel, discord.ForumChannel):
-                logger.info(f"  フォーラムのアーカイブされたスレッドを取得中: {channel.name}")
-                try:
-                    async for thread in channel.archived_threads(limit=None):
-                        logger.info(f'  アーカイブされたスレッドを処理中: {thread.name}')
-                        if await self.process_messageable(thread, category_path=category_name, channel_name=replace_fake_uppercase(channel.name), file_name=replace_fake_uppercase(thread.name), is_thread=True):
-                            updated = True
-                except Exception as e:
-                    logger.error(f"  {channel.name} のアーカイブされたスレッドへのアクセスエラー: {e}")
-
-            # 4. アーカイブされたスレッドの処理（テキストチャンネルの場合）
-            if isinstance(channel, discord.TextChannel):
-                logger.info(f"  テキストチャンネルのアーカイブされたスレッドを取得中: {channel.name}")
-                try:
-                    async for thread in channel.archived_threads(limit=None):
-                        logger.info(f'  アーカイブされたスレッドを処理中: {thread.name}')
-                        if await self.process_messageable(thread, category_path=category_name, channel_name=replace_fake_uppercase(channel.name), file_name=replace_fake_uppercase(thread.name), is_thread=True):
-                            updated = True
-                except Exception as e:
-                    logger.error(f"  {channel.name} のアーカイブされたスレッドへのアクセスエラー: {e}")
-
-        # ギルドのアクティブなスレッドを処理（channel.threadsで見つからないスレッドのフォールバック）
-        logger.info('アクティブなスレッドを処理中 (ギルド全体チェック)...')
-        for thread in guild.threads:
-            if thread.parent_id and thread.guild.id == GUILD_ID:
-                 parent = guild.get_channel(thread.parent_id)
-                 if parent and isinstance(parent, (discord.TextChannel, discord.ForumChannel)):
-                    parent_category = replace_fake_uppercase(parent.category.name if parent.category else "Uncategorized")
-                    # 親カテゴリ名が許可リストにない、かつ（親カテゴリなしの場合に空文字列が許可リストにない）場合はスキップ
-                    if parent_category not in ALLOWED_CATEGORIES and not (not parent.category and "" in ALLOWED_CATEGORIES):
-                        continue
-                    logger.info(f'  スレッドを処理中: {thread.name} (親: {parent.name} カテゴリ: {parent_category})')
-                    if await self.process_messageable(thread, category_path=parent_category, channel_name=replace_fake_uppercase(parent.name), file_name=replace_fake_uppercase(thread.name), is_thread=True):
-                        updated = True
+        # 取得ジョブを並行実行する（添付ファイルは別のワーカープールでダウンロード）
+        self.downloader.start()
+        scheduler = FetchScheduler(concurrency=FETCH_CONCURRENCY)
+        scheduler.start()
+        for target in plan.targets:
+            scheduler.submit(self.process_target, target)
+        results = await scheduler.join()
+
+        if self.deferred_targets:
+            logger.warning(f'実行時間の上限に達したため、{len(self.deferred_targets)} 件のチャンネル/スレッドの取得を次回に持ち越します。')
+
+        # アーカイブ済みスレッドが全て取得できたチャンネルのみウォーターマークを進める
+        for watermark in plan.watermarks:
+            if any(key in self.failed_targets for key in watermark.thread_keys):
+                logger.warning(f'チャンネル ID {watermark.channel_key} のアーカイブ済みスレッドの取得に失敗したため、ウォーターマークを更新しません。')
+                continue
+            if any(key in self.deferred_targets for key in watermark.thread_keys):
+                logger.info(f'チャンネル ID {watermark.channel_key} のアーカイブ済みスレッドの取得を次回に持ち越すため、ウォーターマークを更新しません。')
+                continue
+            self.storage.update_archive_watermark(watermark.channel_key, watermark.archived_at)
 
         self.storage.save_state()
+
+        # 新着メッセージの取得後に、直近の期間の編集/削除を反映する（実行時間の上限に達した場合は次回に持ち越す）
+        if self.reconciler and not self.past_deadline():
+            scheduler = FetchScheduler(concurrency=FETCH_CONCURRENCY)
+            scheduler.start()
+            for target in plan.targets:
+                if self.reconciler.is_applicable(target.messageable):
+                    scheduler.submit(self.reconcile_target, target)
+            results += await scheduler.join()
+
+        # 取得のたびに分析用のデータセットへ差分をエクスポートする
+        if EXPORT_ENABLED and any(results):
+            try:
+                exported = await asyncio.to_thread(ParquetExporter().run)
+                logger.info(f'{exported} 件のメッセージを Parquet へエクスポートしました。')
+            except Exception as e:
+                logger.error(f'Parquet へのエクスポートに失敗しました: {e}')
         
-        if updated:
+        if self.skipped_count:
+            logger.info(f'{self.skipped_count} 件のチャンネル/スレッドは新着メッセージがないためスキップしました。')
+        
+        if any(results):
             logger.info('ログが更新されました。')
         
+        self.report_progress({"event": "finished"})
         logger.info('完了。')
 
+    async def process_target(self, target: FetchTarget) -> bool:
+        """計画された取得対象を処理します。実行時間の上限を過ぎている場合は取得せずに次回に持ち越します。"""
+        if self.past_deadline():
+            self.deferred_targets.add(target.key)
+            return False
+        try:
+            return await self.process_messageable(target.messageable, category_path=target.category_path, channel_name=target.channel_name, file_name=target.file_name, is_thread=target.is_thread)
+        finally:
+            target_metrics = self.metrics.targets.get(target.key)
+            self.report_progress({"event": "target_done", "messages": target_metrics.messages if target_metrics else 0})
+
+    async def fetch_attachment_urls(self, channel_id: int, message_id: int) -> Dict[int, str]:
+        """
+        メッセージを取得し直し、添付ファイルID -> 現在のURL を返します（前回の実行から持ち越した添付ファイルのダウンロード用）。
+        チャンネル/スレッドまたはメッセージが削除されている場合は空の辞書を返します。
+        """
+        try:
+            channel = self.get_channel(channel_id) or await self.fetch_channel(channel_id)
+            message = await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return {}
+        return {attachment.id: attachment.url for attachment in message.attachments}
+
+    def past_deadline(self) -> bool:
+        """実行時間の上限を過ぎているかどうか"""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def report_progress(self, event: Dict[str, Any]) -> None:
+        """進捗を通知します。通知に失敗しても取得は続行します。"""
+        if not self.on_progress:
+            return
+        try:
+            self.on_progress(event)
+        except Exception as e:
+            logger.debug(f"進捗の通知に失敗しました: {e}")
+
     async def process_messageable(self, messageable: discord.abc.Messageable, category_path: str, channel_name: str, file_name: str="MainChat", is_thread: bool=False) -> bool:
         """
         メッセージを取得し、保存処理をStorageManagerに委譲します。
+        同じチャンネル/スレッドのジョブが重複した場合は、先行するジョブの完了を待ってから実行します。
         """
         # 状態追跡用の一意ID
         state_key = str(messageable.id)
+        lock = self.target_locks.setdefault(state_key, asyncio.Lock())
+        async with lock:
+            return await self._process_messageable(messageable, state_key, category_path, channel_name, file_name, is_thread)
+
+    async def _process_messageable(self, messageable: discord.abc.Messageable, state_key: str, category_path: str, channel_name: str, file_name: str, is_thread: bool) -> bool:
         last_message_id = self.storage.get_last_message_id(state_key)
         
+        # ゲートウェイキャッシュ上の最終メッセージIDが取得済みであれば、HTTPリクエストを行わずにスキップ
+        if self.is_unchanged(messageable, last_message_id):
+            logger.debug(f'    {channel_name}/{file_name}: 新着メッセージがないためスキップします。')
+            self.skipped_count += 1
+            self.metrics.skipped_targets += 1
+            self.storage.record_activity(state_key, 0, discord.utils.snowflake_time(messageable.id))
+            return False
+        
+        buffer = self.prepare_target(messageable, state_key, category_path, channel_name, file_name, is_thread)
+        self.metrics.mark("最初の履歴取得")
+        target_metrics = buffer.metrics
+        started = time.monotonic()
+
+        new_messages_count = 0
+        updated = False
+        
+        try:
+            # 初回取得の大きなチャンネルは期間を分割して並行取得し、その後に取得中に届いた新着分を通常どおり取得する
+            if SlicedBackfill.is_applicable(messageable, last_message_id, BACKFILL_SLICES, BACKFILL_MIN_DAYS):
+                spool_dir = os.path.join(os.path.dirname(buffer.jsonl_file), ".backfill")
+                backfill = SlicedBackfill(messageable, buffer, BACKFILL_SLICES, spool_dir, label=f"{channel_name}/{file_name}", deadline=self.deadline)
+                new_messages_count += await backfill.run()
+                last_message_id = buffer.pending_last_id or last_message_id
+                # 書き込み済みの期間までの状態を保存し、残りは次回の通常の取得に持ち越す
+                if backfill.interrupted:
+                    logger.info(f'    {channel_name}/{file_name}: 実行時間の上限に達したため、分割取得を中断します。')
+                    self.deferred_targets.add(state_key)
+
+            if state_key not in self.deferred_targets:
+                history = messageable.history(limit=None, after=discord.Object(id=last_message_id) if last_message_id else None, oldest_first=True)
+                async for message in target_metrics.timed(history):
+                    
+                    await buffer.add_message(message)
+                    
+                    new_messages_count += 1
+
+                    if new_messages_count % 100 == 0:
+                         logger.info(f"    ... {channel_name}/{file_name}: これまでに {new_messages_count} 件のメッセージを処理しました")
+
+                    # 実行時間の上限に達した場合は、書き込み済みの位置までの状態を保存して残りを次回に持ち越す
+                    if self.past_deadline():
+                        logger.info(f'    {channel_name}/{file_name}: 実行時間の上限に達したため、取得を中断します。')
+                        self.deferred_targets.add(state_key)
+                        break
+            
+            if new_messages_count > 0:
+                logger.info(f'    {channel_name}/{file_name}: {new_messages_count} 件の新しいメッセージを取得しました。')
+                updated = True
+
+        except discord.Forbidden:
+             logger.warning(f'    アクセス拒否: {channel_name}/{file_name}')
+        except Exception as e:
+             logger.error(f'    取得エラー {channel_name}/{file_name}: {e}', exc_info=True)
+             self.failed_targets.add(state_key)
+        finally:
+            # 残りのバッファを書き込み（エラー時も実行）
+            try:
+                buffer.flush()
+            except OSError as e:
+                logger.error(f'    書き込みエラー {channel_name}/{file_name}: {e}')
+                self.failed_targets.add(state_key)
+                updated = False
+            # 対象ごとに書き込んだファイルを確定する（状態の保存は一定の間隔でまとめて行い、最後に fetch_all_logs で保存する）
+            self.storage.end_target(state_key)
+            # 古い行を圧縮済みのセグメントへ移す（書き込みに失敗した場合は次回に持ち越す）
+            if JSONL_FORMAT == "segmented" and state_key not in self.failed_targets:
+                try:
+                    await buffer.roll_segments(RECONCILE_WINDOW_DAYS, by=SEGMENT_BY, max_bytes=SEGMENT_MAX_BYTES)
+                except (OSError, RuntimeError) as e:
+                    logger.error(f'    セグメントへの分割に失敗しました {channel_name}/{file_name}: {e}')
+            buffer.close()
+            target_metrics.messages += new_messages_count
+            target_metrics.fetch_seconds += time.monotonic() - started
+            # 失敗した対象や実行時間の上限で打ち切った対象は、件数が前回からの増加を表さないため記録しない
+            if state_key not in self.failed_targets and state_key not in self.deferred_targets:
+                self.storage.record_activity(state_key, new_messages_count, discord.utils.snowflake_time(messageable.id))
+             
+        return updated
+
+    async def reconcile_target(self, target: FetchTarget) -> bool:
+        """
+        取得済みの対象について直近の期間を再取得し、編集/削除をパッチとして記録してから反映します。
+        """
+        lock = self.target_locks.setdefault(target.key, asyncio.Lock())
+        async with lock:
+            last_message_id = self.storage.get_last_message_id(target.key)
+            if last_message_id is None:
+                return False
+            buffer = self.prepare_target(target.messageable, target.key, target.category_path, target.channel_name, target.file_name, target.is_thread)
+            label = f"{target.channel_name}/{target.file_name}"
+            try:
+                edited, deleted = await self.reconciler.reconcile(buffer, target.messageable, last_message_id)
+            except discord.Forbidden:
+                logger.warning(f'    アクセス拒否: {label}')
+                return False
+            except Exception as e:
+                logger.error(f'    編集/削除の確認中にエラーが発生しました {label}: {e}', exc_info=True)
+                return False
+
+            try:
+                applied = await Reconciler.compact_in_thread(buffer)
+            except OSError as e:
+                logger.error(f'    編集/削除の反映に失敗しました {label}: {e}')
+                return False
+            if edited or deleted:
+                logger.info(f'    {label}: 編集 {edited} 件、削除 {deleted} 件を検出しました。')
+            return applied > 0
+
+    def prepare_target(self, messageable: discord.abc.Messageable, state_key: str, category_path: str, channel_name: str, file_name: str, is_thread: bool) -> ChannelBuffer:
+        """
+        保存先のディレクトリとメタデータを用意し、書き込みバッファを生成します。
+        """
         safe_category = sanitize(category_path)
         safe_channel = sanitize(channel_name)
         safe_filename = sanitize(file_name)
@@ -122,6 +336,7 @@ class DiscordFetcher(discord.Client):
             channel_dir = os.path.join(base_dir, safe_filename)
         else:
             channel_dir = base_dir
+        channel_dir = self.claim_dir(channel_dir, messageable.id, is_thread)
 
         messages_dir = os.path.join(channel_dir, "messages")
         jsonl_file = os.path.join(channel_dir, "messages.jsonl")
@@ -132,6 +347,14 @@ class DiscordFetcher(discord.Client):
         os.makedirs(messages_dir, exist_ok=True)
         os.makedirs(attachments_dir, exist_ok=True)
         
+        # 対象ごとに独立した書き込みバッファを使用する
+        buffer = self.storage.create_buffer(
+            state_key, attachments_dir, messages_dir, jsonl_file, downloader=self.downloader,
+            channel_id=messageable.parent_id if is_thread else messageable.id,
+            thread_id=messageable.id if is_thread else None,
+            metrics=self.metrics.target(state_key, f"{channel_name}/{file_name}" if is_thread else channel_name, attachments_dir)
+        )
+        
         # --- メタデータの保存 ---
         if not os.path.exists(meta_file):
             metadata = {
@@ -142,52 +365,79 @@ class DiscordFetcher(discord.Client):
                 "topic": getattr(messageable, 'topic', None),
                 "category": category_path,
                 "parent_channel": channel_name if is_thread else None,
+                "parent_id": messageable.parent_id if is_thread else None,
                 "is_thread": is_thread,
                 "fetched_at": str(datetime.datetime.now())
             }
             with open(meta_file, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, indent=4, ensure_ascii=False)
 
-        new_messages_count = 0
-        
-        try:
-            async for message in messageable.history(limit=None, after=discord.Object(id=last_message_id) if last_message_id else None, oldest_first=True):
-                
-                await self.storage.add_message(message, attachments_dir, messages_dir, jsonl_file)
-                
-                new_messages_count += 1
-                self.storage.update_last_message_id(state_key, message.id)
-
-                if new_messages_count % 100 == 0:
-                     logger.info(f"    ... これまでに {new_messages_count} 件のメッセージを処理しました")
-            
-            if new_messages_count > 0:
-                logger.info(f'    {new_messages_count} 件の新しいメッセージを取得しました。')
-                return True
+        return buffer
 
-        except discord.Forbidden:
-             logger.warning(f'    アクセス拒否: {channel_name}/{file_name}')
-        except Exception as e:
-             logger.error(f'    取得エラー {channel_name}/{file_name}: {e}', exc_info=True)
-        finally:
-            # 残りのバッファを書き込み（エラー時も実行）
-            self.storage.flush(messages_dir, jsonl_file)
-             
-        return False
+    @staticmethod
+    def claim_dir(channel_dir: str, target_id: int, is_thread: bool) -> str:
+        """
+        保存先が同じ名前の別のチャンネル/スレッドで使用されている場合は、IDを付けた保存先を返します。
+        名前が同じ対象で messages.jsonl を共有すると、ID順の索引や編集/削除の確認が他の対象のメッセージを含んでしまうため。
+        保存先の所有者は channel_info.json で判定します（prepare_target の中で待機せずに書き込むため、並行するジョブと競合しません）。
+        """
+        channel_id, thread_id = read_channel_ids(channel_dir)
+        owner_id = thread_id if is_thread else channel_id
+        if owner_id is None or owner_id == target_id:
+            return channel_dir
+        return f"{channel_dir}_{target_id}"
 
-def run_fetcher():
-    if not DISCORD_TOKEN:
-        logger.critical("エラー: .env に DISCORD_TOKEN が見つかりません")
-        exit(1)
+    @staticmethod
+    def is_unchanged(messageable: discord.abc.Messageable, last_message_id: Optional[int]) -> bool:
+        """
+        チャンネル/スレッドオブジェクトが保持する last_message_id と取得済みの状態を比較し、
+        新着メッセージがないと判断できる場合に True を返します。
+        どちらかが不明な場合は判断できないため False を返します。
+        """
+        cached_last_id = getattr(messageable, 'last_message_id', None)
+        if last_message_id is None or cached_last_id is None:
+            return False
+        return int(cached_last_id) <= int(last_message_id)
 
+def create_client_options() -> dict:
+    """
+    アーカイブ用に調整したクライアントの設定を返します。
+    メンバー一覧の取得（チャンキング）とメッセージキャッシュを無効にし、起動時間とメモリ使用量を抑えます。
+    著者の情報はメッセージのペイロードに含まれるため、メンバーのキャッシュがなくても保存できます。
+    """
     intents = discord.Intents.default()
     intents.message_content = True
     intents.guilds = True 
-    intents.members = True 
-    
-    client = DiscordFetcher(intents=intents)
+    intents.members = CLIENT_MEMBERS_INTENT
+    return {
+        "intents": intents,
+        "chunk_guilds_at_startup": CLIENT_CHUNK_GUILDS_AT_STARTUP,
+        "max_messages": CLIENT_MAX_MESSAGES,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents) if CLIENT_MEMBERS_INTENT else discord.MemberCacheFlags.none(),
+    }
+
+def run_fetcher(daemon: bool = False, reconcile: bool = RECONCILE_ENABLED, on_progress: Optional[Callable[[Dict[str, Any]], None]] = None, max_runtime: float = MAX_RUNTIME):
+    if not DISCORD_TOKEN:
+        logger.critical("エラー: .env に DISCORD_TOKEN が見つかりません")
+        exit(1)
+
+    # 複数のギルドはギルドごとのワーカープロセスで取得する
+    if len(GUILD_IDS) > 1:
+        from .shard import ShardedRunner
+        ShardedRunner(GUILD_IDS, workers=GUILD_WORKERS, daemon=daemon, reconcile=reconcile, max_runtime=max_runtime).run()
+        return
+
+    options = create_client_options()
+    if daemon:
+        # 常駐モードでは持ち越した対象の新着を受信すると取得の抜けが生じるため、実行時間の上限は使用しない
+        if max_runtime:
+            logger.warning("常駐モードでは実行時間の上限 (max_runtime) は無視されます。")
+        # 循環インポートを避けるため、常駐モードのクライアントはここで読み込む
+        from .daemon import DiscordDaemon
+        client = DiscordDaemon(reconcile=reconcile, on_progress=on_progress, **options)
+    else:
+        client = DiscordFetcher(reconcile=reconcile, on_progress=on_progress, max_runtime=max_runtime, **options)
     client.run(DISCORD_TOKEN)
 
 if __name__ == '__main__':
     run_fetcher()
-
@@ -1,89 +1,162 @@
 import logging
 import os
-import asyncio
-import random
+import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import discord
 from .utils import sanitize
 from .config import LOGGER_NAME
+from .downloader import AttachmentDownloader
 
 logger = logging.getLogger(LOGGER_NAME)
 
+# 返信先の抜粋として表示する最大文字数
+REPLY_EXCERPT_LENGTH = 60
+
 class MessageFormatter:
     """
     DiscordのメッセージオブジェクトをMarkdown形式などに変換するクラス
     """
 
     @staticmethod
-    async def to_markdown(message: discord.Message, attachments_dir: str) -> tuple[str, list[str]]:
+    async def to_markdown(message: discord.Message, attachments_dir: str, downloader: Optional[AttachmentDownloader] = None,
+                          lookup: Optional[Callable[[int], Optional[Dict[str, Any]]]] = None) -> tuple[str, list[str]]:
         """
         メッセージをMarkdown文字列に変換します。
-        添付ファイルがあればダウンロード処理も行い、保存したファイル名のリストを返します。
+        添付ファイルがあればダウンロードをキューに追加し、保存先のファイル名のリストを返します。
+        downloader が None の場合はダウンロードを行わず、リンクのみを生成します。
+        lookup には保存済みのメッセージをIDから引く関数を指定し、返信先の抜粋の表示に使用します。
         """
-        msg_content = ""
         attachment_filenames = []
+        attachment_links = []
+
+        # 添付ファイル
+        # attachments_dir は物理的な保存先パスを受け取る
+        for attachment in message.attachments:
+            safe_att_name = sanitize(attachment.filename)
+            filename = f"{message.id}_{safe_att_name}"
+            filepath = os.path.join(attachments_dir, filename)
+            
+            # ダウンロードはワーカープールに任せ、確定している保存先パスでリンクを生成する
+            if downloader:
+                downloader.enqueue(attachment.url, filepath, attachment.filename, attachment.size,
+                                   channel_id=message.channel.id, message_id=message.id, attachment_id=attachment.id)
+            
+            attachment_filenames.append(filename)
+            attachment_links.append((attachment.filename, filename))
+
+        reply_to = message.reference.message_id if message.reference else None
+        msg_content = MessageFormatter.format_markdown(
+            author_name=message.author.display_name,
+            created_at=message.created_at,
+            reply_to=reply_to,
+            replied=lookup(reply_to) if lookup and reply_to else None,
+            content=message.clean_content,
+            embeds=[e.to_dict() for e in message.embeds],
+            attachment_links=attachment_links,
+        )
+        return msg_content, attachment_filenames
+
+    @staticmethod
+    def record_to_markdown(record: Dict[str, Any], lookup: Optional[Callable[[int], Optional[Dict[str, Any]]]] = None) -> str:
+        """
+        messages.jsonl のレコードからMarkdown文字列を再生成します（編集/削除の反映時に使用）。
+        元のファイル名はレコードに含まれないため、添付ファイルのリンク名には保存先のファイル名を使用します。
+        """
+        attachment_links = []
+        for rel_path in record.get("attachments", []):
+            filename = os.path.basename(rel_path)
+            attachment_links.append((filename.split("_", 1)[-1], filename))
+
+        reply_to = record["reference"]["message_id"] if record.get("reference") else None
+        return MessageFormatter.format_markdown(
+            author_name=record["author"]["display_name"],
+            created_at=datetime.datetime.fromisoformat(record["created_at"]),
+            reply_to=reply_to,
+            replied=lookup(reply_to) if lookup and reply_to else None,
+            content=record.get("clean_content"),
+            embeds=record.get("embeds", []),
+            attachment_links=attachment_links,
+            deleted=bool(record.get("deleted_at")),
+        )
+
+    @staticmethod
+    def format_markdown(author_name: str, created_at: datetime.datetime, reply_to: Optional[int], content: Optional[str],
+                        embeds: List[Dict[str, Any]], attachment_links: List[Tuple[str, str]], deleted: bool = False,
+                        replied: Optional[Dict[str, Any]] = None) -> str:
+        """
+        メッセージの各要素からMarkdown文字列を組み立てます。
+        attachment_links は (表示名, 保存先のファイル名) のリストです。
+        replied は返信先のメッセージのレコードで、見つからない場合はIDのみを表示します。
+        """
+        # 文字列の連結を繰り返さず、断片をリストに集めて最後に結合する
+        parts = []
 
         # 著者ヘッダー
-        author_name = message.author.display_name
-        time_str = message.created_at.strftime('%H:%M')
-        msg_content += f"### {author_name} ({time_str})\n"
+        time_str = created_at.strftime('%H:%M')
+        parts.append(f"### {author_name} ({time_str})\n")
+
+        # 削除されたメッセージ（内容はアーカイブとして残す）
+        if deleted:
+            parts.append("> (Deleted)\n\n")
 
         # 返信コンテキスト
-        if message.reference:
-                msg_content += f"> (Reply to message {message.reference.message_id})\n\n"
+        if replied:
+            parts.append(MessageFormatter.reply_line(replied))
+        elif reply_to:
+            parts.append(f"> (Reply to message {reply_to})\n\n")
 
         # コンテンツ
-        content = message.clean_content
         if content:
-            msg_content += f"{content}\n\n"
+            parts.append(f"{content}\n\n")
 
         # 埋め込み (Embeds)
-        for embed in message.embeds:
-            if embed.title: msg_content += f"**Embed: {embed.title}**\n"
-            if embed.description: msg_content += f"> {embed.description}\n"
-            if embed.url: msg_content += f"[Link]({embed.url})\n"
-            msg_content += "\n"
+        for embed in embeds:
+            if embed.get("title"): parts.append(f"**Embed: {embed['title']}**\n")
+            if embed.get("description"): parts.append(f"> {embed['description']}\n")
+            if embed.get("url"): parts.append(f"[Link]({embed['url']})\n")
+            parts.append("\n")
 
         # 添付ファイル
-        if message.attachments:
-            # attachments_dir は物理的な保存先パスを受け取る
-            
-            for attachment in message.attachments:
-                try:
-                    safe_att_name = sanitize(attachment.filename)
-                    filename = f"{message.id}_{safe_att_name}"
-                    filepath = os.path.join(attachments_dir, filename)
-                    
-                    if not os.path.exists(filepath):
-                        # 指数バックオフを用いたリトライ処理
-                        max_retries = 3
-                        base_delay = 1.0 # 秒
-                        
-                        for attempt in range(max_retries):
-                            try:
-                                await attachment.save(filepath)
-                                break # 成功したらループを抜ける
-                            except Exception as e:
-                                if attempt < max_retries - 1:
-                                    # ランダムな揺らぎ（Jitter）を追加
-                                    delay = (base_delay * (2 ** attempt)) + (random.random() * 0.5)
-                                    logger.warning(f"    添付ファイルのダウンロードに失敗 ({attachment.filename}): {e}。 {delay:.2f}秒後に再試行します... (試行 {attempt + 1}/{max_retries})")
-                                    await asyncio.sleep(delay)
-                                else:
-                                    # 最後のリトライでも失敗した場合
-                                    raise e
-                    
-                    attachment_filenames.append(filename)
-                    
-                    # Markdownリンク（標準化された相対パス）
-                    # ../attachments/{filename} という構造は固定とする
-                    rel_path = f"../attachments/{filename}"
-                    ext = os.path.splitext(filename)[1].lower()
-                    if ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
-                        msg_content += f"![{attachment.filename}]({rel_path})\n"
-                    else:
-                        msg_content += f"[{attachment.filename}]({rel_path})\n"
-                except Exception as e:
-                    logger.warning(f"    添付ファイルのダウンロードに失敗しました {attachment.filename}: {e}")
+        for display_name, filename in attachment_links:
+            # Markdownリンク（標準化された相対パス）
+            # ../attachments/{filename} という構造は固定とする
+            rel_path = f"../attachments/{filename}"
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
+                parts.append(f"![{display_name}]({rel_path})\n")
+            else:
+                parts.append(f"[{display_name}]({rel_path})\n")
         
-        msg_content += "\n" # メッセージ間のスペース
-        return msg_content, attachment_filenames
+        parts.append("\n") # メッセージ間のスペース
+        return "".join(parts)
+
+    @staticmethod
+    def resolve_reply(formatted_msg: str, record: Optional[Dict[str, Any]], lookup: Callable[[int], Optional[Dict[str, Any]]]) -> str:
+        """
+        変換時に返信先が見つからずIDのみを表示したMarkdownについて、返信先を引き直して抜粋に置き換えます。
+        分割取得で、返信先より先に返信が変換された場合に使用します。
+        """
+        reference = record.get("reference") if record else None
+        if not reference or not reference.get("message_id"):
+            return formatted_msg
+        fallback = f"> (Reply to message {reference['message_id']})\n\n"
+        if fallback not in formatted_msg:
+            return formatted_msg
+        replied = lookup(reference["message_id"])
+        if not replied:
+            return formatted_msg
+        return formatted_msg.replace(fallback, MessageFormatter.reply_line(replied), 1)
+
+    @staticmethod
+    def reply_line(replied: Dict[str, Any]) -> str:
+        """返信先のメッセージの著者と本文の抜粋を表示する行"""
+        return f"> (Reply to {replied['author']['display_name']}: {MessageFormatter.excerpt(replied.get('clean_content'))})\n\n"
+
+    @staticmethod
+    def excerpt(content: Optional[str], limit: int = REPLY_EXCERPT_LENGTH) -> str:
+        """返信先の本文の1行目を、指定した文字数までに切り詰めて返します。"""
+        lines = (content or "").strip().splitlines()
+        first_line = lines[0] if lines else ""
+        if len(first_line) > limit or len(lines) > 1:
+            return first_line[:limit] + "…"
+        return first_line
@@ -0,0 +1,118 @@
+import os
+import json
+import mmap
+import struct
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from .config import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# messages.jsonl → messages.idx
+INDEX_SUFFIX = ".idx"
+# 1件あたり (メッセージID, messages.jsonl 内のバイト位置) の16バイト（リトルエンディアンの符号なし64bit整数 x 2）
+ENTRY = struct.Struct("<QQ")
+
+class MessageIndex:
+    """
+    messages.jsonl の横に置く、メッセージIDから行の位置を引くための固定長バイナリの索引。
+    messages.jsonl はID順に追記されるため、索引もフラッシュごとに末尾へ追記するだけでID順に並びます。
+    検索は mmap 上の二分探索で行い、JSONL 全体を読み込まずに1件のメッセージを取得できます。
+    """
+    def __init__(self, jsonl_file: str):
+        self.jsonl_file: str = jsonl_file
+        self.path: str = os.path.splitext(jsonl_file)[0] + INDEX_SUFFIX
+
+    def __len__(self) -> int:
+        return os.path.getsize(self.path) // ENTRY.size if os.path.exists(self.path) else 0
+
+    def ensure(self) -> None:
+        """索引がない（機能の追加前に保存された）JSONL の場合は、既存の内容から索引を作成します。"""
+        if not os.path.exists(self.path) and os.path.exists(self.jsonl_file) and os.path.getsize(self.jsonl_file) > 0:
+            logger.info(f"{self.jsonl_file} の索引を作成します。")
+            self.rebuild()
+
+    @staticmethod
+    def pack(entries: List[Tuple[int, int]]) -> bytes:
+        """(メッセージID, バイト位置) の一覧を索引の形式に変換します。フラッシュでは開いたままのハンドルへ追記します。"""
+        return b"".join(ENTRY.pack(message_id, offset) for message_id, offset in entries)
+
+    def rebuild(self, start_offset: int = 0) -> int:
+        """
+        messages.jsonl の start_offset 以降を読み直して索引を作り直し、索引の件数を返します。
+        start_offset より前の行の索引はそのまま残します（末尾のみ書き換えられた場合に使用）。
+        """
+        if not os.path.exists(self.path):
+            start_offset = 0
+        keep = self._count_before(start_offset) if start_offset else 0
+        entries = []
+        if os.path.exists(self.jsonl_file):
+            with open(self.jsonl_file, 'rb') as f:
+                f.seek(start_offset)
+                offset = start_offset
+                for line in f:
+                    if line.endswith(b"\n"):
+                        try:
+                            entries.append((json.loads(line)["id"], offset))
+                        except (json.JSONDecodeError, KeyError, TypeError):
+                            pass
+                    offset += len(line)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as dst:
+            if keep:
+                with open(self.path, 'rb') as src:
+                    dst.write(src.read(keep * ENTRY.size))
+            dst.write(self.pack(entries))
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, self.path)
+        return keep + len(entries)
+
+    def _count_before(self, offset: int) -> int:
+        """バイト位置が offset より前の行の件数を返します。"""
+        count = len(self)
+        if not count:
+            return 0
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if ENTRY.unpack_from(mm, mid * ENTRY.size)[1] < offset:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+    def lookup_offset(self, message_id: int) -> Optional[int]:
+        """メッセージIDに対応する messages.jsonl 内のバイト位置を二分探索で返します。"""
+        count = len(self)
+        if not count:
+            return None
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if ENTRY.unpack_from(mm, mid * ENTRY.size)[0] < message_id:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < count:
+                found_id, offset = ENTRY.unpack_from(mm, lo * ENTRY.size)
+                if found_id == message_id:
+                    return offset
+        return None
+
+    def lookup(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """メッセージIDに対応するレコードを返します。見つからない場合は None を返します。"""
+        offset = self.lookup_offset(message_id)
+        if offset is None:
+            return None
+        try:
+            with open(self.jsonl_file, 'rb') as f:
+                f.seek(offset)
+                record = json.loads(f.readline())
+        except (OSError, json.JSONDecodeError):
+            return None
+        # 索引が古い場合に別の行を返さないよう、IDを確認する
+        return record if record.get("id") == message_id else None
@@ -0,0 +1,225 @@
+import os
+import re
+import sys
+import time
+import logging
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Dict, List, Optional
+from .config import LOGGER_NAME
+from .utils import atomic_write_json, atomic_write_text
+
+try:
+    import resource
+except ImportError:
+    # Windows には resource モジュールがないため、メモリ使用量は記録しない
+    resource = None
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def peak_rss_mb() -> Optional[float]:
+    """プロセスの最大常駐メモリ (MB) を返します。取得できない環境では None を返します。"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+# Prometheus のメトリクス名の接頭辞
+PROMETHEUS_PREFIX = "discord_indexer"
+
+# discord.py が 429 を受け取った時のログ（引数は (メソッド, URL, 待機秒数)）
+RATE_LIMIT_LOG_PREFIX = "We are being rate limited."
+# 待機して再試行する場合のログの末尾（待機せずに例外を送出する場合のログは対象外）
+RATE_LIMIT_RETRY_SUFFIX = "Retrying in %.2f seconds."
+CHANNEL_URL_PATTERN = re.compile(r"/channels/(\d+)")
+
+@dataclass
+class TargetMetrics:
+    """1つのチャンネル/スレッドの1回の実行における計測値"""
+    key: str
+    label: str = ""
+    messages: int = 0
+    # process_messageable 全体の所要時間
+    fetch_seconds: float = 0.0
+    # history() の応答待ち（APIの待ち時間とレート制限による待機を含む）
+    api_seconds: float = 0.0
+    # MessageFormatter.to_markdown の所要時間
+    render_seconds: float = 0.0
+    flushes: int = 0
+    flush_seconds: float = 0.0
+    written_bytes: int = 0
+    attachments: int = 0
+    attachment_bytes: int = 0
+    attachment_seconds: float = 0.0
+    retries: int = 0
+    rate_limited: int = 0
+    rate_limit_wait_seconds: float = 0.0
+
+    async def timed(self, source: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """非同期イテレータの次の要素を待つ時間を api_seconds に加算しながら、要素をそのまま返します。"""
+        waiting_since = time.monotonic()
+        async for item in source:
+            self.api_seconds += time.monotonic() - waiting_since
+            yield item
+            waiting_since = time.monotonic()
+        self.api_seconds += time.monotonic() - waiting_since
+
+class RateLimitLogHandler(logging.Handler):
+    """
+    discord.py の HTTP クライアントが 429 を受け取って待機する時のログから、対象のチャンネル/スレッドと待機秒数を記録します。
+    discord.py はレート制限をクライアント内で処理し、待機を通知するイベントを持たないため、ログを利用します。
+    """
+    def __init__(self, metrics: "RunMetrics"):
+        super().__init__(level=logging.WARNING)
+        self.metrics: "RunMetrics" = metrics
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not isinstance(record.msg, str) or not record.msg.startswith(RATE_LIMIT_LOG_PREFIX) or not record.msg.endswith(RATE_LIMIT_RETRY_SUFFIX):
+            return
+        if not isinstance(record.args, tuple) or len(record.args) < 3:
+            return
+        _method, url, retry_after = record.args[:3]
+        match = CHANNEL_URL_PATTERN.search(str(url))
+        target = self.metrics.targets.get(match.group(1)) if match else None
+        if target is None:
+            self.metrics.rate_limited += 1
+            self.metrics.rate_limit_wait_seconds += float(retry_after)
+            return
+        target.rate_limited += 1
+        target.retries += 1
+        target.rate_limit_wait_seconds += float(retry_after)
+
+class RunMetrics:
+    """
+    1回の実行の所要時間を計測するクラス。
+    クライアントの生成時点を起点として、on_ready や最初のAPIリクエストまでの経過時間を記録します。
+    チャンネル/スレッドごとの計測値 (TargetMetrics) も保持し、終了時に Prometheus の textfile と JSON に書き出します。
+    """
+    def __init__(self):
+        self.started_at: float = time.monotonic()
+        # 計測点の名前 -> 起点からの経過秒数（最初に記録された値のみ保持）
+        self.marks: Dict[str, float] = {}
+        # 対象ID -> 計測値
+        self.targets: Dict[str, TargetMetrics] = {}
+        # 添付ファイルの保存先ディレクトリ -> 対象ID（ダウンロードの計測値を対象に割り当てるために使用）
+        self.attachment_dirs: Dict[str, str] = {}
+        self.skipped_targets: int = 0
+        # 対象を特定できなかったレート制限
+        self.rate_limited: int = 0
+        self.rate_limit_wait_seconds: float = 0.0
+        # discord.http のロガーに登録したハンドラー（unwatch_rate_limits で取り除く）
+        self.rate_limit_handler: Optional[RateLimitLogHandler] = None
+
+    def target(self, key: str, label: str = "", attachments_dir: Optional[str] = None) -> TargetMetrics:
+        """対象の計測値を返します（なければ作成します）。"""
+        metrics = self.targets.get(key)
+        if metrics is None:
+            metrics = self.targets[key] = TargetMetrics(key, label)
+        if attachments_dir:
+            self.attachment_dirs[attachments_dir] = key
+        return metrics
+
+    def target_for_path(self, path: str) -> Optional[TargetMetrics]:
+        """添付ファイルの保存先パスから対象の計測値を返します。"""
+        key = self.attachment_dirs.get(os.path.dirname(path))
+        return self.targets.get(key) if key else None
+
+    def watch_rate_limits(self) -> None:
+        """discord.py のレート制限のログの監視を開始します。"""
+        if self.rate_limit_handler is None:
+            self.rate_limit_handler = RateLimitLogHandler(self)
+            logging.getLogger("discord.http").addHandler(self.rate_limit_handler)
+
+    def unwatch_rate_limits(self) -> None:
+        """
+        レート制限のログの監視を終了します。
+        ハンドラーはプロセス全体のロガーに登録されるため、同じプロセスで複数回実行した場合に重複して数えないよう、終了時に取り除きます。
+        """
+        if self.rate_limit_handler is not None:
+            logging.getLogger("discord.http").removeHandler(self.rate_limit_handler)
+            self.rate_limit_handler = None
+
+    def mark(self, name: str) -> None:
+        """計測点を記録します。同じ名前の計測点は最初の1回のみ記録されます。"""
+        if name not in self.marks:
+            self.marks[name] = time.monotonic() - self.started_at
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def log_summary(self) -> None:
+        """計測結果をログに出力します。"""
+        parts = [f"{name}: {seconds:.2f} 秒" for name, seconds in self.marks.items()]
+        parts.append(f"合計: {self.elapsed():.2f} 秒")
+        rss = peak_rss_mb()
+        if rss is not None:
+            parts.append(f"最大メモリ使用量: {rss:.1f} MB")
+        logger.info("計測結果 - " + ", ".join(parts))
+
+    def summary(self) -> Dict[str, Any]:
+        """実行全体と対象ごとの計測値を辞書で返します。"""
+        targets = sorted(self.targets.values(), key=lambda t: t.fetch_seconds, reverse=True)
+        return {
+            "finished_at": time.time(),
+            "duration_seconds": self.elapsed(),
+            "peak_rss_mb": peak_rss_mb(),
+            "marks": self.marks,
+            "skipped_targets": self.skipped_targets,
+            "messages": sum(t.messages for t in targets),
+            "rate_limited": self.rate_limited + sum(t.rate_limited for t in targets),
+            "rate_limit_wait_seconds": self.rate_limit_wait_seconds + sum(t.rate_limit_wait_seconds for t in targets),
+            "targets": [asdict(t) for t in targets],
+        }
+
+    def to_prometheus(self) -> str:
+        """計測値を Prometheus の text exposition format で返します。"""
+        summary = self.summary()
+        lines: List[str] = []
+
+        def gauge(name: str, help_text: str, samples: List[tuple]) -> None:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{label_str}}} {value}" if label_str else f"{PROMETHEUS_PREFIX}_{name} {value}")
+
+        gauge("last_run_timestamp_seconds", "Unix time at which the last run finished.", [({}, summary["finished_at"])])
+        gauge("run_duration_seconds", "Wall time of the last run.", [({}, summary["duration_seconds"])])
+        if summary["peak_rss_mb"] is not None:
+            gauge("peak_rss_bytes", "Peak resident memory of the last run.", [({}, int(summary["peak_rss_mb"] * 1024 * 1024))])
+        gauge("skipped_targets", "Channels and threads skipped without an API call.", [({}, self.skipped_targets)])
+        gauge("untracked_rate_limit_wait_seconds", "429 waits that could not be attributed to a channel.", [({}, self.rate_limit_wait_seconds)])
+
+        fields = [
+            ("messages", "messages", "Messages fetched in the last run."),
+            ("fetch_seconds", "fetch_seconds", "Wall time spent processing the target."),
+            ("api_seconds", "api_wait_seconds", "Time spent waiting for history() pages, including rate limit sleeps."),
+            ("render_seconds", "render_seconds", "Time spent in MessageFormatter.to_markdown."),
+            ("flushes", "flushes", "Buffer flushes."),
+            ("flush_seconds", "flush_seconds", "Time spent in StorageManager flushes."),
+            ("written_bytes", "written_bytes", "Bytes written to JSONL and Markdown."),
+            ("attachments", "attachments", "Attachments saved."),
+            ("attachment_bytes", "attachment_bytes", "Bytes of attachments saved."),
+            ("attachment_seconds", "attachment_seconds", "Time spent downloading attachments."),
+            ("retries", "retries", "Retried requests (429 responses and attachment downloads)."),
+            ("rate_limited", "rate_limited", "429 responses received."),
+            ("rate_limit_wait_seconds", "rate_limit_wait_seconds", "Time spent sleeping after 429 responses."),
+        ]
+        targets = list(self.targets.values())
+        for attr, name, help_text in fields:
+            gauge(f"target_{name}", help_text, [({"target": t.key, "name": t.label}, getattr(t, attr)) for t in targets])
+        return "\n".join(lines) + "\n"
+
+    def write(self, textfile: str, summary_file: str) -> None:
+        """Prometheus の textfile と JSON の実行結果を書き出します。"""
+        try:
+            atomic_write_text(textfile, self.to_prometheus())
+            atomic_write_json(summary_file, self.summary(), indent=4)
+        except OSError as e:
+            logger.error(f"計測結果の書き出しに失敗しました: {e}")
+
+def escape_label(value: Any) -> str:
+    """Prometheus のラベル値をエスケープします。"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
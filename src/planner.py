@@ -0,0 +1,230 @@
+import json
+import math
+import time
+import datetime
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set
+import discord
+from .config import ALLOWED_CATEGORIES, LOGGER_NAME, PRIORITY_STALENESS_WEIGHT
+from .storage import StorageManager
+from .utils import replace_fake_uppercase
+
+logger = logging.getLogger(LOGGER_NAME)
+
+@dataclass
+class FetchTarget:
+    """取得対象となるチャンネル/スレッドと、その保存先の情報"""
+    messageable: discord.abc.Messageable
+    category_path: str
+    channel_name: str
+    file_name: str = "messages"
+    is_thread: bool = False
+    # 対象を検出した経路 (channel / active_thread / archived_thread / guild_thread / gateway)
+    source: str = "channel"
+    # 取得の優先度（大きいほど先に取得する。FetchPlanner.prioritize で設定）
+    priority: float = 0.0
+
+    @property
+    def key(self) -> str:
+        """状態追跡用の一意ID"""
+        return str(self.messageable.id)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """計画の出力用に辞書へ変換します。"""
+        return {
+            "id": self.messageable.id,
+            "name": self.messageable.name,
+            "category": self.category_path,
+            "channel": self.channel_name,
+            "file_name": self.file_name,
+            "is_thread": self.is_thread,
+            "source": self.source,
+            "last_message_id": getattr(self.messageable, 'last_message_id', None),
+            "priority": self.priority if math.isfinite(self.priority) else None,
+        }
+
+@dataclass
+class ArchiveWatermark:
+    """列挙が完了したチャンネルの新しいアーカイブウォーターマーク"""
+    channel_key: str
+    archived_at: datetime.datetime
+    thread_keys: List[str] = field(default_factory=list)
+
+@dataclass
+class FetchPlan:
+    """1回の実行で取得する対象の一覧"""
+    targets: List[FetchTarget] = field(default_factory=list)
+    watermarks: List[ArchiveWatermark] = field(default_factory=list)
+    # 重複として除外された対象の数
+    duplicates: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "created_at": str(datetime.datetime.now()),
+            "duplicates": self.duplicates,
+            "targets": [target.to_dict() for target in self.targets],
+            "archive_watermarks": [
+                {"channel_id": w.channel_key, "archived_at": w.archived_at.isoformat(), "threads": len(w.thread_keys)}
+                for w in self.watermarks
+            ],
+        }
+
+    def dump(self, path: str) -> None:
+        """計画をJSONファイルに書き出します。"""
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, indent=4, ensure_ascii=False)
+            logger.info(f'取得計画を {path} に書き出しました。')
+        except Exception as e:
+            logger.error(f"取得計画の書き出しに失敗しました: {e}")
+
+class FetchPlanner:
+    """
+    ギルド内の取得対象を列挙し、FetchPlan を作成するクラス。
+    スレッドはIDで重複を除外するため、channel.threads / archived_threads / guild.threads の
+    いずれから見つかっても1回の実行で一度だけ取得されます。
+    """
+    def __init__(self, storage: StorageManager):
+        self.storage = storage
+
+    @staticmethod
+    def category_name(channel: discord.abc.GuildChannel) -> str:
+        return replace_fake_uppercase(channel.category.name if channel.category else "Uncategorized")
+
+    def is_allowed(self, channel: discord.abc.GuildChannel) -> bool:
+        """カテゴリが取得対象かどうかを判定します。"""
+        # カテゴリ名が許可リストにない、かつ（カテゴリなしの場合に空文字列が許可リストにない）場合は対象外
+        return self.category_name(channel) in ALLOWED_CATEGORIES or (not channel.category and "" in ALLOWED_CATEGORIES)
+
+    def target_for(self, channel: discord.abc.GuildChannel) -> Optional[FetchTarget]:
+        """
+        単一のチャンネル/スレッドに対応する取得対象を返します（ゲートウェイイベントの処理用）。
+        取得対象外の場合は None を返します。
+        """
+        if isinstance(channel, discord.Thread):
+            parent = channel.parent
+            if not isinstance(parent, (discord.TextChannel, discord.ForumChannel)) or not self.is_allowed(parent):
+                return None
+            return FetchTarget(channel, self.category_name(parent), replace_fake_uppercase(parent.name), replace_fake_uppercase(channel.name), is_thread=True, source="gateway")
+        if isinstance(channel, discord.TextChannel) and self.is_allowed(channel):
+            return FetchTarget(channel, self.category_name(channel), replace_fake_uppercase(channel.name), file_name="messages", source="gateway")
+        return None
+
+    async def plan(self, guild: discord.Guild) -> FetchPlan:
+        plan = FetchPlan()
+        visited: Set[str] = set()
+
+        def add(target: FetchTarget) -> bool:
+            if target.key in visited:
+                plan.duplicates += 1
+                return False
+            visited.add(target.key)
+            plan.targets.append(target)
+            logger.debug(f'  取得対象に追加: {target.channel_name}/{target.file_name} ({target.source})')
+            return True
+
+        # テキストチャンネルとフォーラムを取得
+        channels = [c for c in guild.channels if isinstance(c, (discord.TextChannel, discord.ForumChannel))]
+
+        for channel in channels:
+            if not self.is_allowed(channel):
+                continue
+            category_name = self.category_name(channel)
+            channel_name = replace_fake_uppercase(channel.name)
+            logger.info(f'チャンネルを確認中: {channel.name} (ID: {channel.id}) カテゴリ: {category_name}')
+
+            # 1. チャンネル自体（テキストチャンネルの場合）
+            if isinstance(channel, discord.TextChannel):
+                add(FetchTarget(channel, category_name, channel_name, file_name="messages"))
+
+            # 2. アクティブなスレッド
+            try:
+                if hasattr(channel, 'threads'):
+                    for thread in channel.threads:
+                        add(FetchTarget(thread, category_name, channel_name, replace_fake_uppercase(thread.name), is_thread=True, source="active_thread"))
+            except Exception as e:
+                logger.error(f"  {channel.name} のスレッドへのアクセスエラー: {e}")
+
+            # 3. アーカイブされたスレッド（フォーラム/テキストチャンネル）
+            label = "フォーラム" if isinstance(channel, discord.ForumChannel) else "テキストチャンネル"
+            logger.info(f"  {label}のアーカイブされたスレッドを取得中: {channel.name}")
+            watermark = await self.plan_archived_threads(channel, category_name, add)
+            if watermark:
+                plan.watermarks.append(watermark)
+
+        # ギルドのアクティブなスレッド（channel.threadsで見つからないスレッドのフォールバック）
+        for thread in guild.threads:
+            if thread.parent_id and thread.guild.id == guild.id:
+                parent = guild.get_channel(thread.parent_id)
+                if parent and isinstance(parent, (discord.TextChannel, discord.ForumChannel)) and self.is_allowed(parent):
+                    add(FetchTarget(thread, self.category_name(parent), replace_fake_uppercase(parent.name), replace_fake_uppercase(thread.name), is_thread=True, source="guild_thread"))
+
+        threads = sum(1 for t in plan.targets if t.is_thread)
+        logger.info(f'取得計画: {len(plan.targets)} 件 (チャンネル {len(plan.targets) - threads} 件, スレッド {threads} 件, 重複除外 {plan.duplicates} 件)')
+        return plan
+
+    def prioritize(self, plan: FetchPlan, staleness_weight: float = PRIORITY_STALENESS_WEIGHT) -> None:
+        """
+        取得対象を優先度の降順に並べ替えます（同じ優先度の対象は列挙した順を保ちます）。
+        優先度は、取得済みのIDとゲートウェイキャッシュ上の最終メッセージIDの間の期間に、
+        これまでの1時間あたりのメッセージ数を掛けた新着メッセージの見込み数に、前回の取得からの経過時間（時間）× staleness_weight を加えた値です。
+        一度も取得していない対象は最優先、最終メッセージIDが取得済みの対象（スキップされる）は最後になります。
+        """
+        now = time.time()
+        for target in plan.targets:
+            target.priority = self.priority_of(target, now, staleness_weight)
+        plan.targets.sort(key=lambda target: target.priority, reverse=True)
+        busiest = ", ".join(f"{t.channel_name}/{t.file_name}" if t.is_thread else t.channel_name for t in plan.targets[:3])
+        logger.info(f'取得対象を優先度順に並べ替えました (上位: {busiest})')
+
+    def priority_of(self, target: FetchTarget, now: float, staleness_weight: float) -> float:
+        stored_id = self.storage.get_last_message_id(target.key)
+        if stored_id is None:
+            return math.inf
+        latest_id = getattr(target.messageable, 'last_message_id', None)
+        if latest_id is not None and latest_id <= stored_id:
+            return 0.0
+        activity = self.storage.get_activity(target.key)
+        fetched_at = activity["fetched_at"] if activity else discord.utils.snowflake_time(stored_id).timestamp()
+        stale_hours = max(0.0, (now - fetched_at) / 3600)
+        # 最終メッセージIDが不明な場合（アーカイブ済みスレッドなど）は、前回の取得からの期間に新着があったものとみなす
+        if latest_id is not None:
+            gap_hours = (discord.utils.snowflake_time(latest_id) - discord.utils.snowflake_time(stored_id)).total_seconds() / 3600
+        else:
+            gap_hours = stale_hours
+        expected = activity["rate"] * gap_hours if activity else 0.0
+        # 最終メッセージIDが進んでいる対象には、少なくとも1件の新着がある
+        if latest_id is not None:
+            expected = max(1.0, expected)
+        return expected + staleness_weight * stale_hours
+
+    async def plan_archived_threads(self, channel: discord.abc.GuildChannel, category_name: str, add: Callable[[FetchTarget], bool]) -> Optional[ArchiveWatermark]:
+        """
+        アーカイブされたスレッドを列挙し、取得対象に追加します。
+        スレッドは archive_timestamp の降順で返されるため、保存済みのウォーターマーク以前に
+        アーカイブされたスレッド（取得済み）に到達した時点で列挙を打ち切ります。
+        再アーカイブされたスレッドは archive_timestamp が更新されるため、再度列挙されます。
+        列挙が完了した場合は新しいウォーターマークを返します。
+        """
+        channel_key = str(channel.id)
+        watermark = self.storage.get_archive_watermark(channel_key)
+        latest = watermark
+        thread_keys: List[str] = []
+        try:
+            async for thread in channel.archived_threads(limit=None):
+                archived_at = thread.archive_timestamp
+                if watermark and archived_at < watermark:
+                    logger.info(f'  取得済みのアーカイブに到達したため列挙を終了します: {channel.name}')
+                    break
+                if latest is None or archived_at > latest:
+                    latest = archived_at
+                thread_keys.append(str(thread.id))
+                add(FetchTarget(thread, category_name, replace_fake_uppercase(channel.name), replace_fake_uppercase(thread.name), is_thread=True, source="archived_thread"))
+        except Exception as e:
+            logger.error(f"  {channel.name} のアーカイブされたスレッドへのアクセスエラー: {e}")
+            return None
+
+        if latest is None:
+            return None
+        return ArchiveWatermark(channel_key, latest, thread_keys)
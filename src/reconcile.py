@@ -0,0 +1,222 @@
+import os
+import json
+import asyncio
+import datetime
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import discord
+from discord.utils import snowflake_time, time_snowflake
+from .config import LOGGER_NAME
+from .renderer import write_day_file
+from .storage import ChannelBuffer
+from .segments import SegmentedJsonl
+from .utils import atomic_write_text, iter_lines_reversed
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# 編集の検出で比較するレコードの項目（著者の表示名の変更などは対象外）
+RECONCILED_FIELDS = ("content", "clean_content", "edited_at", "attachments", "embeds", "reactions")
+
+def make_edit_patch(record: Dict[str, Any]) -> Dict[str, Any]:
+    """編集されたメッセージの新しいレコードを持つパッチを作成します。"""
+    return {"op": "edit", "id": record["id"], "record": record, "at": str(datetime.datetime.now(datetime.timezone.utc))}
+
+def make_delete_patch(message_id: int) -> Dict[str, Any]:
+    """削除されたメッセージのパッチ（トゥームストーン）を作成します。"""
+    return {"op": "delete", "id": message_id, "at": str(datetime.datetime.now(datetime.timezone.utc))}
+
+def read_patches(patches_file: str) -> Dict[int, Dict[str, Any]]:
+    """パッチファイルを読み込み、メッセージIDごとの最新のパッチを返します。"""
+    patches: Dict[int, Dict[str, Any]] = {}
+    if not os.path.exists(patches_file):
+        return patches
+    with open(patches_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                patch = json.loads(line)
+            except json.JSONDecodeError:
+                # 追記中に中断された行は無視する
+                continue
+            previous = patches.get(patch["id"])
+            # 削除後に届いた編集（順序の入れ替わり）で削除を取り消さない
+            if previous and previous["op"] == "delete" and patch["op"] == "edit":
+                continue
+            patches[patch["id"]] = patch
+    return patches
+
+def apply_patch(record: Dict[str, Any], patch: Dict[str, Any]) -> Dict[str, Any]:
+    """レコードにパッチを適用した新しいレコードを返します。削除されたメッセージも内容は残し、deleted_at を付与します。"""
+    if patch["op"] == "edit":
+        patched = dict(patch["record"])
+        if record.get("deleted_at"):
+            patched["deleted_at"] = record["deleted_at"]
+        return patched
+    patched = dict(record)
+    patched.setdefault("deleted_at", patch["at"])
+    return patched
+
+def read_recent_records(jsonl_file: str, stop: Callable[[Dict[str, Any]], bool]) -> Tuple[int, List[Tuple[bytes, Optional[Dict[str, Any]]]]]:
+    """
+    messages.jsonl を末尾から読み、stop(record) が True になるレコードの手前までを返します。
+    戻り値は (返した範囲の先頭のバイト位置, 古い順の (元の行, レコード) のリスト) です。
+    解析できない行はレコードを None として元の行のまま返します。
+    """
+    offset = os.path.getsize(jsonl_file) if os.path.exists(jsonl_file) else 0
+    lines: List[Tuple[bytes, Optional[Dict[str, Any]]]] = []
+    if not offset:
+        return 0, lines
+    for line_offset, line in iter_lines_reversed(jsonl_file):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = None
+        if record is not None and stop(record):
+            break
+        offset = line_offset
+        lines.append((line, record))
+    lines.reverse()
+    return offset, lines
+
+class Reconciler:
+    """
+    取得済みのメッセージに対する編集/削除/リアクションの変更を反映するクラス。
+    直近 window_days 日間だけを再取得して messages.jsonl と比較し、差分をパッチファイルへ追記します。
+    パッチは compact() で messages.jsonl と該当する日付のMarkdownにまとめて反映されます。
+    """
+    def __init__(self, window_days: int = 7):
+        self.window_days: int = window_days
+
+    def window_start(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.window_days)
+
+    def is_applicable(self, messageable: discord.abc.Messageable) -> bool:
+        """最後のメッセージが再確認の期間内にある場合のみ対象とします（APIは呼びません）。"""
+        cached_last_id = getattr(messageable, 'last_message_id', None)
+        if not cached_last_id:
+            return False
+        return snowflake_time(int(cached_last_id)) >= self.window_start()
+
+    async def reconcile(self, buffer: ChannelBuffer, messageable: discord.abc.Messageable, last_message_id: int) -> Tuple[int, int]:
+        """
+        直近の期間の取得済みメッセージを再取得して比較し、(編集数, 削除数) を返します。
+        履歴の取得が途中で失敗した場合は例外を送出し、削除の判定は行いません。
+        """
+        since_id = time_snowflake(self.window_start())
+        _offset, lines = read_recent_records(buffer.jsonl_file, lambda r: r["id"] <= since_id)
+        ids = [record["id"] for _line, record in lines if record is not None]
+        # 同じ名前の別の対象と messages.jsonl を共有していた場合（以前の保存先の決め方）は、
+        # 他の対象のメッセージを削除と判定してしまうため確認しない。1つの対象の行はID順に追記される
+        if any(a >= b for a, b in zip(ids, ids[1:])):
+            logger.warning(f'{buffer.jsonl_file} のメッセージがID順ではないため（別のチャンネル/スレッドと共有している可能性）、編集/削除の確認をスキップします。')
+            return 0, 0
+        stored = {record["id"]: record for _line, record in lines if record is not None}
+        # 未反映のパッチも考慮し、同じ変更を繰り返し記録しないようにする
+        for message_id, patch in read_patches(buffer.patches_file).items():
+            if message_id in stored:
+                stored[message_id] = apply_patch(stored[message_id], patch)
+        if not stored:
+            return 0, 0
+
+        patches = []
+        seen = set()
+        async for message in messageable.history(limit=None, after=discord.Object(id=since_id), before=discord.Object(id=last_message_id + 1), oldest_first=True):
+            seen.add(message.id)
+            old = stored.get(message.id)
+            if old is None or old.get("deleted_at"):
+                continue
+            _date, _md, record = await buffer.render(message)
+            if record and any(record.get(k) != old.get(k) for k in RECONCILED_FIELDS):
+                patches.append(make_edit_patch(record))
+        edited = len(patches)
+
+        for message_id, record in stored.items():
+            if message_id not in seen and not record.get("deleted_at"):
+                patches.append(make_delete_patch(message_id))
+
+        buffer.append_patches(patches)
+        return edited, len(patches) - edited
+
+    @staticmethod
+    async def compact_in_thread(buffer: ChannelBuffer) -> int:
+        """
+        compact() を、他の取得ジョブやゲートウェイの処理を止めないよう別スレッドで実行します。
+        messages.jsonl とMarkdownを置き換えるため、保存されていない書き込みを確定してから開いたままのハンドルを閉じます。
+        """
+        if not os.path.exists(buffer.patches_file):
+            return 0
+        buffer.storage.sync(buffer.key)
+        buffer.close()
+        return await asyncio.to_thread(Reconciler.compact, buffer)
+
+    @staticmethod
+    def compact(buffer: ChannelBuffer) -> int:
+        """
+        パッチファイルの内容を messages.jsonl と該当する日付のMarkdownへ反映し、反映したパッチをパッチファイルから取り除きます。
+        書き換えるのは最も古いパッチの日付以降の末尾部分のみで、それより前はそのままコピーします。
+        途中で中断されても、パッチは再適用しても同じ結果になるため次回の実行でやり直されます。
+        セグメントへ移動済みのメッセージに対するパッチは反映できないため、パッチファイルに残します。
+        反映したパッチの数を返します。
+        呼び出し側は状態を保存し、開いたままのハンドルを閉じておく必要があります（compact_in_thread を参照）。
+        """
+        patches = read_patches(buffer.patches_file)
+        if not patches:
+            return 0
+
+        last_segment_id = SegmentedJsonl(buffer.jsonl_file).last_segment_id()
+        rolled = {message_id: patch for message_id, patch in patches.items() if last_segment_id is not None and message_id <= last_segment_id}
+        patches = {message_id: patch for message_id, patch in patches.items() if message_id not in rolled}
+        if rolled:
+            logger.warning(f'{buffer.patches_file}: セグメントへ移動済みのメッセージに対する {len(rolled)} 件のパッチは反映できないため、パッチファイルに残します。')
+        if not patches:
+            return 0
+
+        min_date = snowflake_time(min(patches)).strftime('%Y-%m-%d')
+        offset, lines = read_recent_records(buffer.jsonl_file, lambda r: r["created_at"][:10] < min_date)
+
+        tail = []
+        tail_records = []
+        affected_dates = set()
+        applied_ids = set()
+        for line, record in lines:
+            patch = patches.get(record["id"]) if record is not None else None
+            if patch is None:
+                tail.append(line + b"\n")
+                if record is not None:
+                    tail_records.append(record)
+                continue
+            record = apply_patch(record, patch)
+            tail.append(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+            tail_records.append(record)
+            affected_dates.add(record["created_at"][:10])
+            applied_ids.add(record["id"])
+
+        if applied_ids:
+            # 変更のない先頭部分はそのままコピーし、末尾だけを書き換えたファイルで置き換える
+            tmp_path = f"{buffer.jsonl_file}.tmp"
+            with open(buffer.jsonl_file, 'rb') as src, open(tmp_path, 'wb') as dst:
+                remaining = offset
+                while remaining > 0:
+                    chunk = src.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+                dst.writelines(tail)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, buffer.jsonl_file)
+            buffer.index.rebuild(offset)
+
+            # 影響を受けた日付のMarkdownをレコードから再生成する
+            for date_str in sorted(affected_dates):
+                write_day_file(buffer.messages_dir, date_str, [r for r in tail_records if r["created_at"][:10] == date_str], buffer.lookup_message)
+
+        # 保存されていないメッセージ（取得前に編集/削除されたものなど）に対するパッチは反映先がないため破棄する
+        unmatched = len(patches) - len(applied_ids)
+        if unmatched:
+            logger.debug(f'{buffer.patches_file}: 保存されていないメッセージに対する {unmatched} 件のパッチを破棄しました。')
+        if rolled:
+            atomic_write_text(buffer.patches_file, "".join(json.dumps(patch, ensure_ascii=False) + "\n" for patch in rolled.values()))
+        else:
+            os.remove(buffer.patches_file)
+        return len(applied_ids)
@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .config import LOGGER_NAME, DATA_DIR, RENDER_MANIFEST_FILE
+from .formatter import MessageFormatter
+from .segments import SegmentedJsonl
+from .utils import atomic_write_json
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# Markdownの出力形式を変更した場合に上げることで、次回の render で全ての日付が再生成される
+RENDER_FORMAT_VERSION = 2
+
+def write_day_file(messages_dir: str, date_str: str, records: List[Dict[str, Any]],
+                   lookup: Optional[Callable[[int], Optional[Dict[str, Any]]]] = None) -> None:
+    """1日分のレコードから日付ごとのMarkdownファイルを生成し、置き換えます。lookup は返信先の抜粋に使用します。"""
+    md_file_path = os.path.join(messages_dir, f"{date_str}.md")
+    tmp_path = f"{md_file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(f"# {date_str}\n\n")
+        f.write("".join(MessageFormatter.record_to_markdown(r, lookup) for r in records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, md_file_path)
+
+def render_channel(channel_dir: str, entry: Optional[Dict[str, Any]], force: bool = False) -> Tuple[Dict[str, Any], int, int]:
+    """
+    1つのチャンネル/スレッドの messages.jsonl から、変更があった日付のMarkdownのみを再生成します。
+    プロセスプールから呼び出されるため、引数と戻り値はpickle可能な値のみを使用します。
+    戻り値は (新しいマニフェストのエントリ, 再生成した日数, 解析できなかった行数) です。
+    """
+    jsonl_file = os.path.join(channel_dir, "messages.jsonl")
+    messages_dir = os.path.join(channel_dir, "messages")
+    stat = os.stat(jsonl_file)
+    entry = entry or {}
+    # messages.jsonl のサイズと更新日時が前回と同じであれば、ファイルを読まずにスキップする
+    if not force and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+        return entry, 0, 0
+
+    records_by_date: Dict[str, List[Dict[str, Any]]] = {}
+    # 返信先の抜粋のために、全てのレコードをIDから引けるようにする
+    records_by_id: Dict[int, Dict[str, Any]] = {}
+    digests: Dict[str, Any] = {}
+    invalid = 0
+    # セグメントへ分割されている場合も、全ての行を古い順に読む
+    for line in SegmentedJsonl(jsonl_file).iter_lines():
+        try:
+            record = json.loads(line)
+            date_str = record["created_at"][:10]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            invalid += 1
+            continue
+        records_by_date.setdefault(date_str, []).append(record)
+        records_by_id[record.get("id")] = record
+        digests.setdefault(date_str, hashlib.sha1()).update(line)
+
+    os.makedirs(messages_dir, exist_ok=True)
+    previous_days = entry.get("days", {})
+    days = {}
+    rendered = 0
+    for date_str, records in records_by_date.items():
+        digest = digests[date_str].hexdigest()
+        days[date_str] = digest
+        if not force and previous_days.get(date_str) == digest and os.path.exists(os.path.join(messages_dir, f"{date_str}.md")):
+            continue
+        write_day_file(messages_dir, date_str, records, records_by_id.get)
+        rendered += 1
+
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "days": days}, rendered, invalid
+
+class MarkdownRenderer:
+    """
+    保存済みの messages.jsonl から日付ごとのMarkdownをオフラインで再生成するクラス。
+    チャンネル/スレッド単位のタスクをプロセスプールで並行に処理し、
+    前回の再生成から変更があった日付のみをマニフェストで判定して書き換えます。
+    """
+    def __init__(self, data_dir: str = DATA_DIR, manifest_file: str = RENDER_MANIFEST_FILE, workers: Optional[int] = None):
+        self.data_dir: str = data_dir
+        self.manifest_file: str = manifest_file
+        self.workers: Optional[int] = workers
+
+    def load_manifest(self) -> Dict[str, Any]:
+        if not os.path.exists(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"マニフェスト {self.manifest_file} の読み込みに失敗したため、全て再生成します: {e}")
+            return {}
+
+    def find_channel_dirs(self) -> List[str]:
+        """messages.jsonl を持つディレクトリを列挙します。"""
+        return sorted(root for root, _dirs, files in os.walk(self.data_dir) if "messages.jsonl" in files)
+
+    def run(self, force: bool = False) -> Tuple[int, int]:
+        """再生成を実行し、(処理したチャンネル数, 再生成した日数) を返します。"""
+        manifest = self.load_manifest()
+        # 出力形式が変わった場合は全て再生成する
+        if manifest.get("format_version") != RENDER_FORMAT_VERSION:
+            force = True
+        channels = manifest.get("channels", {}) if not force else {}
+
+        channel_dirs = self.find_channel_dirs()
+        new_channels: Dict[str, Any] = {}
+        total_rendered = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for channel_dir in channel_dirs:
+                key = os.path.relpath(channel_dir, self.data_dir)
+                futures[executor.submit(render_channel, channel_dir, channels.get(key), force)] = key
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    entry, rendered, invalid = future.result()
+                except Exception as e:
+                    logger.error(f"{key} の再生成に失敗しました: {e}")
+                    if key in channels:
+                        new_channels[key] = channels[key]
+                    continue
+                new_channels[key] = entry
+                total_rendered += rendered
+                if invalid:
+                    logger.warning(f"{key}: 解析できない {invalid} 行をスキップしました。")
+                if rendered:
+                    logger.info(f"  {key}: {rendered} 日分を再生成しました。")
+
+        atomic_write_json(self.manifest_file, {"format_version": RENDER_FORMAT_VERSION, "channels": new_channels})
+        return len(channel_dirs), total_rendered
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+from .config import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class FetchScheduler:
+    """
+    process_messageable などの取得ジョブを並行実行するスケジューラ。
+    同時実行数はワーカー数で制限します。
+    レート制限は discord.py の HTTPClient がルート（バケット）単位で待機するため、
+    ここでは同時にリクエストを発行するジョブの数のみを制御します。
+    """
+    def __init__(self, concurrency: int = 4):
+        self.concurrency: int = max(1, concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers: List[asyncio.Task] = []
+        self.results: List[bool] = []
+
+    def start(self) -> None:
+        """ワーカーを起動します。"""
+        if self.workers:
+            return
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def submit(self, job: Callable[..., Awaitable[bool]], *args: Any, **kwargs: Any) -> None:
+        """ジョブをキューに追加します。"""
+        self.queue.put_nowait((job, args, kwargs))
+
+    async def join(self) -> List[bool]:
+        """キュー内の全ジョブの完了を待機し、ワーカーを停止して結果を返します。"""
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        return self.results
+
+    async def _worker(self) -> None:
+        while True:
+            job, args, kwargs = await self.queue.get()
+            result: Optional[bool] = False
+            try:
+                result = await job(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"ジョブの実行中にエラーが発生しました: {e}", exc_info=True)
+            finally:
+                self.results.append(bool(result))
+                self.queue.task_done()
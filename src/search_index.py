@@ -0,0 +1,154 @@
+import os
+import json
+import sqlite3
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+from .config import LOGGER_NAME, DATA_DIR, SEARCH_DB_FILE, SEARCH_TOKENIZER
+from .segments import SegmentedJsonl
+from .utils import read_channel_ids
+
+logger = logging.getLogger(LOGGER_NAME)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER,
+    thread_id INTEGER,
+    author_id INTEGER,
+    author_name TEXT,
+    created_at TEXT,
+    date TEXT,
+    clean_content TEXT,
+    jsonl_path TEXT,
+    md_path TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_author ON messages(author_id);
+CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages(channel_id);
+CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_id);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    clean_content, content='messages', content_rowid='id', tokenize='{tokenizer}'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, clean_content) VALUES (new.id, new.clean_content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, clean_content) VALUES ('delete', old.id, old.clean_content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, clean_content) VALUES ('delete', old.id, old.clean_content);
+    INSERT INTO messages_fts(rowid, clean_content) VALUES (new.id, new.clean_content);
+END;
+"""
+
+UPSERT = """
+INSERT INTO messages (id, channel_id, thread_id, author_id, author_name, created_at, date, clean_content, jsonl_path, md_path)
+VALUES (:id, :channel_id, :thread_id, :author_id, :author_name, :created_at, :date, :clean_content, :jsonl_path, :md_path)
+ON CONFLICT(id) DO UPDATE SET
+    author_name = excluded.author_name,
+    clean_content = excluded.clean_content,
+    jsonl_path = excluded.jsonl_path,
+    md_path = excluded.md_path
+"""
+
+class SearchIndex:
+    """
+    メッセージの全文検索インデックス (SQLite FTS5)。
+    StorageManager のシンクとしてフラッシュごとに差分を追加します。
+    日本語など空白で区切られない文章も部分一致で検索できるよう、既定では trigram トークナイザーを使用します。
+    """
+    def __init__(self, db_path: str = SEARCH_DB_FILE, tokenizer: str = SEARCH_TOKENIZER):
+        self.db_path: str = db_path
+        self.conn: sqlite3.Connection = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA.format(tokenizer=tokenizer))
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @staticmethod
+    def to_row(record: Dict[str, Any], channel_id: Optional[int], thread_id: Optional[int], jsonl_file: str, messages_dir: str) -> Dict[str, Any]:
+        date_str = record["created_at"][:10]
+        return {
+            "id": record["id"],
+            "channel_id": channel_id,
+            "thread_id": thread_id,
+            "author_id": record["author"]["id"],
+            "author_name": record["author"]["display_name"],
+            "created_at": record["created_at"],
+            "date": date_str,
+            "clean_content": record["clean_content"],
+            "jsonl_path": os.path.relpath(jsonl_file, DATA_DIR),
+            "md_path": os.path.relpath(os.path.join(messages_dir, f"{date_str}.md"), DATA_DIR),
+        }
+
+    def upsert(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """メッセージを1トランザクションでまとめて追加/更新します。"""
+        with self.conn:
+            self.conn.executemany(UPSERT, rows)
+
+    def on_flush(self, buffer: Any, records: List[Dict[str, Any]]) -> None:
+        """ChannelBuffer のフラッシュ完了時に呼び出されます。"""
+        self.upsert(self.to_row(r, buffer.channel_id, buffer.thread_id, buffer.jsonl_file, buffer.messages_dir) for r in records)
+
+    def on_patch(self, buffer: Any, patches: List[Dict[str, Any]]) -> None:
+        """取得済みメッセージの編集/削除が記録された時に呼び出されます。削除されたメッセージは検索対象から外します。"""
+        edits = [p["record"] for p in patches if p["op"] == "edit"]
+        deleted = [(p["id"],) for p in patches if p["op"] == "delete"]
+        self.upsert(self.to_row(r, buffer.channel_id, buffer.thread_id, buffer.jsonl_file, buffer.messages_dir) for r in edits)
+        with self.conn:
+            self.conn.executemany("DELETE FROM messages WHERE id = ?", deleted)
+
+    def rebuild(self, data_dir: str = DATA_DIR) -> int:
+        """DATA_DIR 配下の全ての messages.jsonl からインデックスを作り直します。"""
+        count = 0
+        for root, _dirs, files in os.walk(data_dir):
+            if "messages.jsonl" not in files:
+                continue
+            jsonl_file = os.path.join(root, "messages.jsonl")
+            channel_id, thread_id = read_channel_ids(root)
+            rows = []
+            # セグメントへ分割されている場合も、全ての行を古い順に読む
+            for line in SegmentedJsonl(jsonl_file).iter_lines():
+                try:
+                    record = json.loads(line)
+                    if record.get("deleted_at"):
+                        continue
+                    rows.append(self.to_row(record, channel_id, thread_id, jsonl_file, os.path.join(root, "messages")))
+                except (json.JSONDecodeError, KeyError) as e:
+                    logger.warning(f"{jsonl_file} の不正な行をスキップしました: {e}")
+            self.upsert(rows)
+            count += len(rows)
+        return count
+
+    def search(self, query: str, limit: int = 20, author: Optional[str] = None, channel_id: Optional[int] = None,
+               since: Optional[str] = None, until: Optional[str] = None, raw: bool = False) -> List[sqlite3.Row]:
+        """
+        全文検索を行い、関連度順に結果を返します。
+        raw が False の場合、クエリはフレーズとして扱われます（FTS5の構文は解釈されません）。
+        """
+        match = query if raw else '"' + query.replace('"', '""') + '"'
+        sql = """
+            SELECT m.id, m.author_name, m.created_at, m.channel_id, m.thread_id, m.jsonl_path, m.md_path,
+                   snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet, bm25(messages_fts) AS score
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        """
+        params: List[Any] = [match]
+        if author:
+            sql += " AND m.author_name = ?"
+            params.append(author)
+        if channel_id:
+            sql += " AND (m.channel_id = ? OR m.thread_id = ?)"
+            params.extend([channel_id, channel_id])
+        if since:
+            sql += " AND m.date >= ?"
+            params.append(since)
+        if until:
+            sql += " AND m.date <= ?"
+            params.append(until)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
@@ -0,0 +1,241 @@
+import os
+import json
+import struct
+import shutil
+import logging
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+from .config import LOGGER_NAME
+from .message_index import MessageIndex
+
+try:
+    import zstandard
+except ImportError:
+    # 分割保存を使用しない場合は zstandard は不要
+    zstandard = None
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# messages.jsonl と同じディレクトリに置く、確定したセグメントの保存先
+SEGMENTS_DIR_NAME = "segments"
+# segments/messages.<最初のID>-<最後のID>.jsonl.zst （IDは20桁で0埋めし、名前順がID順になるようにする）
+SEGMENT_SUFFIX = ".jsonl.zst"
+# 1フレームあたりの圧縮前のサイズ。フレームは独立して展開できるため、シークテーブルからフレーム単位で読み出せる
+FRAME_SIZE = 1024 * 1024
+
+# Zstandard の seekable format（スキップ可能フレームに格納するシークテーブル）
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_ENTRY = struct.Struct("<II")
+SEEK_FOOTER = struct.Struct("<IBI")
+
+def require_zstandard() -> None:
+    if zstandard is None:
+        raise RuntimeError("JSONL の分割保存には zstandard が必要です (pip install zstandard)")
+
+class SegmentWriter:
+    """
+    1つのセグメントを独立した Zstandard フレームの列として書き込み、末尾にシークテーブルを付けます。
+    一時ファイルへ書き込み、close() で最初と最後のメッセージIDを含む名前に置き換えます。
+    """
+    def __init__(self, segments_dir: str, level: int = 10):
+        require_zstandard()
+        self.segments_dir: str = segments_dir
+        self.tmp_path: str = os.path.join(segments_dir, "segment.tmp")
+        self.f: BinaryIO = open(self.tmp_path, 'wb')
+        self.cctx = zstandard.ZstdCompressor(level=level)
+        self.pending: List[bytes] = []
+        self.pending_size: int = 0
+        # (圧縮後のサイズ, 圧縮前のサイズ)
+        self.frames: List[Tuple[int, int]] = []
+        self.first_id: Optional[int] = None
+        self.last_id: Optional[int] = None
+        self.count: int = 0
+
+    def write_line(self, line: bytes, message_id: int) -> None:
+        if self.first_id is None:
+            self.first_id = message_id
+        self.last_id = message_id
+        self.count += 1
+        self.pending.append(line)
+        self.pending_size += len(line)
+        if self.pending_size >= FRAME_SIZE:
+            self._write_frame()
+
+    def _write_frame(self) -> None:
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        frame = self.cctx.compress(data)
+        self.f.write(frame)
+        self.frames.append((len(frame), len(data)))
+        self.pending.clear()
+        self.pending_size = 0
+
+    def close(self) -> str:
+        """セグメントを確定し、そのパスを返します。"""
+        self._write_frame()
+        table = b"".join(SEEK_ENTRY.pack(c_size, d_size) for c_size, d_size in self.frames)
+        table += SEEK_FOOTER.pack(len(self.frames), 0, SEEKABLE_MAGIC)
+        self.f.write(struct.pack("<II", SKIPPABLE_MAGIC, len(table)) + table)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        path = os.path.join(self.segments_dir, f"messages.{self.first_id:020d}-{self.last_id:020d}{SEGMENT_SUFFIX}")
+        os.replace(self.tmp_path, path)
+        return path
+
+def read_seek_table(f: BinaryIO) -> List[Tuple[int, int]]:
+    """セグメントの末尾のシークテーブルから (圧縮後のサイズ, 圧縮前のサイズ) の一覧を読み込みます。"""
+    f.seek(-SEEK_FOOTER.size, os.SEEK_END)
+    count, _descriptor, magic = SEEK_FOOTER.unpack(f.read(SEEK_FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError(f"{f.name} にシークテーブルがありません")
+    f.seek(-(SEEK_FOOTER.size + count * SEEK_ENTRY.size), os.SEEK_END)
+    table = f.read(count * SEEK_ENTRY.size)
+    return [SEEK_ENTRY.unpack_from(table, i * SEEK_ENTRY.size) for i in range(count)]
+
+def iter_segment_lines(path: str) -> Iterator[bytes]:
+    """セグメントの行をフレームごとに展開しながら返します。"""
+    require_zstandard()
+    dctx = zstandard.ZstdDecompressor()
+    with open(path, 'rb') as f:
+        frames = read_seek_table(f)
+        f.seek(0)
+        for c_size, d_size in frames:
+            data = dctx.decompress(f.read(c_size), max_output_size=d_size)
+            yield from data.splitlines(keepends=True)
+
+class SegmentedJsonl:
+    """
+    messages.jsonl を月またはサイズで区切ったセグメントに分割して保存するためのクラス。
+    messages.jsonl は追記中の現在のセグメントとしてそのまま残り、書き込み・チェックポイント・索引は従来どおり動作します。
+    roll() は編集/削除の確認期間より古い行だけを圧縮済みのセグメントへ移すため、編集/削除の反映は現在のセグメントのみで完結します。
+    iter_lines() は全てのセグメントと現在のセグメントを順に読み、分割の有無を意識せずに全ての行を返します。
+    """
+    def __init__(self, jsonl_file: str):
+        self.jsonl_file: str = jsonl_file
+        self.segments_dir: str = os.path.join(os.path.dirname(jsonl_file), SEGMENTS_DIR_NAME)
+
+    def segments(self) -> List[str]:
+        """確定したセグメントのパスをID順に返します。"""
+        if not os.path.isdir(self.segments_dir):
+            return []
+        return [os.path.join(self.segments_dir, name) for name in sorted(os.listdir(self.segments_dir)) if name.endswith(SEGMENT_SUFFIX)]
+
+    def last_segment_id(self) -> Optional[int]:
+        """最後のセグメントに含まれる最新のメッセージIDを返します。"""
+        segments = self.segments()
+        if not segments:
+            return None
+        return int(os.path.basename(segments[-1])[:-len(SEGMENT_SUFFIX)].split("-")[-1])
+
+    def iter_lines(self) -> Iterator[bytes]:
+        """全てのセグメントと messages.jsonl の行を古い順に返します。"""
+        for path in self.segments():
+            yield from iter_segment_lines(path)
+        if os.path.exists(self.jsonl_file):
+            with open(self.jsonl_file, 'rb') as f:
+                yield from self._skip_rolled(f)
+
+    def _skip_rolled(self, lines: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        セグメントの書き込み後、messages.jsonl の置き換え前に中断された場合に残る重複した行を読み飛ばします。
+        messages.jsonl はID順のため、先頭の数行のみを確認します。
+        """
+        last_id = self.last_segment_id()
+        for line in lines:
+            if last_id is not None:
+                try:
+                    if json.loads(line)["id"] <= last_id:
+                        continue
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    pass
+                last_id = None
+            yield line
+
+    def _grouper(self, keep_since: str, by: str, max_bytes: int) -> Optional[Callable[[bytes], Tuple[Optional[int], Optional[str]]]]:
+        """行をまとめるセグメントのキーを返す関数を返します。messages.jsonl がない、または分割するサイズに達していない場合は None を返します。"""
+        if not os.path.exists(self.jsonl_file):
+            return None
+        if by == "size":
+            if os.path.getsize(self.jsonl_file) < max_bytes:
+                return None
+            cutoff = keep_since
+        else:
+            cutoff = keep_since[:7]
+
+        def group_of(line: bytes) -> Tuple[Optional[int], Optional[str]]:
+            """(メッセージID, まとめるセグメントのキー) を返します。移動の対象外の行はキーが None になります。"""
+            if not line.endswith(b"\n"):
+                return None, None
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                return None, None
+            if by == "size":
+                return record["id"], "" if record["created_at"][:10] < cutoff else None
+            month = record["created_at"][:7]
+            return record["id"], month if month < cutoff else None
+        return group_of
+
+    def needs_roll(self, keep_since: str, by: str = "month", max_bytes: int = 0) -> bool:
+        """roll() でセグメントへ移す行があるかどうかを、先頭の行のみを読んで判定します。"""
+        group_of = self._grouper(keep_since, by, max_bytes)
+        if group_of is None:
+            return False
+        with open(self.jsonl_file, 'rb') as f:
+            first_line = next(self._skip_rolled(f), None)
+        return first_line is not None and group_of(first_line)[1] is not None
+
+    def roll(self, keep_since: str, by: str = "month", max_bytes: int = 0) -> int:
+        """
+        messages.jsonl のうち keep_since（YYYY-MM-DD）より前の行をセグメントへ移し、移した行数を返します。
+        by が "month" の場合は keep_since の月より前の行を月ごとのセグメントに、
+        "size" の場合は messages.jsonl が max_bytes を超えた時点で keep_since より前の行を1つのセグメントにまとめます。
+        呼び出し側は messages.jsonl の開いたままのハンドルを閉じておく必要があります。
+        索引 (messages.idx) は置き換え前に削除されるため、次回の参照時に作り直されます。
+        """
+        # 先頭の行が対象外であれば、ファイル全体を読まずに終了する
+        if not self.needs_roll(keep_since, by, max_bytes):
+            return 0
+        group_of = self._grouper(keep_since, by, max_bytes)
+        require_zstandard()
+
+        os.makedirs(self.segments_dir, exist_ok=True)
+        tmp_path = f"{self.jsonl_file}.tmp"
+        rolled = 0
+        with open(self.jsonl_file, 'rb') as src:
+            writer: Optional[SegmentWriter] = None
+            writer_group: Optional[str] = None
+            tail: Optional[bytes] = None
+            for line in self._skip_rolled(src):
+                message_id, group = group_of(line)
+                if group is None:
+                    tail = line
+                    break
+                if writer is not None and group != writer_group:
+                    writer.close()
+                    rolled += writer.count
+                    writer = None
+                if writer is None:
+                    writer = SegmentWriter(self.segments_dir)
+                    writer_group = group
+                writer.write_line(line, message_id)
+            if writer is not None:
+                writer.close()
+                rolled += writer.count
+
+            # 残りの行で messages.jsonl を置き換える
+            with open(tmp_path, 'wb') as dst:
+                if tail is not None:
+                    dst.write(tail)
+                    shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+        # 索引は置き換え前のバイト位置を指すため、先に削除する
+        index_path = MessageIndex(self.jsonl_file).path
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.replace(tmp_path, self.jsonl_file)
+        logger.info(f"{self.jsonl_file} の {rolled} 行をセグメントへ移しました。")
+        return rolled
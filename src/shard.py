@@ -0,0 +1,133 @@
+import os
+import time
+import queue
+import logging
+import multiprocessing
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from .config import LOGGER_NAME, DATA_DIR, EXPORT_DIR
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# 全体の進捗をログに出力する間隔（秒）
+PROGRESS_INTERVAL = 10.0
+
+def guild_data_dir(guild_id: int) -> str:
+    """複数ギルドの実行時の、ギルドごとの保存先"""
+    return os.path.join(DATA_DIR, str(guild_id))
+
+def run_guild(guild_id: int, daemon: bool, reconcile: bool, max_runtime: float, progress: Any) -> None:
+    """ワーカープロセスで1つのギルドを取得します。保存先と対象のギルドは起動時の環境変数で指定されています。"""
+    # 同じ端末に複数のギルドのログが混ざるため、ギルドIDを付ける
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f'%(asctime)s - [{guild_id}] %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    from .fetch_logs import run_fetcher
+    run_fetcher(daemon=daemon, reconcile=reconcile, max_runtime=max_runtime, on_progress=lambda event: progress.put((guild_id, event)))
+
+@dataclass
+class GuildProgress:
+    """親プロセスで集計する1つのギルドの進捗"""
+    guild_id: int
+    state: str = "待機中"
+    targets: int = 0
+    done: int = 0
+    messages: int = 0
+
+    def describe(self) -> str:
+        return f"{self.guild_id}: {self.state} {self.done}/{self.targets} 件 ({self.messages} 件のメッセージ)"
+
+class ShardedRunner:
+    """
+    複数のギルドをワーカープロセスに割り当てて取得するクラス。
+    各ワーカーは独立したログイン・StorageManager・状態ファイル（DATA_DIR/<ギルドID>/）を持ち、
+    ギルドごとのレート制限のバケットを並行して使用します。
+    同時に起動するワーカーの数は workers までに制限し、終了したワーカーから順に次のギルドを割り当てます。
+    ワーカーからの進捗は親プロセスのキューに集められ、全ギルドをまとめた1行のログとして出力されます。
+    """
+    def __init__(self, guild_ids: List[int], workers: int = 0, daemon: bool = False, reconcile: bool = False, max_runtime: float = 0):
+        self.guild_ids: List[int] = guild_ids
+        # 常駐モードのワーカーは終了しないため、全てのギルドを同時に起動する
+        self.workers: int = len(guild_ids) if daemon else min(len(guild_ids), workers or os.cpu_count() or 1)
+        self.daemon: bool = daemon
+        self.reconcile: bool = reconcile
+        # ギルドごとの実行時間の上限（各ワーカーの起動から数える）
+        self.max_runtime: float = max_runtime
+        self.progress: Dict[int, GuildProgress] = {guild_id: GuildProgress(guild_id) for guild_id in guild_ids}
+
+    def run(self) -> None:
+        logger.info(f"{len(self.guild_ids)} 件のギルドを {self.workers} 個のワーカープロセスで取得します。")
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        pending = list(self.guild_ids)
+        running: Dict[int, Any] = {}
+        last_report = time.monotonic()
+        while pending or running:
+            while pending and len(running) < self.workers:
+                guild_id = pending.pop(0)
+                running[guild_id] = self.start_worker(context, guild_id, events)
+            self._drain(events, timeout=1.0)
+            for guild_id, process in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[guild_id]
+                if process.exitcode != 0:
+                    self.progress[guild_id].state = "失敗"
+                    logger.error(f"ギルド {guild_id} のワーカーが異常終了しました (終了コード {process.exitcode})。")
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                self.log_progress()
+                last_report = time.monotonic()
+        self._drain(events)
+        self.log_progress()
+
+    def start_worker(self, context: Any, guild_id: int, events: Any) -> Any:
+        """
+        ギルドを取得するワーカープロセスを起動します。
+        設定はモジュールの読み込み時に保存先が決まるため、起動時の環境変数で保存先と対象のギルドを指定します
+        （spawn で起動したプロセスは、起動時点の親プロセスの環境変数を引き継ぎます）。
+        """
+        overrides = {
+            "SDI_SHARD_GUILD_ID": str(guild_id),
+            "SDI_DATA_DIR": guild_data_dir(guild_id),
+            "SDI_EXPORT_DIR": os.path.join(EXPORT_DIR, str(guild_id)),
+        }
+        saved = {key: os.environ.get(key) for key in overrides}
+        os.environ.update(overrides)
+        try:
+            process = context.Process(target=run_guild, args=(guild_id, self.daemon, self.reconcile, self.max_runtime, events), name=f"guild-{guild_id}")
+            process.start()
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        return process
+
+    def _drain(self, events: Any, timeout: Optional[float] = None) -> None:
+        """キューに届いた進捗を全て反映します。timeout を指定した場合は最初の1件をその秒数だけ待ちます。"""
+        try:
+            while True:
+                guild_id, event = events.get(timeout=timeout) if timeout else events.get_nowait()
+                timeout = None
+                self.apply(guild_id, event)
+        except queue.Empty:
+            pass
+
+    def apply(self, guild_id: int, event: Dict[str, Any]) -> None:
+        progress = self.progress[guild_id]
+        kind = event.get("event")
+        if kind == "planned":
+            progress.state = "取得中"
+            progress.targets = event.get("targets", 0)
+        elif kind == "target_done":
+            progress.done += 1
+            progress.messages += event.get("messages", 0)
+        elif kind == "finished":
+            progress.state = "完了"
+
+    def log_progress(self) -> None:
+        done = sum(p.done for p in self.progress.values())
+        targets = sum(p.targets for p in self.progress.values())
+        messages = sum(p.messages for p in self.progress.values())
+        logger.info(f"全体の進捗: {done}/{targets} 件 ({messages} 件のメッセージ) | " + " | ".join(p.describe() for p in self.progress.values()))
@@ -1,24 +1,134 @@
 import os
 import json
+import time
+import asyncio
+import datetime
 import logging
-from typing import Dict, List, Any, Optional
+from collections import OrderedDict
+from typing import BinaryIO, Dict, List, Any, Optional, Set, Tuple
 import discord
-from .config import STATE_FILE, LOGGER_NAME
+from .config import STATE_FILE, JOURNAL_DIR, DATA_DIR, LOGGER_NAME
 from .formatter import MessageFormatter
+from .downloader import AttachmentDownloader
+from .message_index import MessageIndex
+from .segments import SegmentedJsonl
+from .metrics import TargetMetrics
+from .utils import atomic_write_json
 
 logger = logging.getLogger(LOGGER_NAME)
 
+# fetch_state 内でチャンネルごとのアーカイブ済みスレッドのウォーターマークを保持するキー
+ARCHIVE_WATERMARKS_KEY = "_archive_watermarks"
+# fetch_state 内で対象ごとの前回の取得時刻とメッセージの増加率を保持するキー（取得の優先度の計算に使用）
+FETCH_ACTIVITY_KEY = "_fetch_activity"
+# メッセージの増加率の移動平均の半減期（時間）。取得の間隔が短いほど、今回の観測値の重みを小さくする
+ACTIVITY_HALF_LIFE_HOURS = 24.0
+
+# 取得済みメッセージの編集/削除を追記するパッチファイルの拡張子（messages.jsonl → messages.patches.jsonl）
+PATCHES_SUFFIX = ".patches.jsonl"
+
+# バッチサイズの自動調整で目標とするフラッシュの間隔（秒）
+ADAPTIVE_FLUSH_INTERVAL = 2.0
+
+# フラッシュ後に状態ファイルを保存する（書き込んだファイルを fsync する）最短の間隔（秒）
+STATE_SAVE_INTERVAL = 5.0
+
+class FileHandleCache:
+    """
+    追記用のファイルハンドルを開いたまま保持するキャッシュ。
+    フラッシュのたびにファイルを開き直すことを避け、同時に開くファイル数は LRU で max_open 件までに制限します。
+    """
+    def __init__(self, max_open: int = 64):
+        self.max_open: int = max(1, max_open)
+        self.handles: "OrderedDict[str, BinaryIO]" = OrderedDict()
+        # 開いた時点でファイルが存在しなかったパス（最初の書き込みまでサイズを None として扱う）
+        self.created: set = set()
+
+    def get(self, path: str) -> BinaryIO:
+        """追記用のハンドルを返します。上限を超えた場合は最も長く使われていないハンドルを閉じます。"""
+        handle = self.handles.get(path)
+        if handle is not None:
+            self.handles.move_to_end(path)
+            return handle
+        if not os.path.exists(path):
+            self.created.add(path)
+        handle = open(path, 'ab')
+        self.handles[path] = handle
+        while len(self.handles) > self.max_open:
+            old_path, old_handle = self.handles.popitem(last=False)
+            old_handle.close()
+            self.created.discard(old_path)
+        return handle
+
+    def size(self, path: str) -> Optional[int]:
+        """書き込み前のファイルサイズを返します。このキャッシュが作成した空のファイルの場合は None を返します。"""
+        size = self.get(path).tell()
+        return None if size == 0 and path in self.created else size
+
+    def written(self, path: str) -> None:
+        """書き込みが完了したことを記録します（以降は既存のファイルとして扱う）。"""
+        self.created.discard(path)
+
+    def sync(self, path: str) -> None:
+        """ファイルの内容をディスクへ書き出します。ハンドルが閉じられている場合はパスから開いて書き出します。"""
+        handle = self.handles.get(path)
+        if handle is not None:
+            handle.flush()
+            os.fsync(handle.fileno())
+        elif os.path.exists(path):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self, path: str) -> None:
+        handle = self.handles.pop(path, None)
+        if handle is not None:
+            handle.close()
+        self.created.discard(path)
+
+    def close_under(self, directory: str) -> None:
+        """指定したディレクトリ配下のファイルのハンドルを全て閉じます。"""
+        prefix = os.path.join(directory, "")
+        for path in [p for p in self.handles if p.startswith(prefix)]:
+            self.close(path)
+
+    def close_all(self) -> None:
+        for path in list(self.handles):
+            self.close(path)
+
 class StorageManager:
     """
     メッセージの保存と状態管理を行うクラス。
-    データのバッファリングとフラッシュを管理します。
+    書き込みバッファはチャンネル/スレッドごとに ChannelBuffer として生成します。
+
+    状態はフラッシュごとにメモリ上で進め、STATE_SAVE_INTERVAL 秒ごと（または save_state() の呼び出し時）に
+    書き込んだファイルを fsync してから状態ファイルへ保存します。対象の取得の終了時 (end_target()) も保存は同じ間隔でまとめて行います。保存後の最初のフラッシュの前に、
+    書き込み前のファイルサイズをジャーナルに記録し、状態の保存後にジャーナルを削除します。
+    起動時に残っているジャーナルは、保存された状態より後に書き込まれたデータとして切り詰めます。
+
+    シンク（on_flush(buffer, records) を持つオブジェクト）を登録すると、
+    チェックポイントの完了後にフラッシュしたメッセージが通知されます。
+    シンクが on_patch(buffer, patches) を持つ場合は、編集/削除のパッチも通知されます。
     """
-    def __init__(self, batch_size: int = 100):
+    def __init__(self, batch_size: int = 100, max_batch_size: int = 0, max_open_files: int = 64):
         self.fetch_state: Dict[str, Any] = self.load_state()
         self.batch_size: int = batch_size
-        self.buffer_content_md: Dict[str, str] = {}
-        self.buffer_content_jsonl: List[str] = []
-        self.current_batch_count: int = 0
+        # 0 またはバッチサイズ以下の場合、バッチサイズの自動調整は行わない
+        self.max_batch_size: int = max(batch_size, max_batch_size)
+        self.handles: FileHandleCache = FileHandleCache(max_open_files)
+        self.sinks: List[Any] = []
+        # 状態の保存後に書き込みを行った対象のジャーナル（キー -> ジャーナルの内容）
+        self.journals: Dict[str, Dict[str, Any]] = {}
+        # ジャーナルに記録したファイルを、最後のフラッシュの後に fsync 済みのキー（状態の保存時に再度 fsync しない）
+        self.synced_keys: Set[str] = set()
+        self.last_saved_at: float = time.monotonic()
+        self.repair()
+
+    def add_sink(self, sink: Any) -> None:
+        """フラッシュ完了時に通知を受けるシンクを登録します。"""
+        self.sinks.append(sink)
 
     def load_state(self) -> Dict[str, Any]:
         """保存された状態を読み込みます。"""
@@ -32,12 +142,141 @@ class StorageManager:
         return {}
 
     def save_state(self) -> None:
-        """現在の状態をファイルに保存します。"""
+        """
+        前回の保存後に書き込んだファイルを fsync してから、現在の状態をファイルに保存します（一時ファイルへの書き込み後に置き換え）。
+        保存した状態までのデータは確定しているため、ジャーナルを削除します。
+        """
         try:
-            with open(STATE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.fetch_state, f, indent=4)
+            for key, journal in self.journals.items():
+                if key in self.synced_keys:
+                    continue
+                for rel_path in journal["files"]:
+                    self.handles.sync(os.path.join(DATA_DIR, rel_path))
+            atomic_write_json(STATE_FILE, self.fetch_state, indent=4)
         except Exception as e:
             logger.error(f"状態ファイルの保存に失敗しました: {e}")
+            return
+        for key in self.journals:
+            journal_path = self.journal_path(key)
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+        self.journals.clear()
+        self.synced_keys.clear()
+        self.last_saved_at = time.monotonic()
+
+    def save_state_if_due(self) -> None:
+        """前回の保存から STATE_SAVE_INTERVAL 秒以上経過している場合は状態を保存します。"""
+        if time.monotonic() - self.last_saved_at >= STATE_SAVE_INTERVAL:
+            self.save_state()
+
+    def sync(self, key: str) -> None:
+        """指定されたキーに保存されていない書き込みがある場合は、状態を保存します（ファイルの置き換えの前などに使用）。"""
+        if key in self.journals:
+            self.save_state()
+
+    def end_target(self, key: str) -> None:
+        """
+        対象の取得の終了時に、書き込んだファイルを fsync します（ハンドルを閉じる前に使用）。
+        状態ファイルは全ての対象の状態を含むため、対象ごとには保存せず STATE_SAVE_INTERVAL 秒ごとにまとめて保存します。
+        """
+        journal = self.journals.get(key)
+        if journal is not None and key not in self.synced_keys:
+            for rel_path in journal["files"]:
+                self.handles.sync(os.path.join(DATA_DIR, rel_path))
+            self.synced_keys.add(key)
+        self.save_state_if_due()
+
+    def journal_path(self, key: str) -> str:
+        return os.path.join(JOURNAL_DIR, f"{key}.json")
+
+    def begin_checkpoint(self, key: str, message_id: int, paths: List[str], sizes: Optional[Dict[str, Optional[int]]] = None) -> None:
+        """
+        フラッシュの開始を記録します。
+        状態の保存後の最初のフラッシュでは、書き込み対象の各ファイルについて書き込み前のサイズ（新規の場合は None）をジャーナルに保存します。
+        以降のフラッシュでは、新しく書き込むファイルがある場合のみジャーナルを更新します。
+        sizes に含まれるパスは、ファイルを参照せずにその値を使用します。
+        """
+        sizes = sizes or {}
+        self.synced_keys.discard(key)
+        journal = self.journals.get(key)
+        if journal is None:
+            # last_message_id は保存後の最初のフラッシュのID、base_message_id は保存済みの状態（巻き戻し先）
+            journal = {"key": key, "last_message_id": message_id, "base_message_id": self.get_last_message_id(key), "files": {}}
+        new_files = {
+            os.path.relpath(path, DATA_DIR): sizes[path] if path in sizes else (os.path.getsize(path) if os.path.exists(path) else None)
+            for path in paths if os.path.relpath(path, DATA_DIR) not in journal["files"]
+        }
+        if not new_files:
+            return
+        journal["files"].update(new_files)
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        atomic_write_json(self.journal_path(key), journal)
+        self.journals[key] = journal
+
+    def commit_checkpoint(self, key: str, message_id: int) -> None:
+        """書き込みが完了したデータまで状態を進めます。前回の保存から STATE_SAVE_INTERVAL 秒以上経過している場合は状態を保存します。"""
+        self.update_last_message_id(key, message_id)
+        self.save_state_if_due()
+
+    def rollback_checkpoint(self, key: str) -> None:
+        """ジャーナルに記録されたサイズまでファイルを切り詰め、状態を保存済みの位置に戻してジャーナルを削除します。"""
+        journal_path = self.journal_path(key)
+        self.journals.pop(key, None)
+        self.synced_keys.discard(key)
+        try:
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                journal = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"ジャーナル {journal_path} の読み込みに失敗しました: {e}")
+            return
+
+        # 状態の保存前のフラッシュも巻き戻すため、メモリ上の状態も保存済みの位置に戻す（以前の形式のジャーナルには含まれない）
+        if "base_message_id" in journal:
+            if journal["base_message_id"] is None:
+                self.fetch_state.pop(key, None)
+            else:
+                self.fetch_state[key] = journal["base_message_id"]
+
+        for rel_path, size in journal.get("files", {}).items():
+            path = os.path.join(DATA_DIR, rel_path)
+            # 開いたままのハンドルの書き込み位置が切り詰め後のサイズとずれないよう、先に閉じる
+            self.handles.close(path)
+            if not os.path.exists(path):
+                continue
+            if size is None:
+                os.remove(path)
+            elif os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        os.remove(journal_path)
+
+    def repair(self) -> None:
+        """
+        前回の実行が中断された場合に、チェックポイントより後に書き込まれたデータを切り詰めます。
+        状態の保存まで完了していたジャーナルは削除のみ行います。
+        """
+        if not os.path.isdir(JOURNAL_DIR):
+            return
+        for name in os.listdir(JOURNAL_DIR):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            journal_path = self.journal_path(key)
+            try:
+                with open(journal_path, 'r', encoding='utf-8') as f:
+                    journal_last_id = json.load(f).get("last_message_id")
+            except (OSError, json.JSONDecodeError):
+                # ジャーナル自体の書き込み中に中断された場合は、データはまだ書き込まれていない
+                os.remove(journal_path)
+                continue
+
+            committed_id = self.get_last_message_id(key)
+            if committed_id is not None and journal_last_id is not None and committed_id >= journal_last_id:
+                os.remove(journal_path)
+                continue
+
+            logger.warning(f"前回の実行が中断されたため、{key} のチェックポイント以降のデータを切り詰めます。")
+            self.rollback_checkpoint(key)
 
     def get_last_message_id(self, key: str) -> Optional[int]:
         """指定されたキー（チャンネルIDなど）の最後のメッセージIDを取得します。"""
@@ -47,30 +286,111 @@ class StorageManager:
         """指定されたキーの最後のメッセージIDを更新します。"""
         self.fetch_state[key] = message_id
 
-    async def add_message(self, message: discord.Message, attachments_dir: str, messages_dir: str, jsonl_file: str) -> None:
+    def get_archive_watermark(self, channel_key: str) -> Optional[datetime.datetime]:
+        """指定されたチャンネルで取得済みのアーカイブ済みスレッドの最新 archive_timestamp を取得します。"""
+        value = self.fetch_state.get(ARCHIVE_WATERMARKS_KEY, {}).get(channel_key)
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    def update_archive_watermark(self, channel_key: str, archived_at: datetime.datetime) -> None:
+        """指定されたチャンネルのアーカイブ済みスレッドのウォーターマークを更新します。"""
+        self.fetch_state.setdefault(ARCHIVE_WATERMARKS_KEY, {})[channel_key] = archived_at.isoformat()
+
+    def get_activity(self, key: str) -> Optional[Dict[str, float]]:
+        """指定されたキーの前回の取得時刻 (fetched_at, UNIX時刻) と1時間あたりのメッセージ数 (rate) を取得します。"""
+        return self.fetch_state.get(FETCH_ACTIVITY_KEY, {}).get(key)
+
+    def record_activity(self, key: str, messages: int, created_at: datetime.datetime) -> None:
+        """
+        今回の取得で得たメッセージ数から、指定されたキーの1時間あたりのメッセージ数を更新します。
+        前回の取得時刻から現在までの時間で割った値を、間隔に応じた重み（半減期 ACTIVITY_HALF_LIFE_HOURS）で移動平均に加えます。
+        初回は created_at（チャンネル/スレッドの作成時刻）からの平均を使用します。
+        取得が途中で打ち切られた場合は、観測した間隔と件数が対応しないため呼び出さないでください。
+        """
+        now = time.time()
+        activities = self.fetch_state.setdefault(FETCH_ACTIVITY_KEY, {})
+        previous = activities.get(key)
+        if previous:
+            hours = max((now - previous["fetched_at"]) / 3600, 1 / 60)
+            weight = 1 - 0.5 ** (hours / ACTIVITY_HALF_LIFE_HOURS)
+            rate = weight * (messages / hours) + (1 - weight) * previous["rate"]
+        else:
+            rate = messages / max((now - created_at.timestamp()) / 3600, 1 / 60)
+        activities[key] = {"fetched_at": round(now, 3), "rate": round(rate, 4)}
+
+    def create_buffer(self, key: str, attachments_dir: str, messages_dir: str, jsonl_file: str, downloader: Optional[AttachmentDownloader] = None,
+                      channel_id: Optional[int] = None, thread_id: Optional[int] = None, metrics: Optional[TargetMetrics] = None) -> "ChannelBuffer":
+        """
+        チャンネル/スレッド単位の書き込みバッファを生成します。
+        並行して処理されるジョブはそれぞれ独自のバッファを使用します。
+        """
+        return ChannelBuffer(self, key, attachments_dir, messages_dir, jsonl_file, batch_size=self.batch_size, max_batch_size=self.max_batch_size, downloader=downloader,
+                             channel_id=channel_id, thread_id=thread_id, metrics=metrics)
+
+class ChannelBuffer:
+    """
+    1つのチャンネル/スレッドに対応する書き込みバッファ。
+    データのバッファリングとフラッシュを管理し、フラッシュが完了した時点で状態を進めます。
+    max_batch_size がバッチサイズより大きい場合、メッセージの流量に応じてバッチサイズを自動で調整します
+    （フラッシュの間隔が短ければ倍に、長ければ半分に）。
+    """
+    def __init__(self, storage: StorageManager, key: str, attachments_dir: str, messages_dir: str, jsonl_file: str, batch_size: int = 100,
+                 max_batch_size: int = 0, downloader: Optional[AttachmentDownloader] = None, channel_id: Optional[int] = None, thread_id: Optional[int] = None,
+                 metrics: Optional[TargetMetrics] = None):
+        self.storage: StorageManager = storage
+        self.key: str = key
+        self.channel_id: Optional[int] = channel_id
+        self.thread_id: Optional[int] = thread_id
+        self.attachments_dir: str = attachments_dir
+        self.messages_dir: str = messages_dir
+        self.jsonl_file: str = jsonl_file
+        self.batch_size: int = batch_size
+        self.min_batch_size: int = batch_size
+        self.max_batch_size: int = max(batch_size, max_batch_size)
+        self.last_flush_at: float = time.monotonic()
+        self.downloader: Optional[AttachmentDownloader] = downloader
+        # 日付 -> Markdownの断片のリスト（フラッシュ時にまとめて結合する）
+        self.buffer_content_md: Dict[str, List[str]] = {}
+        self.buffer_content_jsonl: List[str] = []
+        # シンクへ渡すためのJSONLと同じ内容のレコード
+        self.buffer_records: List[Dict[str, Any]] = []
+        self.current_batch_count: int = 0
+        # バッファ内の最新メッセージID（フラッシュ完了時に状態へ反映される）
+        self.pending_last_id: Optional[int] = None
+        # メッセージIDから messages.jsonl の行を引くための索引（フラッシュごとに追記）
+        self.index: MessageIndex = MessageIndex(jsonl_file)
+        # 変換・フラッシュの所要時間と書き込んだバイト数の計測値
+        self.metrics: TargetMetrics = metrics or TargetMetrics(key)
+
+    async def add_message(self, message: discord.Message) -> None:
         """
         メッセージをバッファに追加します。
         バッファサイズが閾値に達した場合、自動的にフラッシュします。
         """
-        # --- Markdownフォーマット & 添付ファイル保存 ---
-        # 保存されたファイル名を取得するために先に実行する
+        self.add_rendered(message.id, *await self.render(message))
+
+    async def render(self, message: discord.Message) -> Tuple[str, Optional[str], Optional[Dict[str, Any]]]:
+        """
+        メッセージを (日付, Markdown, JSONLレコード) に変換します。
+        変換に失敗した部分は None になります。
+        """
+        msg_date_str = message.created_at.strftime('%Y-%m-%d')
+
+        # --- Markdownフォーマット & 添付ファイルのダウンロード要求 ---
+        # 保存先のファイル名を取得するために先に実行する
+        formatted_msg = None
         attachment_rel_paths = []
+        started = time.perf_counter()
         try:
-            formatted_msg, attachment_filenames = await MessageFormatter.to_markdown(message, attachments_dir)
+            formatted_msg, attachment_filenames = await MessageFormatter.to_markdown(message, self.attachments_dir, self.downloader, self.lookup_message)
             
             # JSONL用の相対パスを作成
             attachment_rel_paths = [f"attachments/{fname}" for fname in attachment_filenames]
-
-            msg_date_str = message.created_at.strftime('%Y-%m-%d')
-            
-            if msg_date_str not in self.buffer_content_md:
-                self.buffer_content_md[msg_date_str] = ""
-            
-            self.buffer_content_md[msg_date_str] += formatted_msg
         except Exception as e:
             logger.error(f"メッセージID {message.id} のMarkdown変換中にエラーが発生しました: {e}")
+        self.metrics.render_seconds += time.perf_counter() - started
 
         # --- JSONLデータの準備 ---
+        msg_data = None
         try:
             msg_data = {
                 "id": message.id,
@@ -97,46 +417,192 @@ class StorageManager:
                     "count": r.count
                 } for r in message.reactions]
             }
-            self.buffer_content_jsonl.append(json.dumps(msg_data, ensure_ascii=False) + "\n")
         except Exception as e:
             logger.error(f"メッセージID {message.id} のJSONデータ作成中にエラーが発生しました: {e}")
 
+        return msg_date_str, formatted_msg, msg_data
+
+    def lookup_message(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """同じチャンネル/スレッドの保存済み（またはバッファ内の）メッセージのレコードを返します。"""
+        for record in reversed(self.buffer_records):
+            if record["id"] == message_id:
+                return record
+        if self.pending_last_id is not None and message_id > self.pending_last_id:
+            return None
+        self.index.ensure()
+        return self.index.lookup(message_id)
+
+    def add_rendered(self, message_id: int, msg_date_str: str, formatted_msg: Optional[str], msg_data: Optional[Dict[str, Any]]) -> None:
+        """
+        render() で変換済みのメッセージをバッファに追加します。
+        バッファサイズが閾値に達した場合、自動的にフラッシュします。
+        """
+        if formatted_msg is not None:
+            chunks = self.buffer_content_md.get(msg_date_str)
+            if chunks is None:
+                chunks = self.buffer_content_md[msg_date_str] = []
+            chunks.append(formatted_msg)
+
+        if msg_data is not None:
+            self.buffer_content_jsonl.append(json.dumps(msg_data, ensure_ascii=False) + "\n")
+            self.buffer_records.append(msg_data)
+
         self.current_batch_count += 1
+        self.pending_last_id = message_id
 
         # バッファが一杯になったら書き込む
         if self.current_batch_count >= self.batch_size:
-            self.flush(messages_dir, jsonl_file)
+            self.flush()
+            self._adapt_batch_size()
+
+    def _adapt_batch_size(self) -> None:
+        """直前のフラッシュからの経過時間に応じてバッチサイズを調整します。"""
+        now = time.monotonic()
+        interval = now - self.last_flush_at
+        self.last_flush_at = now
+        if interval < ADAPTIVE_FLUSH_INTERVAL / 2:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+        elif interval > ADAPTIVE_FLUSH_INTERVAL * 2:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
 
-    def flush(self, messages_dir: str, jsonl_file: str) -> None:
-        """バッファ内のデータをファイルに書き込み、バッファをクリアします。"""
+    def flush(self) -> None:
+        """
+        バッファ内のデータをファイルに書き込み、バッファをクリアします。
+        書き込みが完了してから状態を進めます。書き込みに失敗した場合は書き込み前の状態に戻し、OSError を送出します。
+        """
         if not self.buffer_content_md and not self.buffer_content_jsonl:
             return
 
-        # Markdownファイルの書き込み
-        for date_str, content in self.buffer_content_md.items():
-            md_file_path = os.path.join(messages_dir, f"{date_str}.md")
+        started = time.perf_counter()
+        written = 0
+        handles = self.storage.handles
+        md_files = {date_str: os.path.join(self.messages_dir, f"{date_str}.md") for date_str in self.buffer_content_md}
+        paths = list(md_files.values())
+        if self.buffer_content_jsonl:
+            self.index.ensure()
+            paths.extend([self.jsonl_file, self.index.path])
+        # 書き込み前のサイズは開いたままのハンドルから取得する
+        sizes = {path: handles.size(path) for path in paths}
+        self.storage.begin_checkpoint(self.key, self.pending_last_id, paths, sizes)
+
+        try:
+            # Markdownファイルの書き込み
+            for date_str, chunks in self.buffer_content_md.items():
+                md_file_path = md_files[date_str]
+                try:
+                    f = handles.get(md_file_path)
+                    data = "".join(chunks).encode('utf-8')
+                    # 新規（空）の場合はファイルを初期化（ヘッダー書き込み）
+                    if not sizes[md_file_path]:
+                        data = f"# {date_str}\n\n".encode('utf-8') + data
+                    f.write(data)
+                    written += len(data)
+                    # fsync は状態の保存時にまとめて行う
+                    f.flush()
+                    handles.written(md_file_path)
+                except Exception as e:
+                    logger.error(f"Markdownファイル {md_file_path} への書き込みに失敗しました: {e}")
+                    raise
+
+            # JSONLの書き込み（各行の位置を索引に追記する）
+            if self.buffer_content_jsonl:
+                try:
+                    offset = sizes[self.jsonl_file] or 0
+                    entries = []
+                    chunks = []
+                    for line, record in zip(self.buffer_content_jsonl, self.buffer_records):
+                        data = line.encode('utf-8')
+                        chunks.append(data)
+                        entries.append((record["id"], offset))
+                        offset += len(data)
+                    f = handles.get(self.jsonl_file)
+                    data = b"".join(chunks)
+                    f.write(data)
+                    written += len(data)
+                    f.flush()
+                    handles.written(self.jsonl_file)
+                    index = handles.get(self.index.path)
+                    index.write(MessageIndex.pack(entries))
+                    index.flush()
+                    handles.written(self.index.path)
+                except Exception as e:
+                    logger.error(f"JSONLファイル {self.jsonl_file} への書き込みに失敗しました: {e}")
+                    raise
+        except Exception as e:
+            self.storage.rollback_checkpoint(self.key)
+            self._reset()
+            raise OSError(f"{self.key} のフラッシュに失敗したため、チェックポイントまで巻き戻しました") from e
+
+        self.storage.commit_checkpoint(self.key, self.pending_last_id)
+        self.metrics.flushes += 1
+        self.metrics.flush_seconds += time.perf_counter() - started
+        self.metrics.written_bytes += written
+
+        # シンクへの通知（失敗してもデータ自体は保存済みのため、ログのみ出力する）
+        for sink in self.storage.sinks:
             try:
-                # 新規の場合はファイルを初期化（ヘッダー書き込み）
-                if not os.path.exists(md_file_path):
-                    with open(md_file_path, 'w', encoding='utf-8') as f:
-                        f.write(f"# {date_str}\n\n")
-                
-                with open(md_file_path, 'a', encoding='utf-8') as f:
-                    f.write(content)
+                sink.on_flush(self, self.buffer_records)
             except Exception as e:
-                logger.error(f"Markdownファイル {md_file_path} への書き込みに失敗しました: {e}")
-        
-        # JSONLの書き込み
-        if self.buffer_content_jsonl:
+                logger.error(f"{type(sink).__name__} への書き込みに失敗しました: {e}")
+
+        self._reset()
+
+    @property
+    def patches_file(self) -> str:
+        """取得済みメッセージの編集/削除を記録するパッチファイルのパス"""
+        return os.path.splitext(self.jsonl_file)[0] + PATCHES_SUFFIX
+
+    def append_patches(self, patches: List[Dict[str, Any]]) -> None:
+        """
+        編集/削除のパッチをパッチファイルに追記し、シンクへ通知します。
+        パッチは同じものを複数回適用しても結果が変わらないため、チェックポイントの対象にはしません。
+        """
+        if not patches:
+            return
+        with open(self.patches_file, 'a', encoding='utf-8') as f:
+            for patch in patches:
+                f.write(json.dumps(patch, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        for sink in self.storage.sinks:
+            if not hasattr(sink, 'on_patch'):
+                continue
             try:
-                with open(jsonl_file, 'a', encoding='utf-8') as f:
-                    for line in self.buffer_content_jsonl:
-                        f.write(line)
+                sink.on_patch(self, patches)
             except Exception as e:
-                logger.error(f"JSONLファイル {jsonl_file} への書き込みに失敗しました: {e}")
+                logger.error(f"{type(sink).__name__} への書き込みに失敗しました: {e}")
 
-        # バッファのリセット
+    async def roll_segments(self, window_days: int, by: str = "month", max_bytes: int = 0) -> int:
+        """
+        編集/削除の確認期間（window_days 日）より古い messages.jsonl の行を圧縮済みのセグメントへ移し、移した行数を返します。
+        messages.jsonl が置き換えられた場合は索引を作り直します。
+        圧縮とファイルの置き換えは、他の取得ジョブやゲートウェイの処理を止めないよう別スレッドで行います。
+        """
+        keep_since = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=window_days)).strftime('%Y-%m-%d')
+        # 移す行がなければ、状態を保存せずに終了する（先頭の行のみを読む）
+        if not SegmentedJsonl(self.jsonl_file).needs_roll(keep_since, by=by, max_bytes=max_bytes):
+            return 0
+        # ジャーナルは置き換え前のファイルサイズを指すため、置き換えの前に状態を保存しておく
+        self.storage.sync(self.key)
+        self.close()
+        return await asyncio.to_thread(self._roll_segments, keep_since, by, max_bytes)
+
+    def _roll_segments(self, keep_since: str, by: str, max_bytes: int) -> int:
+        rolled = SegmentedJsonl(self.jsonl_file).roll(keep_since, by=by, max_bytes=max_bytes)
+        if rolled:
+            self.index.ensure()
+        return rolled
+
+    def close(self) -> None:
+        """このチャンネル/スレッドのファイルについて、開いたままのハンドルを閉じます。"""
+        self.storage.handles.close(self.jsonl_file)
+        self.storage.handles.close(self.index.path)
+        self.storage.handles.close_under(self.messages_dir)
+
+    def _reset(self) -> None:
+        """バッファのリセット"""
         self.buffer_content_md.clear()
         self.buffer_content_jsonl.clear()
+        self.buffer_records.clear()
         self.current_batch_count = 0
-
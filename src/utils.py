@@ -1,3 +1,7 @@
+import os
+import json
+from typing import Any, Iterator, Optional, Tuple
+
 def sanitize(name: str) -> str:
     """
     ファイル名またはディレクトリ名として安全に使用できるように文字列をサニタイズします。
@@ -15,3 +19,57 @@ def replace_fake_uppercase(text: str) -> str:
         "ꓬ": "Y", "ꓜ": "Z"
     }
     return "".join(mapping.get(c, c) for c in text)
+
+def atomic_write_json(path: str, data: Any, indent: Optional[int] = None) -> None:
+    """
+    JSONを一時ファイルに書き込んでから置き換えることで、途中で中断されても壊れないように保存します。
+    """
+    atomic_write_text(path, json.dumps(data, indent=indent, ensure_ascii=False))
+
+def atomic_write_text(path: str, text: str) -> None:
+    """テキストを一時ファイルに書き込んでから置き換えます。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def iter_lines_reversed(path: str, chunk_size: int = 64 * 1024) -> Iterator[Tuple[int, bytes]]:
+    """
+    ファイルを末尾から読み、(行の先頭のバイト位置, 行の内容) を新しい行から順に返します。
+    追記型のJSONLで直近のレコードだけを読むために使用し、ファイル全体は読み込みません。
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b""
+        while position > 0:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b"\n")
+            # 先頭の断片は前のチャンクと結合するまで行として確定しない
+            remainder = lines.pop(0)
+            offset = position + len(remainder) + 1
+            line_offsets = []
+            for line in lines:
+                line_offsets.append((offset, line))
+                offset += len(line) + 1
+            for line_offset, line in reversed(line_offsets):
+                if line:
+                    yield line_offset, line
+        if remainder:
+            yield 0, remainder
+
+def read_channel_ids(channel_dir: str) -> Tuple[Optional[int], Optional[int]]:
+    """channel_info.json からチャンネルIDとスレッドIDを取得します。"""
+    meta_file = os.path.join(channel_dir, "channel_info.json")
+    try:
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None, None
+    if meta.get("is_thread"):
+        return meta.get("parent_id"), meta.get("id")
+    return meta.get("id"), None